@@ -0,0 +1,271 @@
+"""
+Dependency-tracked incremental builds, for the paper figures and tables.
+
+Each BuildNode declares the files it reads (`inputs`), the files it writes
+(`outputs`), and a shell command that makes the outputs. A BuildGraph hashes
+every input and output, and remembers the hashes from the last successful
+run of each node in a JSON state file. A node is rebuilt only if
+
+    * an output is missing, or has changed since it was made,
+    * an input's hash differs from the one recorded at the last build, or
+    * its command changed.
+
+Nodes are linked implicitly: if node B lists as an input a file that node A
+outputs, A runs first. Nodes whose dependencies are satisfied run in
+parallel. Because staleness is decided by content hashes (not modification
+times), a node that is re-run but writes byte-identical outputs does not
+trigger its dependents.
+
+Usage:
+
+    g = BuildGraph(statepath)
+    g.add('hr', 'python plot_hr.py', inputs=[...], outputs=[...], cwd=...)
+    ...
+    g.build(N_workers=4)
+"""
+import os, json, hashlib, subprocess
+from time import time
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def hash_file(path, blocksize=2**20):
+    """
+    sha256 of a file's contents; None if it does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class BuildNode:
+
+    def __init__(self, name, cmd, inputs=None, outputs=None, cwd=None,
+                 clean=False):
+        """
+        name: unique identifier.
+        cmd: shell command string run to make the outputs.
+        inputs / outputs: lists of file paths.
+        cwd: directory in which to run `cmd`.
+        clean: if True, delete the existing outputs before re-running. Use
+        for drivers that skip work when their outputs already exist (e.g.,
+        ModelFitter's pickle cache, or plotting functions with OVERWRITE
+        flags).
+        """
+        self.name = name
+        self.cmd = cmd
+        self.inputs = [os.path.abspath(os.path.expanduser(p))
+                       for p in (inputs or [])]
+        self.outputs = [os.path.abspath(os.path.expanduser(p))
+                        for p in (outputs or [])]
+        self.cwd = cwd
+        self.clean = clean
+
+    def __repr__(self):
+        return 'BuildNode({})'.format(self.name)
+
+
+class BuildGraph:
+
+    def __init__(self, statepath):
+        self.statepath = statepath
+        self.nodes = OrderedDict()
+        self.state = {}
+        if os.path.exists(statepath):
+            with open(statepath, 'r') as f:
+                self.state = json.load(f)
+
+    def add(self, name, cmd, inputs=None, outputs=None, cwd=None,
+            clean=False):
+        if name in self.nodes:
+            raise ValueError('duplicate build node {}'.format(name))
+        node = BuildNode(name, cmd, inputs=inputs, outputs=outputs, cwd=cwd,
+                         clean=clean)
+        self.nodes[name] = node
+        return node
+
+    def get_dependencies(self):
+        """
+        Returns dict of node name -> set of names of nodes that produce one
+        of its inputs.
+        """
+        producer = {}
+        for node in self.nodes.values():
+            for p in node.outputs:
+                if p in producer:
+                    raise ValueError(
+                        '{} is an output of both {} and {}'.
+                        format(p, producer[p], node.name)
+                    )
+                producer[p] = node.name
+
+        deps = OrderedDict()
+        for node in self.nodes.values():
+            deps[node.name] = set(
+                producer[p] for p in node.inputs if p in producer
+            ) - {node.name}
+
+        self._check_acyclic(deps)
+        return deps
+
+    def _check_acyclic(self, deps):
+        done, visiting = set(), set()
+        def visit(n):
+            if n in done:
+                return
+            if n in visiting:
+                raise ValueError('dependency cycle through {}'.format(n))
+            visiting.add(n)
+            for d in deps[n]:
+                visit(d)
+            visiting.discard(n)
+            done.add(n)
+        for n in deps:
+            visit(n)
+
+    def is_stale(self, node):
+        """
+        Returns (stale, reason).
+        """
+        s = self.state.get(node.name)
+        if s is None:
+            return True, 'never built'
+        if s['cmd'] != node.cmd:
+            return True, 'command changed'
+        for p in node.outputs:
+            h = hash_file(p)
+            if h is None:
+                return True, 'missing output {}'.format(p)
+            if h != s['outputs'].get(p):
+                return True, 'output changed {}'.format(p)
+        for p in node.inputs:
+            if hash_file(p) != s['inputs'].get(p):
+                return True, 'input changed {}'.format(p)
+        return False, 'up to date'
+
+    def run_node(self, node):
+
+        if node.clean:
+            for p in node.outputs:
+                if os.path.exists(p):
+                    os.remove(p)
+        for p in node.outputs:
+            outdir = os.path.dirname(p)
+            if not os.path.exists(outdir):
+                os.makedirs(outdir)
+
+        t_start = time()
+        proc = subprocess.run(node.cmd, shell=True, cwd=node.cwd,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        dt = time() - t_start
+
+        if proc.returncode != 0:
+            return False, dt, proc.stdout.decode(errors='replace')
+
+        missing = [p for p in node.outputs if not os.path.exists(p)]
+        if missing:
+            return False, dt, 'did not make {}'.format(missing)
+
+        return True, dt, ''
+
+    def record(self, node):
+        self.state[node.name] = {
+            'cmd': node.cmd,
+            'inputs': {p: hash_file(p) for p in node.inputs},
+            'outputs': {p: hash_file(p) for p in node.outputs},
+            'built': datetime.utcnow().isoformat()
+        }
+        with open(self.statepath, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+
+    def build(self, targets=None, N_workers=4, dry_run=False):
+        """
+        Bring `targets` (node names; default: all nodes) up to date, running
+        independent nodes in parallel. Returns dict of node name -> status,
+        one of 'up to date', 'built', 'failed', 'skipped', or 'stale' (if
+        dry_run).
+        """
+
+        deps = self.get_dependencies()
+
+        if targets is None:
+            todo = set(self.nodes.keys())
+        else:
+            todo = set()
+            def collect(n):
+                if n not in todo:
+                    todo.add(n)
+                    for d in deps[n]:
+                        collect(d)
+            for t in targets:
+                collect(t)
+
+        status = OrderedDict()
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=N_workers) as executor:
+
+            while todo or running:
+
+                ready = [
+                    n for n in self.nodes if n in todo and
+                    all(d in status for d in deps[n])
+                ]
+
+                for n in ready:
+                    todo.discard(n)
+                    node = self.nodes[n]
+
+                    if any(status[d] in ['failed', 'skipped'] for d in deps[n]):
+                        status[n] = 'skipped'
+                        print('{}: skipped (upstream failure)'.format(n))
+                        continue
+
+                    if any(status[d] == 'stale' for d in deps[n]):
+                        # dry run: upstream would be rebuilt first.
+                        stale, reason = True, 'upstream stale'
+                    else:
+                        stale, reason = self.is_stale(node)
+                    if not stale:
+                        status[n] = 'up to date'
+                        continue
+
+                    print('{}: {}: rebuilding ({})'.format(
+                        datetime.utcnow().isoformat(), n, reason))
+                    if dry_run:
+                        status[n] = 'stale'
+                        continue
+
+                    running[executor.submit(self.run_node, node)] = n
+
+                if not running:
+                    continue
+
+                done, _ = wait(list(running.keys()),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    n = running.pop(future)
+                    ok, dt, msg = future.result()
+                    if ok:
+                        self.record(self.nodes[n])
+                        status[n] = 'built'
+                        print('{}: {}: built in {:.1f} s'.format(
+                            datetime.utcnow().isoformat(), n, dt))
+                    else:
+                        status[n] = 'failed'
+                        print('ERR! {} failed after {:.1f} s:\n{}'.format(
+                            n, dt, msg))
+
+        print(42*'-')
+        for k in ['built', 'up to date', 'stale', 'failed', 'skipped']:
+            names = [n for n,v in status.items() if v == k]
+            if names:
+                print('{}: {}'.format(k, ', '.join(names)))
+        print(42*'-')
+
+        return status
@@ -0,0 +1,238 @@
+"""
+Offline catalog and image-stamp caches, used by plotting.plot_scene.
+
+CatalogStore
+    Keeps the rows of every catalog cone search ever made (e.g., TIC
+    neighbors) in one local table, indexed by a KD-tree on unit vectors.
+    A cone search that lies inside a previously fetched cone is answered from
+    disk; otherwise the fetcher is called (with some padding, so that nearby
+    queries are also covered later) and the result is merged in.
+
+StampCache
+    Keeps DSS (or other SkyView) image stamps, with their WCS headers, as
+    .npz files keyed by position, survey, and size.
+
+In both cases the network layer is a `fetcher` callable, which can be
+replaced by a local stand-in (e.g., OfflineFetcher, which raises on any
+cache miss, or any function returning a table / image). `prefetch` fetches
+many targets in parallel threads, so that batch scene plots never block on
+remote services.
+"""
+import os, json, pickle, threading
+import numpy as np, pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.io import fits
+from astropy.table import Table
+
+DEFAULTCACHEDIR = os.path.join(os.path.expanduser('~'), '.billy',
+                               'catalog-cache')
+
+
+def radec_to_xyz(ra, dec):
+    """
+    ra, dec in degrees -> (N x 3) unit vectors.
+    """
+    ra, dec = np.radians(np.atleast_1d(ra)), np.radians(np.atleast_1d(dec))
+    return np.vstack([
+        np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)
+    ]).T
+
+
+def angular_separation(ra0, dec0, ra1, dec1):
+    """
+    Angular separation in degrees (haversine; arrays broadcast).
+    """
+    ra0, dec0, ra1, dec1 = map(np.radians, (ra0, dec0, ra1, dec1))
+    a = (np.sin((dec1-dec0)/2)**2 +
+         np.cos(dec0)*np.cos(dec1)*np.sin((ra1-ra0)/2)**2)
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+class OfflineFetcher:
+    """
+    Stand-in fetcher for running with no network access: every cache miss
+    raises.
+    """
+    def __call__(self, *args, **kwargs):
+        raise IOError(
+            'cache miss for {} {} with offline fetcher'.format(args, kwargs)
+        )
+
+
+def mast_catalog_fetcher(ra, dec, radius_deg, catalog='TIC'):
+    from astroquery.mast import Catalogs
+    import astropy.units as u
+    t = Catalogs.query_region(
+        "{} {}".format(float(ra), float(dec)),
+        catalog=catalog,
+        radius=radius_deg*u.deg
+    )
+    return t.to_pandas()
+
+
+def skyview_stamp_fetcher(ra, dec, survey='DSS2 Red', sizepix=220):
+    """
+    astrobase skyview_stamp, with the retry on corrupt downloads that
+    plot_scene used to do itself. Returns (image, header).
+    """
+    from astrobase.plotbase import skyview_stamp
+    kwargs = dict(survey=survey, scaling='Linear', convolvewith=None,
+                  sizepix=sizepix, flip=False,
+                  cachedir='~/.astrobase/stamp-cache', verbose=True,
+                  savewcsheader=True)
+    try:
+        return skyview_stamp(ra, dec, **kwargs)
+    except (OSError, IndexError, TypeError) as e:
+        print('downloaded FITS appears to be corrupt, retrying...')
+        return skyview_stamp(ra, dec, forcefetch=True, **kwargs)
+
+
+class CatalogStore:
+
+    def __init__(self, cachedir=DEFAULTCACHEDIR, catalog='TIC', fetcher=None,
+                 idcol='ID', pad_factor=2.0):
+        """
+        fetcher: callable (ra, dec, radius_deg) -> DataFrame with at least
+        "ra", "dec", and `idcol` columns. Defaults to a MAST query of
+        `catalog`.
+
+        pad_factor: cache misses are fetched at this multiple of the
+        requested radius.
+        """
+        self.cachedir = cachedir
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        self.catalog = catalog
+        self.idcol = idcol
+        self.pad_factor = pad_factor
+        if fetcher is None:
+            fetcher = lambda ra, dec, r: mast_catalog_fetcher(
+                ra, dec, r, catalog=catalog
+            )
+        self.fetcher = fetcher
+
+        self.tablepath = os.path.join(cachedir, '{}_rows.pkl'.format(catalog))
+        self.coveragepath = os.path.join(cachedir,
+                                         '{}_coverage.json'.format(catalog))
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.tablepath):
+            self.df = pd.read_pickle(self.tablepath)
+        else:
+            self.df = pd.DataFrame({'ra': [], 'dec': [], self.idcol: []})
+        if os.path.exists(self.coveragepath):
+            with open(self.coveragepath, 'r') as f:
+                self.coverage = [tuple(c) for c in json.load(f)]
+        else:
+            self.coverage = []
+        self._build_index()
+
+    def _build_index(self):
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(radec_to_xyz(np.asarray(self.df['ra']),
+                                         np.asarray(self.df['dec'])))
+
+    def _save(self):
+        self.df.to_pickle(self.tablepath)
+        with open(self.coveragepath, 'w') as f:
+            json.dump(self.coverage, f)
+
+    def is_covered(self, ra, dec, radius_deg):
+        if len(self.coverage) == 0:
+            return False
+        c = np.array(self.coverage)
+        sep = angular_separation(ra, dec, c[:,0], c[:,1])
+        return bool(np.any(sep + radius_deg <= c[:,2]))
+
+    def _merge(self, new_df, cones):
+        with self._lock:
+            df = pd.concat([self.df, new_df], ignore_index=True, sort=False)
+            self.df = df.drop_duplicates(subset=self.idcol).reset_index(
+                drop=True)
+            self.coverage.extend(cones)
+            self._build_index()
+            self._save()
+
+    def fetch(self, ra, dec, radius_deg):
+        r = self.pad_factor*radius_deg
+        new_df = self.fetcher(ra, dec, r)
+        self._merge(new_df, [(float(ra), float(dec), float(r))])
+
+    def query_region(self, ra, dec, radius_deg):
+        """
+        Cone search. Returns an astropy Table of the cached rows within
+        radius_deg of (ra, dec), fetching first if the cone is not covered.
+        """
+        if not self.is_covered(ra, dec, radius_deg):
+            self.fetch(ra, dec, radius_deg)
+
+        chord = 2*np.sin(np.radians(radius_deg)/2)
+        inds = self.tree.query_ball_point(radec_to_xyz(ra, dec)[0], chord)
+        return Table.from_pandas(self.df.iloc[np.sort(inds)])
+
+    def prefetch(self, ras, decs, radius_deg, N_workers=8):
+        """
+        Fetch every uncovered cone in parallel, then merge them in one write.
+        """
+        todo = [(ra, dec) for ra, dec in zip(ras, decs)
+                if not self.is_covered(ra, dec, radius_deg)]
+        r = self.pad_factor*radius_deg
+        with ThreadPoolExecutor(max_workers=N_workers) as executor:
+            dfs = list(executor.map(
+                lambda c: self.fetcher(c[0], c[1], r), todo
+            ))
+        if todo:
+            self._merge(pd.concat(dfs, ignore_index=True, sort=False),
+                        [(float(ra), float(dec), float(r)) for ra, dec in todo])
+        print('prefetched {} of {} cones'.format(len(todo), len(ras)))
+
+
+class StampCache:
+
+    def __init__(self, cachedir=DEFAULTCACHEDIR, fetcher=None):
+        """
+        fetcher: callable (ra, dec, survey=, sizepix=) -> (image, header).
+        Defaults to astrobase's skyview_stamp.
+        """
+        self.cachedir = os.path.join(cachedir, 'stamps')
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+        self.fetcher = skyview_stamp_fetcher if fetcher is None else fetcher
+
+    def _path(self, ra, dec, survey, sizepix):
+        return os.path.join(
+            self.cachedir, '{:.6f}_{:+.6f}_{}_{}.npz'.format(
+                ra, dec, survey.replace(' ','_'), sizepix)
+        )
+
+    def get(self, ra, dec, survey='DSS2 Red', sizepix=220):
+        """
+        Returns (image, header), from disk if cached.
+        """
+        path = self._path(ra, dec, survey, sizepix)
+        if os.path.exists(path):
+            d = np.load(path)
+            hdr = fits.Header.fromstring(str(d['header']))
+            return d['image'], hdr
+
+        img, hdr = self.fetcher(ra, dec, survey=survey, sizepix=sizepix)
+        np.savez(path, image=img, header=hdr.tostring())
+        return img, hdr
+
+    def prefetch(self, ras, decs, survey='DSS2 Red', sizepix=220, N_workers=8):
+        def _get(c):
+            try:
+                self.get(c[0], c[1], survey=survey, sizepix=sizepix)
+                return None
+            except Exception as e:
+                return (c, repr(e))
+        with ThreadPoolExecutor(max_workers=N_workers) as executor:
+            errs = [e for e in executor.map(_get, zip(ras, decs))
+                    if e is not None]
+        for c, e in errs:
+            print('ERR! failed to get stamp ra {} dec {}: {}'.format(
+                c[0], c[1], e))
+        return errs
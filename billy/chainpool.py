@@ -0,0 +1,254 @@
+"""
+Multi-process NUTS chains that share the observed data, for ModelFitter.
+
+pm.sample(cores=N) forks workers that each get a pickled copy of the model,
+including x_obs, y_obs, and y_err, and that inherit the parent's matplotlib
+state (hence ModelFitter's `make_threadsafe`). Instead, `sample_chains`:
+
+    * puts the observed arrays in POSIX shared memory, once,
+    * runs one chain per "spawn"-started worker, which attaches to the
+      shared arrays (no copy) and rebuilds the model from its specification
+      (modelid, prior_d) with billy.modelfitter.ModelBuilder,
+    * streams every post-tuning draw back through a shared (N_chains x
+      N_draws x N_free) buffer of the free variables in the sampled space,
+      plus a buffer of the NUTS sampler statistics,
+    * records the draws into pymc3 NDArray traces in the parent as they
+      arrive, and returns a MultiTrace, as pm.sample would.
+
+Recording a draw evaluates every Deterministic, including the per-timestamp
+ones like "mu_model" (N_obs values per draw). The parent does this for
+every chain, one draw after another, so for large N_obs it can fall behind
+the workers.
+
+The shared memory saves pickling the observed arrays to every worker, but
+not holding them: ModelBuilder._build_model turns x_obs, y_obs, y_err (and
+the time grid) into theano constants, through astype(floatX) copies. So
+each worker's compiled model still holds its own data-sized arrays. Nothing
+is forked, so the parent can make figures while the chains run.
+
+The workers are "spawn"-started, and re-import the caller's main module:
+scripts that fit must be importable without side effects, with the fitting
+behind `if __name__ == "__main__":`.
+"""
+import numpy as np
+import multiprocessing as mp
+from time import time, sleep
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+_SHMKEY = '__billy_shm__'
+
+
+class _SharedArrays:
+    """
+    Shared-memory blocks owned by the parent, unlinked on close.
+    """
+
+    def __init__(self):
+        self._shm = []
+
+    def share(self, arr):
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        view[...] = arr
+        self._shm.append(shm)
+        return view, (_SHMKEY, shm.name, arr.shape, arr.dtype.str)
+
+    def zeros(self, shape, dtype=float):
+        return self.share(np.zeros(shape, dtype=dtype))
+
+    def close(self):
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+
+
+def _attach(obj, handles):
+    _, name, shape, dtype = obj
+    shm = shared_memory.SharedMemory(name=name)
+    handles.append(shm)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _get_bijection(model, point):
+    import pymc3 as pm
+    return pm.blocking.DictToArrayBijection(
+        pm.blocking.ArrayOrdering(model.vars), point
+    )
+
+
+def _get_stats_dtypes():
+    import pymc3 as pm
+    return pm.NUTS.stats_dtypes[0]
+
+
+def _run_chain(spec, chain, seed):
+    """
+    Worker: rebuild the model, then run tuning and sampling of one chain,
+    writing each draw into the shared buffers.
+    """
+    import pymc3 as pm, exoplanet as xo
+    from billy.modelfitter import ModelBuilder
+    from billy.tuning import get_tuned_step
+
+    handles = []
+    a = {}
+    t_start = time()
+    try:
+        for k in ['x_obs', 'y_obs', 'y_err', 'samples', 'stats', 'progress']:
+            a[k] = _attach(spec[k], handles)
+
+        np.random.seed(seed)
+
+        mb = ModelBuilder(spec['modelid'], a['x_obs'], a['y_obs'],
+                          a['y_err'], t_exp=spec['t_exp'])
+        model = mb._build_model(spec['prior_d'])
+
+        with model:
+            start = spec['start'][chain % len(spec['start'])]
+            point = {v.name: np.asarray(start[v.name]) for v in model.vars}
+            bij = _get_bijection(model, point)
+            if spec['tuning'] is not None:
+                step = get_tuned_step(model, spec['tuning'],
+                                      **spec['step_kwargs'])
+            else:
+                step = xo.get_dense_nuts_step(**spec['step_kwargs'])
+            statnames = spec['statnames']
+
+            N_tune, N_draws = spec['tune'], spec['draws']
+            for i in range(N_tune + N_draws):
+                if i == N_tune:
+                    step.stop_tuning()
+                point, s = step.step(point)
+                if i >= N_tune:
+                    j = i - N_tune
+                    a['samples'][chain, j] = bij.map(point)
+                    a['stats'][chain, j] = [
+                        float(s[0].get(k, np.nan)) for k in statnames
+                    ]
+                    a['progress'][chain] = j + 1
+
+    finally:
+        # arrays are views on the shared buffers; drop them before closing.
+        a.clear()
+        for shm in handles:
+            try:
+                shm.close()
+            except BufferError:
+                pass
+
+    return time() - t_start
+
+
+def sample_chains(builder, model, prior_d, start, tune=2000, draws=2000,
+                  N_chains=4, N_cores=4, step_kwargs=None, tuning=None,
+                  random_seed=None, poll_sec=5, verbose=True):
+    """
+    builder: ModelBuilder (or ModelFitter) with modelid, x_obs, y_obs, y_err,
+        t_exp.
+    model: the parent's copy of builder._build_model(prior_d), used to record
+        the draws.
+    start: starting point (e.g., the MAP estimate), or a list of them, used
+        by the chains in turn (e.g., several modes from billy.multistart).
+    step_kwargs: passed to xo.get_dense_nuts_step in each worker.
+    tuning: if given (as from billy.tuning.load_tuning), each worker's step
+        starts from its mass matrix and step size (billy.tuning.
+        get_tuned_step, with step_kwargs) instead.
+
+    Returns a pymc3 MultiTrace of N_chains chains of `draws` draws each.
+    """
+    import pymc3 as pm
+
+    if step_kwargs is None:
+        step_kwargs = {'target_accept': 0.9}
+
+    starts = start if isinstance(start, list) else [start]
+    starts = [{v.name: np.asarray(s[v.name]) for v in model.vars}
+              for s in starts]
+    bij = _get_bijection(model, starts[0])
+    N_free = bij.map(starts[0]).size
+
+    stats_dtypes = _get_stats_dtypes()
+    statnames = list(stats_dtypes.keys())
+
+    seeds = np.random.SeedSequence(random_seed).generate_state(N_chains)
+
+    shared = _SharedArrays()
+    b = {}
+    try:
+        # the views on the shared buffers are kept in `b`, and dropped
+        # before the buffers are closed.
+        keys = {}
+        for k in ['x_obs', 'y_obs', 'y_err']:
+            b[k], keys[k] = shared.share(
+                np.asarray(getattr(builder, k), dtype=float)
+            )
+        b['samples'], keys['samples'] = shared.zeros((N_chains, draws, N_free))
+        b['stats'], keys['stats'] = shared.zeros(
+            (N_chains, draws, len(statnames))
+        )
+        b['progress'], keys['progress'] = shared.zeros(N_chains,
+                                                       dtype=np.int64)
+
+        spec = {
+            'modelid': builder.modelid,
+            'prior_d': prior_d,
+            't_exp': builder.t_exp,
+            'start': starts,
+            'step_kwargs': step_kwargs,
+            'tuning': tuning,
+            'statnames': statnames,
+            'tune': tune,
+            'draws': draws,
+        }
+        spec.update(keys)
+
+        straces = []
+        for c in range(N_chains):
+            strace = pm.backends.NDArray(model=model)
+            strace.setup(draws, c, sampler_vars=[stats_dtypes])
+            straces.append(strace)
+        recorded = np.zeros(N_chains, dtype=int)
+
+        def _record_new():
+            for c in range(N_chains):
+                for j in range(recorded[c], int(b['progress'][c])):
+                    st = {
+                        k: np.asarray(b['stats'][c, j, ix]).astype(
+                            stats_dtypes[k])
+                        for ix, k in enumerate(statnames)
+                    }
+                    straces[c].record(bij.rmap(b['samples'][c, j].copy()),
+                                      sampler_stats=[st])
+                    recorded[c] = j + 1
+
+        ctx = mp.get_context('spawn')
+        N_workers = min(N_cores, N_chains)
+        t_start = time()
+        with ProcessPoolExecutor(max_workers=N_workers, mp_context=ctx) as ex:
+            futures = [ex.submit(_run_chain, spec, c, int(seeds[c]))
+                       for c in range(N_chains)]
+            while not all(f.done() for f in futures):
+                sleep(poll_sec)
+                _record_new()
+                if verbose:
+                    print('{:.0f} s: {} of {} draws per chain'.format(
+                        time() - t_start, list(recorded), draws))
+            chain_sec = [f.result() for f in futures]
+        _record_new()
+
+        for strace in straces:
+            strace.close()
+
+    finally:
+        b.clear()
+        shared.close()
+
+    if verbose:
+        print('sampled {} chains in {:.0f} s ({})'.format(
+            N_chains, time() - t_start,
+            ', '.join('{:.0f} s'.format(t) for t in chain_sec)))
+
+    return pm.backends.base.MultiTrace(straces)
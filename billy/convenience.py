@@ -24,7 +24,12 @@ def bic(chisq, k, n):
     return chisq + k*np.log(n)
 
 
-def get_bic(m, ydict, outdir):
+def get_bic(m, ydict, outdir, resultsdb=None):
+    """
+    BIC of the MAP model in `ydict`. Written to {outdir}/{modelid}_bicdict.pkl,
+    and, if a billy.resultsdb.ResultsDB is given (or m.resultsdb is set), to
+    its bic table under m.run_id and m.target.
+    """
 
     y_obs = ydict['y_obs']
     y_err = m.y_err
@@ -70,6 +75,14 @@ def get_bic(m, ydict, outdir):
         pickle.dump(bicdict, buff)
     print('Wrote {}'.format(pklpath))
 
+    if resultsdb is None:
+        resultsdb = getattr(m, 'resultsdb', None)
+    if resultsdb is not None:
+        resultsdb.record_bic(getattr(m, 'run_id', None),
+                             getattr(m, 'target', None), bicdict)
+
+    return bicdict
+
 
 def flatten(l):
     for el in l:
@@ -0,0 +1,248 @@
+"""
+Batch ephemeris fitting, for O-C analyses.
+
+    assign_epochs: vectorized epoch numbers, with ambiguity flags
+    pad_timing_sets: stack ragged timing sets into padded (K x N) arrays
+    fit_ephemeris: weighted linear or quadratic ephemerides, in closed form
+    compare_ephemerides: linear vs quadratic, by ΔBIC and Laplace evidence
+
+Every function operates on stacked arrays of shape (K x N), for K timing
+sets of up to N times each (padded entries have infinite or NaN
+uncertainties, i.e., zero weight), so that thousands of sets are solved in
+one batched call. A single set can be passed as 1-D arrays.
+
+The models follow billy.models.linear_model and quadratic_model:
+
+    transits:     t = t0 + P E + (1/2)(dP/dE) E^2
+    occultations: t = t0 + P/2 + P E + (1/2)(dP/dE) E^2
+"""
+import numpy as np
+
+
+def assign_epochs(times, period, t0, sigmas=None, ambiguity_tol=0.25):
+    """
+    times: (K x N) or (N) array of mid-times.
+    period, t0: scalars, or (K) arrays (one per timing set).
+    sigmas: optional uncertainties, same layout as times. Entries with a
+        non-finite time, or a non-finite or non-positive uncertainty, are
+        padding (as from pad_timing_sets).
+
+    Returns (epochs, ambiguous): integer epoch numbers nearest to each time,
+    and a boolean mask that is True where the time is more than
+    `ambiguity_tol` cycles from its nearest integer epoch (so that a small
+    period error could flip the assignment), or where two times in the same
+    set round to the same epoch. Padding gets epoch 0, is never ambiguous,
+    and is left out of the duplicate check.
+    """
+    times = np.asarray(times, dtype=float)
+    period = np.asarray(period, dtype=float)
+    t0 = np.asarray(t0, dtype=float)
+    if times.ndim == 2:
+        period = period.reshape(-1, 1) if period.ndim else period
+        t0 = t0.reshape(-1, 1) if t0.ndim else t0
+
+    padded = ~np.isfinite(times)
+    if sigmas is not None:
+        sigmas = np.asarray(sigmas, dtype=float)
+        padded |= ~(np.isfinite(sigmas) & (sigmas > 0))
+
+    x = np.where(padded, np.nan, (times - t0) / period)
+    epochs = np.round(x)
+    ambiguous = np.abs(x - epochs) > ambiguity_tol
+
+    # duplicate epochs within a set.
+    _e = np.atleast_2d(np.where(np.isfinite(epochs), epochs, np.nan))
+    order = np.argsort(_e, axis=1)
+    sorted_e = np.take_along_axis(_e, order, axis=1)
+    dup_sorted = np.zeros_like(sorted_e, dtype=bool)
+    same = (np.diff(sorted_e, axis=1) == 0)
+    dup_sorted[:, 1:] |= same
+    dup_sorted[:, :-1] |= same
+    dup = np.zeros_like(dup_sorted)
+    np.put_along_axis(dup, order, dup_sorted, axis=1)
+    ambiguous |= dup.reshape(ambiguous.shape)
+
+    epochs = np.where(np.isfinite(epochs), epochs, 0).astype(int)
+    return epochs, ambiguous
+
+
+def pad_timing_sets(sets):
+    """
+    sets: list of (times, sigmas) tuples, of varying lengths.
+
+    Returns (times, sigmas), each (K x N_max); padding has time NaN and
+    infinite uncertainty (zero weight).
+    """
+    N_max = max(len(s[0]) for s in sets)
+    times = np.full((len(sets), N_max), np.nan)
+    sigmas = np.full((len(sets), N_max), np.inf)
+    for ix, (t, s) in enumerate(sets):
+        times[ix, :len(t)] = t
+        sigmas[ix, :len(t)] = s
+    return times, sigmas
+
+
+def _design(epochs, order, offset):
+    """
+    Columns [1, E + offset, E^2] (truncated to order+1), with E already
+    scaled.
+    """
+    cols = [np.ones_like(epochs), epochs + offset]
+    if order == 2:
+        cols.append(epochs**2)
+    return np.stack(cols, axis=-1)
+
+
+def fit_ephemeris(epochs, times, sigmas, order=1, epochs_occ=None,
+                  times_occ=None, sigmas_occ=None):
+    """
+    Weighted least-squares ephemeris, solved by the normal equations for
+    every timing set at once.
+
+    epochs, times, sigmas: (K x N) or (N) arrays of transit epochs, times,
+    and uncertainties. Entries with non-finite time or uncertainty are
+    ignored.
+    order: 1 for (t0, P); 2 for (t0, P, (1/2) dP/dE).
+    epochs_occ, times_occ, sigmas_occ: optional occultations, same layout.
+
+    Returns a dict of (K)-leading arrays:
+
+        params (K x p), cov (K x p x p), param_errs (K x p),
+        chisq, n_data, n_params, dof, lnlike, bic,
+        residuals (K x N) and residuals_occ (if occultations given).
+
+    Sets with fewer usable entries than parameters (e.g., entirely padding)
+    get NaN for every fitted quantity.
+
+    For 1-D input the leading K axis is dropped.
+    """
+    single = np.ndim(times) == 1
+
+    def _prep(e, t, s):
+        e = np.atleast_2d(np.asarray(e, dtype=float))
+        t = np.atleast_2d(np.asarray(t, dtype=float))
+        s = np.atleast_2d(np.asarray(s, dtype=float))
+        good = np.isfinite(t) & np.isfinite(s) & (s > 0)
+        w = np.where(good, 1/np.where(good, s, 1)**2, 0)
+        return np.where(good, e, 0), np.where(good, t, 0), w
+
+    e, t, w = _prep(epochs, times, sigmas)
+    has_occ = times_occ is not None
+    if has_occ:
+        e_o, t_o, w_o = _prep(epochs_occ, times_occ, sigmas_occ)
+
+    # condition the problem: scale epochs to order unity, and subtract a
+    # per-set reference time.
+    e_all = np.hstack([e, e_o]) if has_occ else e
+    w_all = np.hstack([w, w_o]) if has_occ else w
+    scale = np.max(np.where(w_all > 0, np.abs(e_all), 0), axis=1)
+    scale = np.where(scale > 0, scale, 1)[:, None]
+    t_all = np.hstack([t, t_o]) if has_occ else t
+    w_sum = np.sum(w_all, axis=1)
+    t_ref = (np.sum(w_all*t_all, axis=1) /
+             np.where(w_sum > 0, w_sum, 1))[:, None]
+
+    X = _design(e/scale, order, 0)
+    y = t - t_ref
+    if has_occ:
+        X = np.concatenate([X, _design(e_o/scale, order, 0.5/scale)], axis=1)
+        y = np.concatenate([y, t_o - t_ref], axis=1)
+
+    W = w_all
+    p = order + 1
+    A = np.einsum('kni,kn,knj->kij', X, W, X)
+    b = np.einsum('kni,kn,kn->ki', X, W, y)
+    # underdetermined sets would make the batched inverse fail for every
+    # set; solve them against the identity, and blank them below.
+    under = np.sum(W > 0, axis=1) < p
+    A[under] = np.eye(p)
+    cov_s = np.linalg.inv(A)
+    beta_s = np.einsum('kij,kj->ki', cov_s, b)
+
+    # undo the scaling.
+    D = np.stack([scale[:, 0]**(-ix) for ix in range(p)], axis=1)
+    params = beta_s * D
+    params[:, 0] += t_ref[:, 0]
+    cov = cov_s * D[:, :, None] * D[:, None, :]
+
+    model = np.einsum('kni,ki->kn', X, beta_s) + t_ref
+    t_obs = np.concatenate([t, t_o], axis=1) if has_occ else t
+    resid_all = t_obs - model
+    resid_all = np.where(W > 0, resid_all, 0)
+
+    chisq = np.sum(W * resid_all**2, axis=1)
+    n_data = np.sum(W > 0, axis=1)
+    lnlike = -0.5*chisq - 0.5*np.sum(
+        np.where(W > 0, np.log(2*np.pi/np.where(W > 0, W, 1)), 0), axis=1
+    )
+
+    out = {
+        'params': params,
+        'cov': cov,
+        'param_errs': np.sqrt(np.diagonal(cov, axis1=1, axis2=2)),
+        'chisq': chisq,
+        'n_data': n_data,
+        'n_params': p,
+        'dof': n_data - p,
+        'lnlike': lnlike,
+        'bic': chisq + p*np.log(np.maximum(n_data, 1)),
+        'residuals': resid_all[:, :t.shape[1]],
+    }
+    if has_occ:
+        out['residuals_occ'] = resid_all[:, t.shape[1]:]
+    for k in ['params', 'cov', 'param_errs', 'chisq', 'dof', 'lnlike', 'bic',
+              'residuals', 'residuals_occ']:
+        if k in out:
+            out[k] = np.where(
+                under.reshape((-1,) + (1,)*(out[k].ndim-1)), np.nan,
+                out[k]
+            )
+
+    if single:
+        out = {k: (v[0] if isinstance(v, np.ndarray) else v)
+               for k,v in out.items()}
+    return out
+
+
+def _laplace_lnZ(fit, prior_widths):
+    """
+    Laplace approximation to the evidence under uniform priors of the given
+    widths, wide enough to contain the likelihood:
+
+    ln Z = ln L_max + (p/2) ln 2π + (1/2) ln|Σ| - Σ ln(width).
+    """
+    p = fit['n_params']
+    _, logdet = np.linalg.slogdet(fit['cov'])
+    return (
+        fit['lnlike'] + 0.5*p*np.log(2*np.pi) + 0.5*logdet
+        - np.sum(np.log(prior_widths[:p]))
+    )
+
+
+def compare_ephemerides(epochs, times, sigmas, epochs_occ=None,
+                        times_occ=None, sigmas_occ=None,
+                        prior_widths=(1., 1e-2, 1e-6)):
+    """
+    Fit linear and quadratic ephemerides to each timing set, and compare
+    them.
+
+    prior_widths: widths of the uniform priors on (t0 [d], P [d],
+    (1/2)dP/dE [d]) used for the Laplace evidence.
+
+    Returns dict with "linear" and "quadratic" fit dicts, "delta_bic"
+    (BIC_quadratic - BIC_linear; negative favors a period change), and
+    "delta_lnZ" (lnZ_quadratic - lnZ_linear; positive favors it).
+    """
+    kw = dict(epochs_occ=epochs_occ, times_occ=times_occ,
+              sigmas_occ=sigmas_occ)
+    lin = fit_ephemeris(epochs, times, sigmas, order=1, **kw)
+    quad = fit_ephemeris(epochs, times, sigmas, order=2, **kw)
+
+    prior_widths = np.asarray(prior_widths, dtype=float)
+    return {
+        'linear': lin,
+        'quadratic': quad,
+        'delta_bic': quad['bic'] - lin['bic'],
+        'delta_lnZ': (_laplace_lnZ(quad, prior_widths) -
+                      _laplace_lnZ(lin, prior_widths))
+    }
@@ -1,9 +1,11 @@
 import numpy as np, matplotlib.pyplot as plt, pandas as pd
-import pickle, os, corner
+import pickle, os, json, corner
 from collections import OrderedDict
 
 from billy import __path__
-from billy.models import sin_model, cos_model, transit_model
+from billy.models import (
+    sin_model, cos_model, transit_model, transit_model_batch, harmonic_model
+)
 from billy.plotting import plot_test_data
 import billy.modelfitter as bm
 
@@ -11,8 +13,9 @@ RESULTSDIR = os.path.join(os.path.dirname(__path__[0]), 'results')
 
 class FakeDataGenerator(bm.ModelParser):
 
-    def __init__(self, modelid, plotdir):
+    def __init__(self, modelid, plotdir, seed=42):
 
+        self.seed = seed
         self.initialize_model(modelid)
         self.make_true_params()
         self.make_fake_data()
@@ -21,13 +24,16 @@ class FakeDataGenerator(bm.ModelParser):
                        outdir=plotdir)
 
 
-    def make_true_params(self):
+    def make_true_params(self, rng=np.random):
         """
         Make a dictionary with all the "true" parameters of your fake data.
 
         true_d = OrderedDict({'A_0': 1, 'omega_0': 2, 'phi_0': 0.3141, 'A_1':
             0.2, 'omega_1': 1.8, 'phi_1': 0.5, 'period':4.3, 't0':0.2,
             'r':0.04, 'b':0.5, 'u':[0.3,0.2], 'mean':0})
+
+        The amplitudes are drawn from `rng` (np.random by default, or a
+        np.random.Generator). Also returns true_d.
         """
 
         P_orb = 3*0.45
@@ -63,22 +69,22 @@ class FakeDataGenerator(bm.ModelParser):
 
                     if k == 'orb':
                         true_d['A{}{}'.format(k,ix)] = (
-                            np.random.uniform(low=1e-5, high=2e-5)
+                            rng.uniform(low=1e-5, high=2e-5)
                         )
                         if ix == 1:
                             true_d['B{}{}'.format(k,ix)] = (
-                                np.random.uniform(low=-0.01, high=-0.009)
+                                rng.uniform(low=-0.01, high=-0.009)
                             )
                         else:
                             true_d['B{}{}'.format(k,ix)] = (
-                                np.random.uniform(low=1e-5, high=2e-5)
+                                rng.uniform(low=1e-5, high=2e-5)
                             )
                     elif k == 'rot':
                         true_d['A{}{}'.format(k,ix)] = (
-                            np.random.uniform(low=0.05, high=0.06)
+                            rng.uniform(low=0.05, high=0.06)
                         )
                         true_d['B{}{}'.format(k,ix)] = (
-                            np.random.uniform(low=1e-5, high=2e-5)
+                            rng.uniform(low=1e-5, high=2e-5)
                         )
 
                     if 'Porb' in modelcomponent:
@@ -94,11 +100,12 @@ class FakeDataGenerator(bm.ModelParser):
                     true_d['omega{}'.format(k)] = omega
 
         self.true_d = true_d
+        return true_d
 
 
     def make_fake_data(self):
 
-        np.random.seed(42)
+        np.random.seed(self.seed)
         t_exp = 30/(60*24)
         y_err = 2e-3
         mstar, rstar = 1, 1
@@ -153,3 +160,248 @@ class FakeDataGenerator(bm.ModelParser):
         self.y_obs = y_obs
         self.y_mod = y_mod
         self.y_err = y_err
+
+
+class BatchFakeDataGenerator(bm.ModelParser):
+    """
+    K independent synthetic realizations of a modelid, as contiguous arrays:
+
+        x_obs       (n_times) shared time grid
+        y_mod       (K x n_times) noiseless models
+        y_obs       (K x n_times) models plus noise
+        mask        (K x n_times) True where the cadence is observed (not in
+                    a gap)
+        y_err       (K) white-noise level of each realization
+        true_params DataFrame of the K true-parameter sets ("u" is split
+                    into "u_0" and "u_1")
+
+    Realization k draws its parameters, gaps, and noise from its own stream,
+    np.random.default_rng(SeedSequence(seed).spawn(K)[k]), so it does not
+    depend on how many other realizations are made, or in what order.
+
+    cadence, baseline, t_start: time grid, in days.
+    gaps: list of (t_lo, t_hi) windows removed from every realization (e.g.,
+        the TESS orbit gap), plus N_random_gaps windows of gap_duration days
+        placed at random in each.
+    noise: 'white' (gaussian, σ = y_err), or 'red' (white plus an AR(1)
+        process of amplitude red_amp and timescale red_timescale days).
+    y_err: scalar, or (lo, hi) to draw each realization's level uniformly.
+    param_ranges: dict of parameter name -> (lo, hi), overriding the
+        FakeDataGenerator values with uniform draws (e.g.,
+        {'r': (0.05, 0.2), 'Arot0': (0.01, 0.1)}).
+
+    If outdir is given, the arrays are written directly into memory-mapped
+    .npy files there (see `load`), `chunksize` realizations at a time, so
+    that neither the generator nor the fitting workers that read slices of
+    them hold all K in memory.
+    """
+
+    def __init__(self, modelid, N_realizations, seed=42, cadence=30/(60*24),
+                 baseline=28, t_start=0, gaps=None, N_random_gaps=0,
+                 gap_duration=1, noise='white', y_err=2e-3, red_amp=1e-3,
+                 red_timescale=0.5, param_ranges=None, mstar=1, rstar=1,
+                 outdir=None, chunksize=256):
+
+        self.initialize_model(modelid)
+        self.K = N_realizations
+        self.seed = seed
+        self.cadence = cadence
+        self.gaps = [] if gaps is None else gaps
+        self.N_random_gaps = N_random_gaps
+        self.gap_duration = gap_duration
+        self.noise = noise
+        self.y_err_range = y_err
+        self.red_amp = red_amp
+        self.red_timescale = red_timescale
+        self.param_ranges = {} if param_ranges is None else param_ranges
+        self.mstar, self.rstar = mstar, rstar
+        self.outdir = outdir
+
+        if noise not in ['white', 'red']:
+            raise ValueError('noise must be "white" or "red"')
+
+        self.x_obs = np.arange(t_start, t_start+baseline, cadence)
+
+        children = np.random.SeedSequence(seed).spawn(self.K)
+        self._rngs = [np.random.default_rng(c) for c in children]
+
+        self.make_true_params()
+        self.make_fake_data(chunksize=chunksize)
+
+    def make_true_params(self):
+        """
+        One FakeDataGenerator-style true_d per realization, stacked into a
+        DataFrame.
+        """
+        fdg = FakeDataGenerator.__new__(FakeDataGenerator)
+        fdg.initialize_model(self.modelid)
+
+        rows = []
+        for rng in self._rngs:
+            d = fdg.make_true_params(rng=rng)
+            for k, (lo, hi) in self.param_ranges.items():
+                d[k] = rng.uniform(low=lo, high=hi)
+            row = OrderedDict()
+            for k, v in d.items():
+                if k == 'u':
+                    row['u_0'], row['u_1'] = v
+                else:
+                    row[k] = v
+            rows.append(row)
+
+        self.true_params = pd.DataFrame(rows)
+
+    def _harmonic_params(self, tp, k, N_harmonics):
+        A = np.vstack([tp['A{}{}'.format(k, ix)] for ix in range(N_harmonics)]).T
+        B = np.vstack([tp['B{}{}'.format(k, ix)] for ix in range(N_harmonics)]).T
+        return A, B, np.asarray(tp['omega{}'.format(k)]), np.asarray(tp['phi{}'.format(k)])
+
+    def _get_model(self, tp):
+        y_mod = np.zeros((len(tp), len(self.x_obs)))
+        for modelcomponent in self.modelcomponents:
+            if 'transit' in modelcomponent:
+                y_mod += transit_model_batch(
+                    tp['period'], tp['t0'], tp['r'], tp['b'],
+                    np.vstack([tp['u_0'], tp['u_1']]).T, tp['mean'],
+                    self.x_obs, texp=self.cadence, mstar=self.mstar,
+                    rstar=self.rstar
+                )
+            if 'sincos' in modelcomponent:
+                N_harmonics = int(modelcomponent[0])
+                if N_harmonics == 0:
+                    continue
+                k = 'orb' if 'Porb' in modelcomponent else 'rot'
+                y_mod += harmonic_model(
+                    self._harmonic_params(tp, k, N_harmonics), self.x_obs
+                )
+        return y_mod
+
+    def _get_noise_and_mask(self, rng):
+        n = len(self.x_obs)
+        if np.ndim(self.y_err_range) == 0:
+            y_err = float(self.y_err_range)
+        else:
+            y_err = rng.uniform(*self.y_err_range)
+        noise = rng.normal(scale=y_err, size=n)
+
+        if self.noise == 'red':
+            # AR(1), red[i] = phi*red[i-1] + innov[i], as a single IIR
+            # filter pass. innov is scaled so that the process has
+            # stationary standard deviation red_amp, and red[0] is drawn
+            # from that stationary distribution.
+            from scipy.signal import lfilter
+            phi = np.exp(-self.cadence/self.red_timescale)
+            innov = rng.normal(scale=self.red_amp*np.sqrt(1-phi**2), size=n)
+            innov[0] = rng.normal(scale=self.red_amp)
+            noise += lfilter([1], [1, -phi], innov)
+
+        mask = np.ones(n, dtype=bool)
+        for t_lo, t_hi in self.gaps:
+            mask &= ~((self.x_obs >= t_lo) & (self.x_obs < t_hi))
+        for _ in range(self.N_random_gaps):
+            t_lo = rng.uniform(self.x_obs[0], self.x_obs[-1]-self.gap_duration)
+            mask &= ~((self.x_obs >= t_lo) &
+                      (self.x_obs < t_lo+self.gap_duration))
+
+        return noise, mask, y_err
+
+    def _allocate(self, name, shape, dtype):
+        if self.outdir is None:
+            return np.empty(shape, dtype=dtype)
+        return np.lib.format.open_memmap(
+            os.path.join(self.outdir, '{}.npy'.format(name)), mode='w+',
+            dtype=dtype, shape=shape
+        )
+
+    def make_fake_data(self, chunksize=256):
+
+        if self.outdir is not None and not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+
+        n = len(self.x_obs)
+        self.y_mod = self._allocate('y_mod', (self.K, n), np.float64)
+        self.y_obs = self._allocate('y_obs', (self.K, n), np.float64)
+        self.mask = self._allocate('mask', (self.K, n), np.bool_)
+        self.y_err = np.empty(self.K)
+
+        for i0 in range(0, self.K, chunksize):
+            sl = slice(i0, min(i0+chunksize, self.K))
+            tp = self.true_params.iloc[sl]
+            y_mod = self._get_model(tp)
+            self.y_mod[sl] = y_mod
+            for ix, k in enumerate(range(sl.start, sl.stop)):
+                noise, mask, y_err = self._get_noise_and_mask(self._rngs[k])
+                self.y_obs[k] = y_mod[ix] + noise
+                self.mask[k] = mask
+                self.y_err[k] = y_err
+
+        if self.outdir is not None:
+            for a in [self.y_mod, self.y_obs, self.mask]:
+                a.flush()
+            np.save(os.path.join(self.outdir, 'x_obs.npy'), self.x_obs)
+            np.save(os.path.join(self.outdir, 'y_err.npy'), self.y_err)
+            self.true_params.to_csv(
+                os.path.join(self.outdir, 'true_params.csv'), index=False
+            )
+            with open(os.path.join(self.outdir, 'meta.json'), 'w') as f:
+                json.dump({
+                    'modelid': self.modelid, 'N_realizations': self.K,
+                    'seed': self.seed, 'cadence': self.cadence,
+                    'gaps': self.gaps, 'N_random_gaps': self.N_random_gaps,
+                    'gap_duration': self.gap_duration, 'noise': self.noise,
+                    'red_amp': self.red_amp,
+                    'red_timescale': self.red_timescale,
+                }, f, indent=2)
+            print('wrote {} realizations to {}'.format(self.K, self.outdir))
+
+    def get_realization(self, k):
+        """
+        (x_obs, y_obs, y_err, true_d) of realization k, with gaps removed,
+        in the form FakeDataGenerator and ModelFitter use.
+        """
+        return _get_realization(self.x_obs, self.y_obs, self.mask,
+                                self.y_err, self.true_params, k)
+
+    @staticmethod
+    def load(outdir, mmap_mode='r'):
+        """
+        Memory-map the arrays written to outdir. Returns a dict with x_obs,
+        y_mod, y_obs, mask, y_err, true_params, and meta; slicing y_obs[k]
+        reads only realization k.
+        """
+        d = {
+            k: np.load(os.path.join(outdir, '{}.npy'.format(k)),
+                       mmap_mode=mmap_mode)
+            for k in ['y_mod', 'y_obs', 'mask']
+        }
+        d['x_obs'] = np.load(os.path.join(outdir, 'x_obs.npy'))
+        d['y_err'] = np.load(os.path.join(outdir, 'y_err.npy'))
+        d['true_params'] = pd.read_csv(os.path.join(outdir, 'true_params.csv'))
+        with open(os.path.join(outdir, 'meta.json'), 'r') as f:
+            d['meta'] = json.load(f)
+        return d
+
+
+def _get_realization(x_obs, y_obs, mask, y_err, true_params, k):
+    m = np.asarray(mask[k])
+    row = true_params.iloc[k]
+    true_d = OrderedDict()
+    for c in true_params.columns:
+        if c == 'u_0':
+            true_d['u'] = [float(row['u_0']), float(row['u_1'])]
+        elif c == 'u_1':
+            continue
+        else:
+            true_d[c] = float(row[c])
+    return (np.asarray(x_obs)[m], np.asarray(y_obs[k])[m],
+            float(y_err[k]), true_d)
+
+
+def load_realization(outdir, k):
+    """
+    (x_obs, y_obs, y_err, true_d) of realization k of a batch written to
+    outdir, reading only that row of the memory-mapped arrays.
+    """
+    d = BatchFakeDataGenerator.load(outdir)
+    return _get_realization(d['x_obs'], d['y_obs'], d['mask'], d['y_err'],
+                            d['true_params'], k)
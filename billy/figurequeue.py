@@ -0,0 +1,311 @@
+"""
+Process-pool figure rendering for the fit drivers.
+
+Usage:
+
+    fq = FigureQueue(N_workers=4)
+    fq.submit('plot_sampleplot', m, outpath, N_samples=10)
+    fq.submit('plot_phasefold_map', m, ydict, outpath)
+    ...
+    status = fq.wait()
+
+Each job is a call to a function in billy.plotting, run in its own
+"spawn"-started worker process. Because the workers never share a matplotlib
+state with the parent (or with the sampler's forked children), the MAP plot
+that ModelFitter suppresses via `make_threadsafe` can be rendered here.
+
+ModelFitter instances passed as arguments are replaced by a ModelSnapshot,
+which carries only the observed data, the MAP estimate, and the trace values
+as plain arrays. All numpy arrays (including those inside dicts like
+`ydict`) are sent to the workers through POSIX shared memory rather than
+being pickled, and each model's arrays are shared once, no matter how many
+figures use them. The shared blocks are unlinked once every job that uses
+them has finished.
+
+Jobs run in parallel with each other, and with whatever the parent does next
+(e.g., the next fit). Failures are caught per figure, and reported by
+`wait`.
+"""
+import os, threading
+import numpy as np
+import multiprocessing as mp
+from time import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+_SHMKEY = '__billy_shm__'
+_SNAPKEY = '__billy_snapshot__'
+
+
+class _ArrayDict(dict):
+    """
+    dict of arrays that also allows attribute access, so that both
+    `trace['mu_model']` and `trace.mu_model` work as they do on a MultiTrace.
+    """
+    def __getattr__(self, k):
+        try:
+            return self[k]
+        except KeyError:
+            raise AttributeError(k)
+
+    @property
+    def varnames(self):
+        return list(self.keys())
+
+
+class ModelSnapshot:
+    """
+    Lightweight, picklable stand-in for a ModelFitter, carrying what the
+    billy.plotting functions read: modelid, modelcomponents, x_obs, y_obs,
+    y_err, OVERWRITE, map_estimate, and the trace (as combined-chain arrays).
+    """
+
+    def __init__(self, modelid, modelcomponents, x_obs, y_obs, y_err,
+                 map_estimate, trace, overwrite=1):
+        self.modelid = modelid
+        self.modelcomponents = modelcomponents
+        self.x_obs = x_obs
+        self.y_obs = y_obs
+        self.y_err = y_err
+        self.map_estimate = _ArrayDict(map_estimate)
+        self.trace = _ArrayDict(trace)
+        self.OVERWRITE = overwrite
+
+    @classmethod
+    def from_modelfitter(cls, m, varnames=None):
+        if varnames is None:
+            varnames = m.trace.varnames
+        trace = OrderedDict(
+            (k, np.asarray(m.trace[k])) for k in varnames
+        )
+        map_estimate = OrderedDict(
+            (k, np.asarray(v)) for k,v in m.map_estimate.items()
+        )
+        return cls(m.modelid, m.modelcomponents, m.x_obs, m.y_obs,
+                   np.asarray(m.y_err), map_estimate, trace,
+                   overwrite=m.OVERWRITE)
+
+    def _to_spec(self, share):
+        return {
+            'modelid': self.modelid,
+            'modelcomponents': self.modelcomponents,
+            'x_obs': share(self.x_obs),
+            'y_obs': share(self.y_obs),
+            'y_err': share(self.y_err),
+            'map_estimate': {k: share(v) for k,v in self.map_estimate.items()},
+            'trace': {k: share(v) for k,v in self.trace.items()},
+            'overwrite': self.OVERWRITE
+        }
+
+
+def _is_modelfitter(obj):
+    return (
+        hasattr(obj, 'trace') and hasattr(obj, 'map_estimate') and
+        hasattr(obj, 'modelcomponents') and not isinstance(obj, ModelSnapshot)
+    )
+
+
+class FigureQueue:
+
+    def __init__(self, N_workers=4):
+
+        self.N_workers = N_workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=N_workers, mp_context=mp.get_context('spawn')
+        )
+        self.jobs = OrderedDict()
+
+        # shared memory blocks: name -> [SharedMemory, refcount]
+        self._shm = {}
+        # id(model) -> (model, encoded spec, list of shm names). the entry
+        # holds the model itself, so that its id cannot be reused by another
+        # object while the entry exists.
+        self._snapshots = {}
+        self._lock = threading.RLock()
+
+    def submit(self, funcname, *args, label=None, **kwargs):
+        """
+        Queue `billy.plotting.<funcname>(*args, **kwargs)` for rendering in a
+        worker process. Returns the job label, which is the basename of the
+        first ".png" argument unless given explicitly.
+        """
+
+        if label is None:
+            pngs = [a for a in list(args)+list(kwargs.values())
+                    if isinstance(a, str) and a.endswith('.png')]
+            label = os.path.basename(pngs[0]) if pngs else funcname
+        if label in self.jobs:
+            label = '{}_{}'.format(label, len(self.jobs))
+
+        # encode and take references under one lock, so that a finishing
+        # job cannot unlink a cached snapshot's memory in between.
+        names = []
+        with self._lock:
+            _args = [self._encode(a, names) for a in args]
+            _kwargs = {k: self._encode(v, names) for k,v in kwargs.items()}
+            for n in names:
+                self._shm[n][1] += 1
+
+        future = self.executor.submit(_render, funcname, _args, _kwargs)
+        future.add_done_callback(lambda _f, _n=names: self._release(_n))
+        self.jobs[label] = future
+        return label
+
+    def wait(self, verbose=True):
+        """
+        Block until every queued figure has rendered. Returns an OrderedDict
+        of label -> (ok, message), where message is the render time or the
+        worker's traceback.
+        """
+
+        status = OrderedDict()
+        for label, future in self.jobs.items():
+            try:
+                dt = future.result()
+                status[label] = (True, '{:.1f} s'.format(dt))
+            except Exception as e:
+                # the worker's traceback is attached as the cause.
+                msg = repr(e)
+                if e.__cause__ is not None:
+                    msg += '\n' + str(e.__cause__)
+                status[label] = (False, msg)
+
+        if verbose:
+            print(42*'-')
+            for label, (ok, msg) in status.items():
+                if ok:
+                    print('{}: made in {}'.format(label, msg))
+                else:
+                    print('ERR! {} failed:\n{}'.format(label, msg))
+            print(42*'-')
+
+        self.jobs = OrderedDict()
+        self._snapshots = {}
+        return status
+
+    def close(self):
+        self.wait(verbose=False)
+        self.executor.shutdown(wait=True)
+        with self._lock:
+            for name in list(self._shm.keys()):
+                self._unlink(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #
+    # shared memory bookkeeping
+    #
+    def _share(self, arr, names):
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        with self._lock:
+            self._shm[shm.name] = [shm, 0]
+        names.append(shm.name)
+        return (_SHMKEY, shm.name, arr.shape, arr.dtype.str)
+
+    def _encode(self, obj, names):
+
+        if _is_modelfitter(obj) or isinstance(obj, ModelSnapshot):
+            key = id(obj)
+            if key in self._snapshots and (
+                self._snapshots[key][0] is not obj or not all(
+                    n in self._shm for n in self._snapshots[key][2])
+            ):
+                # every job using this snapshot has finished and released it.
+                self._snapshots.pop(key)
+            if key not in self._snapshots:
+                snap = (
+                    obj if isinstance(obj, ModelSnapshot)
+                    else ModelSnapshot.from_modelfitter(obj)
+                )
+                _names = []
+                spec = snap._to_spec(lambda a: self._share(a, _names))
+                self._snapshots[key] = (obj, (_SNAPKEY, spec), _names)
+            _, encoded, _names = self._snapshots[key]
+            names.extend(_names)
+            return encoded
+
+        if isinstance(obj, np.ndarray) and obj.dtype != object:
+            return self._share(obj, names)
+
+        if isinstance(obj, dict):
+            return type(obj)(
+                (k, self._encode(v, names)) for k,v in obj.items()
+            )
+
+        return obj
+
+    def _release(self, names):
+        with self._lock:
+            for n in names:
+                if n not in self._shm:
+                    continue
+                self._shm[n][1] -= 1
+                if self._shm[n][1] <= 0:
+                    self._unlink(n)
+            # drop the snapshots (and their models) whose memory is gone.
+            for key in [k for k, v in self._snapshots.items()
+                        if not all(n in self._shm for n in v[2])]:
+                self._snapshots.pop(key)
+
+    def _unlink(self, name):
+        shm, _ = self._shm.pop(name)
+        shm.close()
+        shm.unlink()
+
+
+#
+# worker side
+#
+def _decode(obj, handles):
+
+    if isinstance(obj, tuple) and len(obj) == 4 and obj[0] == _SHMKEY:
+        _, name, shape, dtype = obj
+        shm = shared_memory.SharedMemory(name=name)
+        handles.append(shm)
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+    if isinstance(obj, tuple) and len(obj) == 2 and obj[0] == _SNAPKEY:
+        d = obj[1]
+        return ModelSnapshot(
+            d['modelid'], d['modelcomponents'],
+            _decode(d['x_obs'], handles), _decode(d['y_obs'], handles),
+            _decode(d['y_err'], handles),
+            _decode(d['map_estimate'], handles), _decode(d['trace'], handles),
+            overwrite=d['overwrite']
+        )
+
+    if isinstance(obj, dict):
+        return type(obj)((k, _decode(v, handles)) for k,v in obj.items())
+
+    return obj
+
+
+def _render(funcname, args, kwargs):
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import billy.plotting as bp
+
+    handles = []
+    t_start = time()
+    try:
+        args = [_decode(a, handles) for a in args]
+        kwargs = {k: _decode(v, handles) for k,v in kwargs.items()}
+        getattr(bp, funcname)(*args, **kwargs)
+    finally:
+        # arrays are views on the shared buffers; drop them before closing.
+        del args, kwargs
+        for shm in handles:
+            try:
+                shm.close()
+            except BufferError:
+                pass
+
+    return time() - t_start
@@ -0,0 +1,142 @@
+"""
+Background figure writer for billy.plotting.savefig.
+
+Encoding a figure (particularly the rasterized PDFs, at up to 450 dpi) can
+take longer than making it. A FigureWriter pickles each figure and hands it
+to a single "spawn"-started writer process through a bounded queue, so that
+the caller can go on to the next plot while the file is written. If the
+queue is full, `submit` blocks, which bounds the memory held by pending
+figures.
+
+Usage (through billy.plotting):
+
+    bp.start_figwriter(maxsize=8)
+    ... make plots; savefig returns as soon as the figure is queued ...
+    bp.flush_figwriter()    # barrier: wait until every file is written
+
+`flush` returns, and prints, the encoding time of each written file, and any
+errors.
+"""
+import pickle, traceback
+import multiprocessing as mp
+import queue as _queue
+from time import time
+from datetime import datetime
+
+_FLUSH = '__billy_flush__'
+
+
+class FigureWriter:
+
+    def __init__(self, maxsize=8):
+        ctx = mp.get_context('spawn')
+        self.queue = ctx.Queue(maxsize=maxsize)
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_writer_loop,
+                                   args=(self.queue, self.results),
+                                   daemon=True)
+        self.process.start()
+        self.N_flushes = 0
+
+    def submit(self, fig, figpath, writepdf=True, dpi=450):
+        """
+        Queue `fig` to be written to `figpath` (and its .pdf, if writepdf).
+        Raises pickle.PicklingError (or TypeError / AttributeError) if the
+        figure cannot be pickled, in which case the caller should write it
+        itself.
+        """
+        payload = pickle.dumps(fig)
+        self._put((figpath, writepdf, dpi, payload))
+
+    def _check_alive(self):
+        if not self.process.is_alive():
+            raise RuntimeError('figure writer process died')
+
+    def _put(self, item, poll=1.):
+        # a full queue only drains while the writer is alive, so never block
+        # on it indefinitely.
+        while True:
+            self._check_alive()
+            try:
+                self.queue.put(item, timeout=poll)
+                return
+            except _queue.Full:
+                continue
+
+    def flush(self, verbose=True):
+        """
+        Block until every queued figure is written. Returns a list of
+        (path, seconds, error) tuples, with error None on success.
+        """
+        self.N_flushes += 1
+        token = (_FLUSH, self.N_flushes)
+        self._put(token)
+
+        written = []
+        while True:
+            try:
+                r = self.results.get(timeout=1.)
+            except _queue.Empty:
+                self._check_alive()
+                continue
+            if r == token:
+                break
+            written.append(r)
+
+        if verbose:
+            for path, dt, err in written:
+                if err is None:
+                    print('{}: encoded in {:.2f} s'.format(path, dt))
+                else:
+                    print('ERR! failed to write {}:\n{}'.format(path, err))
+
+        return written
+
+    def close(self):
+        if self.process.is_alive():
+            self.flush(verbose=False)
+            self._put(None)
+            self.process.join()
+
+
+def _writer_loop(queue, results):
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    while True:
+
+        item = queue.get()
+        if item is None:
+            break
+        if isinstance(item, tuple) and len(item) == 2 and item[0] == _FLUSH:
+            results.put(item)
+            continue
+
+        figpath, writepdf, dpi, payload = item
+        try:
+            fig = pickle.loads(payload)
+        except Exception:
+            results.put((figpath, 0., traceback.format_exc()))
+            continue
+
+        paths = [figpath]
+        if writepdf:
+            paths.append(figpath.replace('.png','.pdf'))
+
+        for path in paths:
+            t_start = time()
+            try:
+                if path.endswith('.pdf'):
+                    fig.savefig(path, bbox_inches='tight', rasterized=True,
+                                dpi=dpi)
+                else:
+                    fig.savefig(path, dpi=dpi, bbox_inches='tight')
+                print('{}: made {}'.format(datetime.utcnow().isoformat(),
+                                           path))
+                results.put((path, time()-t_start, None))
+            except Exception:
+                results.put((path, time()-t_start, traceback.format_exc()))
+
+        plt.close(fig)
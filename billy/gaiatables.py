@@ -0,0 +1,156 @@
+"""
+Columnar storage for the Gaia neighborhood tables used by plot_hr and
+plot_astrometric_excess.
+
+The neighborhood pickle (`nbhd_info_*.pkl`) holds a 14-element tuple of
+DataFrames and scalars. `convert_nbhd_pickle` splits it once into Feather
+files (one per table: group, target, nbhd), plus a JSON file of the scalar
+entries, with the derived quantities precomputed as columns:
+
+    M_G        G + 5 log10(parallax/1e3) + 5  (parallax in mas)
+    bp_rp      Bp - Rp
+    chisq_red  astrometric_chi2_al / (astrometric_n_obs_al - 5)
+    var_amp    from var_amps.csv, merged on source_id (group table only)
+    ruwe       from the RUWE CSV, merged on source_id (group table only)
+
+`load_nbhd_table` then memory-maps only the requested columns.
+"""
+import os, json, pickle
+import numpy as np, pandas as pd
+
+DROPBOXDIR = '/Users/luke/Dropbox/proj/billy'
+NBHDPKL = os.path.join(DROPBOXDIR, 'results', 'cluster_membership',
+                       'nbhd_info_3222255959210123904.pkl')
+VARAMPCSV = os.path.join(DROPBOXDIR, 'data', '25ori-1', 'var_amps.csv')
+RUWECSV = os.path.join(DROPBOXDIR, 'results', 'cluster_membership',
+                       '25ori-1_group_ruwe.csv')
+
+NBHDKEYS = [
+    'targetname', 'groupname', 'group_df_dr2', 'target_df', 'nbhd_df',
+    'cutoff_probability', 'pmdec_min', 'pmdec_max', 'pmra_min', 'pmra_max',
+    'group_in_k13', 'group_in_cg18', 'group_in_kc19', 'group_in_k18'
+]
+TABLEKEYS = {'group': 'group_df_dr2', 'target': 'target_df', 'nbhd': 'nbhd_df'}
+
+
+def get_tabledir(pklpath):
+    return pklpath.replace('.pkl', '_columnar')
+
+
+def add_derived_columns(df):
+    """
+    Compute M_G, bp_rp, and chisq_red, for whichever of their inputs are
+    present.
+    """
+    if 'phot_g_mean_mag' in df and 'parallax' in df:
+        df['M_G'] = (
+            df['phot_g_mean_mag'] + 5*np.log10(df['parallax']/1e3) + 5
+        )
+    if 'phot_bp_mean_mag' in df and 'phot_rp_mean_mag' in df:
+        df['bp_rp'] = df['phot_bp_mean_mag'] - df['phot_rp_mean_mag']
+    if 'astrometric_chi2_al' in df and 'astrometric_n_obs_al' in df:
+        df['chisq_red'] = (
+            df['astrometric_chi2_al'] / (df['astrometric_n_obs_al'] - 5)
+        )
+    return df
+
+
+def _to_scalar(v):
+    if isinstance(v, (np.generic,)):
+        return v.item()
+    return v
+
+
+def convert_nbhd_pickle(pklpath=NBHDPKL, varamppath=VARAMPCSV,
+                        ruwepath=RUWECSV, tabledir=None):
+    """
+    Split the neighborhood pickle into Feather tables with derived columns,
+    and a JSON file of its scalar entries. Returns the output directory.
+    """
+    if tabledir is None:
+        tabledir = get_tabledir(pklpath)
+    if not os.path.exists(tabledir):
+        os.makedirs(tabledir)
+
+    info = pickle.load(open(pklpath, 'rb'))
+    d = dict(zip(NBHDKEYS, info))
+
+    for name, key in TABLEKEYS.items():
+        df = d[key]
+        if isinstance(df, pd.Series):
+            # the single-row frame of a Series is all-object; restore the
+            # numeric dtypes before deriving columns from them.
+            df = df.to_frame().T.infer_objects()
+        df = pd.DataFrame(df).reset_index(drop=True)
+        df = add_derived_columns(df)
+
+        if name == 'group':
+            df['source_id'] = df['source_id'].astype(np.int64)
+            if varamppath is not None and os.path.exists(varamppath):
+                va_df = pd.read_csv(varamppath)[['source_id', 'var_amp']]
+                va_df['source_id'] = va_df['source_id'].astype(np.int64)
+                df = df.merge(va_df, on='source_id', how='left')
+            if ruwepath is not None and os.path.exists(ruwepath):
+                r_df = pd.read_csv(ruwepath)[['source_id', 'ruwe']]
+                r_df['source_id'] = r_df['source_id'].astype(np.int64)
+                if 'ruwe' in df:
+                    df = df.drop('ruwe', axis=1)
+                df = df.merge(r_df, on='source_id', how='left')
+
+        # feather needs string column names and no object columns of
+        # mixed type.
+        df.columns = [str(c) for c in df.columns]
+        for c in df.columns:
+            if df[c].dtype == object:
+                df[c] = df[c].astype(str)
+
+        df.to_feather(os.path.join(tabledir, '{}.feather'.format(name)))
+
+    scalars = {
+        k: _to_scalar(d[k]) for k in NBHDKEYS if k not in TABLEKEYS.values()
+    }
+    with open(os.path.join(tabledir, 'scalars.json'), 'w') as f:
+        json.dump(scalars, f, indent=2, default=str)
+
+    print('wrote {}'.format(tabledir))
+    return tabledir
+
+
+def _is_current(tabledir, sources):
+    paths = [os.path.join(tabledir, '{}.feather'.format(n)) for n in TABLEKEYS]
+    paths.append(os.path.join(tabledir, 'scalars.json'))
+    if not all(os.path.exists(p) for p in paths):
+        return False
+    t_made = min(os.path.getmtime(p) for p in paths)
+    return all(
+        os.path.getmtime(s) <= t_made for s in sources
+        if s is not None and os.path.exists(s)
+    )
+
+
+def load_nbhd_table(name, columns=None, pklpath=NBHDPKL,
+                    varamppath=VARAMPCSV, ruwepath=RUWECSV):
+    """
+    name: 'group', 'target', or 'nbhd'.
+    columns: list of column names to read (default: all).
+
+    Memory-maps the Feather table, reading only `columns`. (Re)builds the
+    columnar tables from the pickle and CSVs if they are missing or older
+    than their sources.
+    """
+    import pyarrow.feather as feather
+
+    tabledir = get_tabledir(pklpath)
+    if not _is_current(tabledir, [pklpath, varamppath, ruwepath]):
+        convert_nbhd_pickle(pklpath=pklpath, varamppath=varamppath,
+                            ruwepath=ruwepath, tabledir=tabledir)
+
+    path = os.path.join(tabledir, '{}.feather'.format(name))
+    t = feather.read_table(path, columns=columns, memory_map=True)
+    return t.to_pandas()
+
+
+def load_nbhd_scalars(pklpath=NBHDPKL):
+    tabledir = get_tabledir(pklpath)
+    with open(os.path.join(tabledir, 'scalars.json'), 'r') as f:
+        return json.load(f)
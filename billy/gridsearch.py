@@ -0,0 +1,187 @@
+"""
+Successive-halving search over a grid of "transit_NsincosPorb_MsincosProt"
+models.
+
+Every candidate modelid gets a small sampling budget (the MAP, plus short
+chains), and is scored by its PSIS-LOO elpd (billy.modelcomparison). Only
+the top `keep_fraction` survive to the next rung, which has a larger budget;
+the survivors of the last rung get the full sampling budget. Each rung's
+fits are cached as their own pickles, so an interrupted search resumes where
+it stopped.
+
+Usage:
+
+    modelids = get_modelid_grid(N_max=3, M_max=3)
+    result = successive_halving(
+        modelids, x_obs, y_obs, y_err,
+        get_prior_d=lambda modelid: initialize_ptfo_prior_d(
+            x_obs, modelid.split('_')),
+        pklprefix='/home/luke/local/billy/PTFO_8-8695_grid',
+        logpath='gridsearch_log.csv'
+    )
+
+The log records every fit (rung, budget, wall time, elpd and its standard
+error, and whether it was kept or pruned), and the compute saved relative to
+fitting every model at the full budget, estimated from each pruned model's
+measured cost per draw.
+"""
+import os, json
+import numpy as np, pandas as pd
+from time import time
+from itertools import product
+
+from billy.modelfitter import ModelFitter
+from billy.modelcomparison import get_loo_waic
+
+# (N_samples, N_chains) of each rung; the last is the full budget.
+DEFAULTBUDGETS = [(200, 2), (500, 2), (2000, 4)]
+
+
+def get_modelid_grid(N_max=3, M_max=3, N_min=1, M_min=1):
+    """
+    Every "transit_NsincosPorb_MsincosProt" with N_min <= N <= N_max and
+    M_min <= M <= M_max. (ModelParser accepts up to 4 of each, but
+    initialize_ptfo_prior_d only has priors for up to 3 harmonics.)
+    """
+    return [
+        'transit_{}sincosPorb_{}sincosProt'.format(N, M)
+        for N, M in product(range(N_min, N_max+1), range(M_min, M_max+1))
+    ]
+
+
+def _score(m, obs_chunksize=500):
+    d = get_loo_waic(m.trace, m.y_obs, m.y_err, obs_chunksize=obs_chunksize)
+    return d['elpd_loo'], d['se_elpd_loo'], d['max_pareto_k']
+
+
+def successive_halving(modelids, x_obs, y_obs, y_err, get_prior_d,
+                       pklprefix, budgets=DEFAULTBUDGETS, keep_fraction=1/3,
+                       min_keep=1, N_cores=16, logpath=None, verbose=True,
+                       **fitter_kwargs):
+    """
+    modelids: candidate model ids.
+    get_prior_d: callable modelid -> prior_d, for ModelFitter.
+    pklprefix: each fit is cached at {pklprefix}_{modelid}_rung{r}.pkl.
+    budgets: list of (N_samples, N_chains), one per rung.
+    keep_fraction: fraction of each rung's models (at least min_keep)
+        promoted to the next rung.
+
+    Any other keyword arguments are passed to ModelFitter.
+
+    Returns a dict with "best" (the top modelid of the last rung), "log" (a
+    DataFrame with one row per fit), "fitters" (modelid -> ModelFitter of
+    the last rung), and the compute accounting "sec_spent",
+    "sec_full_estimate", and "sec_saved".
+    """
+    survivors = list(modelids)
+    rows = []
+    sec_per_draw = {}
+    fitters = {}
+
+    for rung, (N_samples, N_chains) in enumerate(budgets):
+
+        fitters = {}
+        for modelid in survivors:
+            pklpath = '{}_{}_rung{}.pkl'.format(pklprefix, modelid, rung)
+            timepath = pklpath.replace('.pkl', '_time.json')
+            is_cached = os.path.exists(pklpath)
+            t_start = time()
+            m = ModelFitter(modelid, x_obs, y_obs, y_err,
+                            get_prior_d(modelid), N_samples=N_samples,
+                            N_cores=N_cores, N_chains=N_chains,
+                            pklpath=pklpath, **fitter_kwargs)
+            fit_sec = time() - t_start
+
+            # on resume, use the wall time of the original fit. a pickle
+            # cached without one has no known cost (its fit_sec here is only
+            # the unpickling), so it is left out of the compute accounting.
+            if is_cached and os.path.exists(timepath):
+                with open(timepath, 'r') as f:
+                    fit_sec = json.load(f)['fit_sec']
+            elif is_cached:
+                fit_sec = np.nan
+            else:
+                with open(timepath, 'w') as f:
+                    json.dump({'fit_sec': fit_sec}, f)
+            elpd, se, max_k = _score(m)
+
+            # tuning + draws, per chain.
+            if np.isfinite(fit_sec):
+                sec_per_draw[modelid] = fit_sec / (2*N_samples*N_chains)
+            fitters[modelid] = m
+            rows.append({
+                'rung': rung, 'modelid': modelid, 'N_samples': N_samples,
+                'N_chains': N_chains, 'fit_sec': fit_sec, 'elpd_loo': elpd,
+                'se_elpd_loo': se, 'max_pareto_k': max_k, 'decision': None
+            })
+
+        rung_rows = [r for r in rows if r['rung'] == rung]
+        rung_rows = sorted(rung_rows, key=lambda r: -r['elpd_loo'])
+
+        if rung == len(budgets) - 1:
+            for r in rung_rows:
+                r['decision'] = 'final'
+            break
+
+        N_keep = max(min_keep, int(np.ceil(keep_fraction*len(rung_rows))))
+        survivors = [r['modelid'] for r in rung_rows[:N_keep]]
+        best = rung_rows[0]
+        for r in rung_rows:
+            r['decision'] = 'kept' if r['modelid'] in survivors else 'pruned'
+            if verbose:
+                print('rung {}: {} elpd_loo = {:.1f} ± {:.1f} '
+                      '(best - this = {:.1f}) -> {}'.format(
+                          rung, r['modelid'], r['elpd_loo'], r['se_elpd_loo'],
+                          best['elpd_loo'] - r['elpd_loo'], r['decision']))
+
+    log = pd.DataFrame(rows)
+
+    # compute accounting: what was run, versus fitting every model once at
+    # the full budget, over the models whose fit times are known.
+    N_full, C_full = budgets[-1]
+    timed = log.modelid.isin(sec_per_draw.keys()) & np.isfinite(log.fit_sec)
+    sec_spent = np.sum(log.fit_sec[timed])
+    sec_full_estimate = np.sum([
+        sec_per_draw[modelid] * 2*N_full*C_full for modelid in modelids
+        if modelid in sec_per_draw
+    ])
+    N_untimed = len(modelids) - len(sec_per_draw)
+    if N_untimed and verbose:
+        print('{} cached models have no recorded fit time, and are left out '
+              'of the compute accounting'.format(N_untimed))
+    sec_saved = sec_full_estimate - sec_spent
+
+    if verbose:
+        print(42*'=')
+        print('fit {} models; {} survived to the full budget. '
+              'spent {:.0f} s, vs ~{:.0f} s to fully fit every model '
+              '(saved ~{:.0f} s).'.format(
+                  len(modelids), len(fitters), sec_spent, sec_full_estimate,
+                  sec_saved))
+        print(42*'=')
+
+    if logpath is not None:
+        log.to_csv(logpath, index=False)
+        with open(logpath.replace('.csv', '_summary.json'), 'w') as f:
+            json.dump({
+                'modelids': list(modelids),
+                'budgets': [list(b) for b in budgets],
+                'keep_fraction': keep_fraction,
+                'final': list(fitters.keys()),
+                'sec_spent': float(sec_spent),
+                'sec_full_estimate': float(sec_full_estimate),
+                'sec_saved': float(sec_saved),
+            }, f, indent=2)
+        print('wrote {}'.format(logpath))
+
+    final_rows = log[log.rung == log.rung.max()].sort_values(
+        by='elpd_loo', ascending=False)
+
+    return {
+        'best': final_rows.modelid.iloc[0],
+        'log': log,
+        'fitters': fitters,
+        'sec_spent': sec_spent,
+        'sec_full_estimate': sec_full_estimate,
+        'sec_saved': sec_saved,
+    }
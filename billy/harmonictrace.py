@@ -0,0 +1,123 @@
+"""
+Backwards-compatible names for vector-valued harmonic variables.
+
+With modelfitter.VECTOR_HARMONICS, each harmonic block is one shape-N random
+variable (e.g., "Aorb", with Aorb[ix] the amplitude of harmonic ix), and its
+model components are one (N x N_obs) Deterministic (e.g., "mu_orbsin"). The
+plotting functions and table drivers read the per-harmonic names of the
+scalar parameterization ("Aorb0", "mu_orbsin0", ...), so:
+
+    HarmonicTrace: wraps a MultiTrace (or dict of arrays), answering
+        trace['Aorb0'], trace.Aorb0, and trace.get_values('Aorb0', chains=c)
+        from the vector variables. Its `varnames` list the per-harmonic
+        names in place of the vector ones; everything else is passed through
+        to the wrapped trace.
+    expand_point: the same for a single point (e.g., the MAP estimate),
+        returning a plain dict with both the vector and per-harmonic keys.
+"""
+import re
+import numpy as np
+
+_PARAMPATTERN = re.compile(r'^(logA|logB|A|B)(orb|rot)$')
+_MUPATTERN = re.compile(r'^mu_(orb|rot)(sin|cos)$')
+
+
+def is_harmonic_vector(name):
+    return bool(_PARAMPATTERN.match(name) or _MUPATTERN.match(name))
+
+
+def get_aliases(names_and_lengths):
+    """
+    names_and_lengths: iterable of (varname, number of harmonics).
+
+    Returns dict of per-harmonic name -> (vector name, harmonic index).
+    """
+    aliases = {}
+    for name, N in names_and_lengths:
+        for ix in range(N):
+            aliases['{}{}'.format(name, ix)] = (name, ix)
+    return aliases
+
+
+def expand_point(point):
+    """
+    Add per-harmonic entries ("Aorb0", "mu_orbsin0", ...) to a point dict
+    that has vector harmonic entries. The vector entries are kept.
+    """
+    out = dict(point)
+    for name, val in point.items():
+        if is_harmonic_vector(name):
+            val = np.asarray(val)
+            for ix in range(val.shape[0]):
+                out['{}{}'.format(name, ix)] = val[ix]
+    return out
+
+
+class HarmonicTrace:
+
+    def __init__(self, trace):
+        self._trace = trace
+        self._aliases = get_aliases(
+            (k, self._get_length(k)) for k in trace.varnames
+            if is_harmonic_vector(k)
+        )
+
+    def _get_length(self, name):
+        # first axis after draws, read from a single point.
+        if hasattr(self._trace, 'point'):
+            return np.shape(self._trace.point(0)[name])[0]
+        return np.shape(self._trace[name])[1]
+
+    @property
+    def raw(self):
+        return self._trace
+
+    @property
+    def varnames(self):
+        names = []
+        for k in self._trace.varnames:
+            if is_harmonic_vector(k):
+                names.extend(
+                    a for a, (v, _) in sorted(self._aliases.items(),
+                                              key=lambda kv: kv[1][1])
+                    if v == k
+                )
+            else:
+                names.append(k)
+        return names
+
+    def __getitem__(self, k):
+        if not isinstance(k, str):
+            # e.g., trace[100:], which gives a MultiTrace of fewer draws.
+            return HarmonicTrace(self._trace[k])
+        if k in self._aliases:
+            name, ix = self._aliases[k]
+            return np.asarray(self._trace[name])[:, ix]
+        return self._trace[k]
+
+    def get_values(self, k, **kwargs):
+        if k in self._aliases:
+            name, ix = self._aliases[k]
+            vals = self._trace.get_values(name, **kwargs)
+            if isinstance(vals, list):
+                return [np.asarray(v)[:, ix] for v in vals]
+            return np.asarray(vals)[:, ix]
+        return self._trace.get_values(k, **kwargs)
+
+    def point(self, idx, **kwargs):
+        return expand_point(self._trace.point(idx, **kwargs))
+
+    def __len__(self):
+        return len(self._trace)
+
+    def __contains__(self, k):
+        return k in self._aliases or k in self._trace.varnames
+
+    def __getattr__(self, k):
+        # only called for attributes not found normally. guard against
+        # recursion while unpickling, before _trace is set.
+        if k.startswith('__') or k in ('_trace', '_aliases'):
+            raise AttributeError(k)
+        if k in self._aliases:
+            return self[k]
+        return getattr(self._trace, k)
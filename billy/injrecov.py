@@ -0,0 +1,541 @@
+"""
+Injection-recovery campaigns, to map the detectability of PTFO-like
+transit plus rotation signals in real light-curve noise.
+
+A campaign lives in one directory (which may be on a filesystem shared by
+several hosts):
+
+    config.json     modelid used for recovery, and the recovery settings
+    noise.npz       x_obs, the noise the signals are injected into, y_err
+    jobs.csv        every injection (job_id and the injected parameters)
+    queue/todo/     one {job_id}.json per injection not yet claimed
+    queue/claimed/  claimed jobs, renamed to {job_id}.json.{host}.{pid}
+    queue/done/     finished jobs
+    queue/failed/   jobs that raised, with the traceback
+    results/        one {job_id}.json of recovered parameters per job
+
+Workers claim a job by renaming it out of todo/, which is atomic on a
+single filesystem, so any number of workers on any number of hosts can
+drain the same queue: `run_campaign` starts a "spawn" process pool on this
+host; run it (or `python drivers/injection_recovery.py work`) on each host
+that should help. An interrupted campaign resumes where it stopped: jobs
+with a result are never rerun, and `requeue_stale` returns claimed jobs
+whose worker died to todo/.
+
+Each injection is recovered by the MAP estimate of the ModelBuilder model,
+with uncertainties from the Laplace approximation (the inverse Hessian of
+-logp at the MAP, in the sampled space). If the Hessian is not positive
+definite, and `fallback_mcmc` is set, a short single-process NUTS run is
+used instead. The recovery priors are centered on the injected ephemeris
+and periods (as for a signal whose periods are known from a periodogram),
+so the campaign measures whether the signal is detected and its amplitudes
+recovered. A signal component counts as detected when removing it from the
+MAP model worsens χ² by at least `dchisq_min`.
+
+`get_completeness` aggregates the results into recovery fractions over any
+two injected parameters, and billy.plotting.plot_completeness_map draws
+them.
+"""
+import os, json, socket, traceback
+import numpy as np, pandas as pd
+import multiprocessing as mp
+from glob import glob
+from time import time, sleep
+from itertools import product
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from billy.models import transit_model, harmonic_model
+from billy.convenience import MSTAR_VANEYKEN, RSTAR_VANEYKEN
+
+# injected parameters; period, r, b, amp_orb, P_rot, and amp_rot can be
+# gridded, and t0 and phirot are drawn per job.
+DEFAULTINJECTION = OrderedDict([
+    ('period', 0.4485), ('r', 0.11), ('b', 0.5), ('u', [0.30, 0.35]),
+    ('mean', 0), ('amp_orb', 1e-2), ('P_rot', 0.49845), ('amp_rot', 3e-2),
+])
+
+DEFAULTCONFIG = {
+    'modelid': 'transit_1sincosPorb_1sincosProt',
+    'dchisq_min': 25,
+    'n_sigma': 3,
+    'P_rot_rtol': 1e-2,
+    'N_laplace': 500,
+    'fallback_mcmc': 1,
+    'N_mcmc': 500,
+    'amp_floor': 1e-3,
+}
+
+# campaign directory -> (config, x_obs, noise, y_err), loaded once per
+# worker process.
+_CAMPAIGN = {}
+
+
+def _write_json(d, path):
+    # write-then-rename, so that readers never see a partial file.
+    tmppath = '{}.tmp.{}'.format(path, os.getpid())
+    with open(tmppath, 'w') as f:
+        json.dump(d, f, indent=1)
+    os.replace(tmppath, path)
+
+
+def _queuedir(campaigndir, state):
+    return os.path.join(campaigndir, 'queue', state)
+
+
+def make_jobs(grid, N_phases=4, seed=42, fixed=None):
+    """
+    grid: dict of injected-parameter name -> values (any of period, r, b,
+        amp_orb, P_rot, amp_rot), e.g., {'r': [0.02, 0.05, 0.1], 'amp_rot':
+        [1e-3, 1e-2]}. Every combination is injected N_phases times, each
+        with a transit epoch (t0) and rotation phase (phirot) drawn
+        uniformly.
+    fixed: dict overriding DEFAULTINJECTION for the parameters not gridded.
+
+    Returns a DataFrame with one row per job.
+    """
+    base = OrderedDict(DEFAULTINJECTION)
+    if fixed is not None:
+        base.update(fixed)
+
+    rng = np.random.default_rng(seed)
+    names = list(grid.keys())
+    rows = []
+    for vals in product(*[grid[k] for k in names]):
+        for _ in range(N_phases):
+            row = OrderedDict(base)
+            row.update(zip(names, vals))
+            row['t0'] = rng.uniform(0, row['period'])
+            row['phirot'] = rng.uniform(0, 2*np.pi)
+            row['job_id'] = 'job{:06d}'.format(len(rows))
+            rows.append(row)
+
+    df = pd.DataFrame(rows)
+    return df[['job_id'] + [c for c in df.columns if c != 'job_id']]
+
+
+def setup_campaign(campaigndir, x_obs, noise, y_err, jobs, config=None):
+    """
+    Write the campaign files, and queue every job that has neither a result
+    nor a queue entry. Calling it again on an existing campaign with more
+    jobs adds only the new ones.
+
+    noise: the light curve the signals are injected into (e.g., the
+        residuals of the best-fit model of the real data).
+    """
+    for state in ['todo', 'claimed', 'done', 'failed']:
+        os.makedirs(_queuedir(campaigndir, state), exist_ok=True)
+    os.makedirs(os.path.join(campaigndir, 'results'), exist_ok=True)
+
+    _config = dict(DEFAULTCONFIG)
+    if config is not None:
+        _config.update(config)
+    _write_json(_config, os.path.join(campaigndir, 'config.json'))
+
+    np.savez(os.path.join(campaigndir, 'noise.npz'), x_obs=x_obs,
+             noise=noise, y_err=y_err)
+    jobs.to_csv(os.path.join(campaigndir, 'jobs.csv'), index=False)
+
+    queued = set(
+        os.path.basename(p).split('.json')[0]
+        for state in ['todo', 'claimed', 'done', 'failed']
+        for p in glob(os.path.join(_queuedir(campaigndir, state), '*.json*'))
+    )
+    N_new = 0
+    for _, row in jobs.iterrows():
+        if row['job_id'] in queued:
+            continue
+        job = {k: (list(v) if isinstance(v, (list, np.ndarray)) else
+                   v.item() if isinstance(v, np.generic) else v)
+               for k, v in row.items()}
+        _write_json(
+            job, os.path.join(_queuedir(campaigndir, 'todo'),
+                              '{}.json'.format(row['job_id']))
+        )
+        N_new += 1
+
+    print('{}: queued {} new jobs ({} total)'.format(
+        campaigndir, N_new, len(jobs)))
+
+
+def claim_job(campaigndir):
+    """
+    Claim the next job in todo/, or return (None, None) if there is none.
+    """
+    tag = '{}.{}'.format(socket.gethostname(), os.getpid())
+    for path in sorted(glob(os.path.join(_queuedir(campaigndir, 'todo'),
+                                         '*.json'))):
+        claimedpath = os.path.join(
+            _queuedir(campaigndir, 'claimed'),
+            '{}.{}'.format(os.path.basename(path), tag)
+        )
+        try:
+            os.rename(path, claimedpath)
+        except FileNotFoundError:
+            # claimed by another worker first.
+            continue
+        # rename keeps the mtime of queueing; requeue_stale needs the claim's.
+        os.utime(claimedpath)
+        with open(claimedpath, 'r') as f:
+            return json.load(f), claimedpath
+    return None, None
+
+
+def requeue_stale(campaigndir, stale_sec=6*3600):
+    """
+    Return claimed jobs whose claim is older than stale_sec (i.e., whose
+    worker died) to todo/.
+    """
+    N_requeued = 0
+    for path in glob(os.path.join(_queuedir(campaigndir, 'claimed'),
+                                  '*.json.*')):
+        if time() - os.path.getmtime(path) < stale_sec:
+            continue
+        name = os.path.basename(path).split('.json')[0] + '.json'
+        try:
+            os.rename(path, os.path.join(_queuedir(campaigndir, 'todo'), name))
+            N_requeued += 1
+        except FileNotFoundError:
+            pass
+    if N_requeued:
+        print('requeued {} stale jobs'.format(N_requeued))
+    return N_requeued
+
+
+def _load_campaign(campaigndir):
+    if campaigndir not in _CAMPAIGN:
+        with open(os.path.join(campaigndir, 'config.json'), 'r') as f:
+            config = json.load(f)
+        d = np.load(os.path.join(campaigndir, 'noise.npz'))
+        _CAMPAIGN[campaigndir] = (config, d['x_obs'], d['noise'], d['y_err'])
+    return _CAMPAIGN[campaigndir]
+
+
+def get_injected_signal(job, x_obs, t_exp):
+    """
+    Transit, plus one sinusoid at the orbital period (phased to the transit
+    epoch, as in ModelFitter), plus one at the rotation period.
+    """
+    y_transit = transit_model(
+        [job['period'], job['t0'], job['r'], job['b'], job['u'], job['mean']],
+        x_obs, texp=t_exp, mstar=MSTAR_VANEYKEN, rstar=RSTAR_VANEYKEN
+    )
+    y_orb = harmonic_model(
+        ([job['amp_orb']], [0], 2*np.pi/job['period'],
+         2*np.pi*job['t0']/job['period']), x_obs
+    )
+    y_rot = harmonic_model(
+        ([job['amp_rot']], [0], 2*np.pi/job['P_rot'], job['phirot']), x_obs
+    )
+    return np.asarray(y_transit).flatten() + y_orb + y_rot
+
+
+def get_recovery_prior_d(job, modelcomponents, amp_floor=1e-3):
+    """
+    prior_d in the form of billy.convenience.initialize_ptfo_prior_d,
+    centered on the injected ephemeris and periods. The amplitude priors
+    scale with the injected amplitudes (at least amp_floor, since their
+    bounds are ±2x the prior value).
+    """
+    prior_d = OrderedDict()
+    for modelcomponent in modelcomponents:
+
+        if 'transit' in modelcomponent:
+            prior_d['period'] = job['period']
+            prior_d['t0'] = job['t0']
+            prior_d['r'] = job['r']
+            prior_d['b'] = job['b']
+            prior_d['u'] = list(job['u'])
+            prior_d['mean'] = job['mean']
+            prior_d['m_star'] = MSTAR_VANEYKEN
+            prior_d['r_star'] = RSTAR_VANEYKEN
+
+        if 'sincos' in modelcomponent:
+            k = 'orb' if 'Porb' in modelcomponent else 'rot'
+            amp = max(np.abs(job['amp_{}'.format(k)]), amp_floor)
+            for ix in range(int(modelcomponent[0])):
+                prior_d['A{}{}'.format(k, ix)] = amp
+                prior_d['B{}{}'.format(k, ix)] = amp
+            if k == 'orb':
+                prior_d['phiorb'] = 2*np.pi*job['t0']/job['period']
+                prior_d['omegaorb'] = 2*np.pi/job['period']
+            else:
+                prior_d['phirot'] = job['phirot']
+                prior_d['omegarot'] = 2*np.pi/job['P_rot']
+
+    return prior_d
+
+
+def _get_derived(values):
+    """
+    values: dict of 'r', 'P_rot', 'A{k}', 'B{k}' arrays (draws first).
+    Returns dict of per-draw r, P_rot, amp_orb, amp_rot (first harmonic).
+    """
+    out = {}
+    for k in ['r', 'P_rot']:
+        if k in values:
+            out[k] = np.asarray(values[k]).flatten()
+    for k in ['orb', 'rot']:
+        A, B = values.get('A{}'.format(k)), values.get('B{}'.format(k))
+        if A is not None:
+            A, B = np.asarray(A), np.asarray(B)
+            if A.ndim > 1:
+                A, B = A[:, 0], B[:, 0]
+            out['amp_{}'.format(k)] = np.hypot(A, B)
+    return out
+
+
+def _get_valuenames(model):
+    # vector (Arot) or scalar (Arot0) parameterization of the first harmonic.
+    names = {}
+    for k in ['r', 'P_rot', 'Aorb', 'Borb', 'Arot', 'Brot']:
+        for name in [k, '{}0'.format(k)]:
+            if name in model.named_vars:
+                names[k] = name
+    return names
+
+
+def laplace_draws(model, map_estimate, N_draws=500, seed=None):
+    """
+    Draws of the named quantities of `model` under the Laplace approximation
+    at map_estimate: a gaussian in the sampled (transformed) space, with the
+    inverse Hessian of -logp as its covariance. Returns a dict of arrays, or
+    None if the Hessian is not positive definite.
+    """
+    import pymc3 as pm
+    from billy.chainpool import _get_bijection
+
+    point = {v.name: np.asarray(map_estimate[v.name]) for v in model.vars}
+    bij = _get_bijection(model, point)
+    H = pm.find_hessian(point, vars=model.vars, model=model)
+    try:
+        L_H = np.linalg.cholesky(H)
+    except np.linalg.LinAlgError:
+        return None
+
+    # x = μ + L_H^-T z has covariance H^-1.
+    rng = np.random.default_rng(seed)
+    z = rng.normal(size=(N_draws, H.shape[0]))
+    x = bij.map(point)[None, :] + np.linalg.solve(L_H.T, z.T).T
+
+    names = _get_valuenames(model)
+    f = model.fastfn([model[v] for v in names.values()])
+    draws = {k: [] for k in names}
+    for _x in x:
+        for k, v in zip(names, f(bij.rmap(_x))):
+            draws[k].append(v)
+    return {k: np.array(v) for k, v in draws.items()}
+
+
+def recover(job, x_obs, noise, y_err, config):
+    """
+    Inject `job` into `noise`, and recover it. Returns a dict of the MAP and
+    uncertainty of each recovered quantity, the Δχ² of each signal
+    component, and the recovery flags.
+    """
+    import pymc3 as pm, exoplanet as xo
+    from billy.modelfitter import ModelBuilder
+    from billy.harmonictrace import expand_point
+
+    t_start = time()
+    t_exp = np.nanmedian(np.diff(x_obs))
+    y_obs = noise + get_injected_signal(job, x_obs, t_exp)
+
+    mb = ModelBuilder(config['modelid'], x_obs, y_obs, y_err, t_exp=t_exp)
+    prior_d = get_recovery_prior_d(job, mb.modelcomponents,
+                                   amp_floor=config['amp_floor'])
+    model = mb._build_model(prior_d)
+
+    with model:
+        map_estimate = pm.find_MAP(model=model, progressbar=False)
+    point = expand_point(map_estimate)
+
+    # Δχ² of the MAP model, with and without each signal component.
+    def _chisq(y_mod):
+        return np.sum((y_obs - y_mod)**2 / y_err**2)
+
+    mu_model = point['mu_model'].flatten()
+    chisq = _chisq(mu_model)
+    result = OrderedDict([('job_id', job['job_id']), ('chisq', chisq)])
+    result['dchisq_transit'] = (
+        _chisq(mu_model - point['mu_transit'].flatten() +
+               float(point['mean'])) - chisq
+    )
+    for k in ['orb', 'rot']:
+        mu_k = sum(
+            point[n].flatten() for n in point
+            if n[:-1] in ('mu_{}sin'.format(k), 'mu_{}cos'.format(k))
+            and n[-1].isdigit()
+        )
+        result['dchisq_{}'.format(k)] = _chisq(mu_model - mu_k) - chisq
+
+    names = _get_valuenames(model)
+    map_values = _get_derived(
+        {k: np.asarray(map_estimate[v])[None] for k, v in names.items()}
+    )
+
+    method = 'laplace'
+    draws = laplace_draws(model, map_estimate, N_draws=config['N_laplace'],
+                          seed=int(job['job_id'][3:]))
+    if draws is None and config['fallback_mcmc']:
+        method = 'mcmc'
+        with model:
+            trace = pm.sample(
+                tune=config['N_mcmc'], draws=config['N_mcmc'],
+                start=map_estimate, cores=1, chains=2, progressbar=False,
+                step=xo.get_dense_nuts_step(target_accept=0.9),
+            )
+        draws = {k: trace[v] for k, v in names.items()}
+    elif draws is None:
+        method = 'map'
+
+    sigmas = _get_derived(draws) if draws is not None else {}
+    for k, v in map_values.items():
+        result['{}_map'.format(k)] = float(v[0])
+        result['{}_sigma'.format(k)] = (
+            float(np.std(sigmas[k])) if k in sigmas else np.nan
+        )
+        result['{}_true'.format(k)] = float(job[k])
+
+    # detection, and consistency of the recovered value with the truth.
+    def _consistent(k):
+        if k not in map_values:
+            return True
+        d = np.abs(result['{}_map'.format(k)] - result['{}_true'.format(k)])
+        s = result['{}_sigma'.format(k)]
+        return bool(np.isnan(s) or d <= config['n_sigma']*s)
+
+    result['transit_recovered'] = bool(
+        result['dchisq_transit'] >= config['dchisq_min'] and _consistent('r')
+    )
+    P_rot_ok = (
+        'P_rot' not in map_values or
+        np.abs(result['P_rot_map']/job['P_rot'] - 1) <= config['P_rot_rtol']
+    )
+    result['rot_recovered'] = bool(
+        result['dchisq_rot'] >= config['dchisq_min'] and P_rot_ok and
+        _consistent('amp_rot')
+    )
+    result['recovered'] = (
+        result['transit_recovered'] and result['rot_recovered']
+    )
+    result['method'] = method
+    result['host'] = socket.gethostname()
+    result['sec'] = time() - t_start
+
+    return result
+
+
+def work(campaigndir, max_jobs=None, verbose=True):
+    """
+    Claim and run jobs until the queue is empty (or max_jobs have run).
+    Returns the number of jobs run.
+    """
+    config, x_obs, noise, y_err = _load_campaign(campaigndir)
+
+    N_run = 0
+    while max_jobs is None or N_run < max_jobs:
+        job, claimedpath = claim_job(campaigndir)
+        if job is None:
+            break
+
+        name = '{}.json'.format(job['job_id'])
+        resultpath = os.path.join(campaigndir, 'results', name)
+        if os.path.exists(resultpath):
+            # finished before an interruption, but not marked done.
+            os.replace(claimedpath,
+                       os.path.join(_queuedir(campaigndir, 'done'), name))
+            continue
+
+        try:
+            result = recover(job, x_obs, noise, y_err, config)
+        except Exception:
+            job['traceback'] = traceback.format_exc()
+            _write_json(job, os.path.join(_queuedir(campaigndir, 'failed'),
+                                          name))
+            os.remove(claimedpath)
+            if verbose:
+                print('{} failed'.format(job['job_id']))
+            continue
+
+        _write_json(result, resultpath)
+        os.replace(claimedpath,
+                   os.path.join(_queuedir(campaigndir, 'done'), name))
+        N_run += 1
+        if verbose:
+            print('{}: {} in {:.0f} s ({})'.format(
+                job['job_id'],
+                'recovered' if result['recovered'] else 'not recovered',
+                result['sec'], result['method']))
+
+    return N_run
+
+
+def get_progress(campaigndir):
+    return {
+        state: len(glob(os.path.join(_queuedir(campaigndir, state), '*.json*')))
+        for state in ['todo', 'claimed', 'done', 'failed']
+    }
+
+
+def run_campaign(campaigndir, N_workers=4, stale_sec=6*3600, poll_sec=60,
+                 verbose=True):
+    """
+    Drain the campaign's queue with N_workers "spawn"-started processes on
+    this host (alongside any other hosts doing the same), then return the
+    collected results.
+    """
+    requeue_stale(campaigndir, stale_sec=stale_sec)
+
+    ctx = mp.get_context('spawn')
+    t_start = time()
+    with ProcessPoolExecutor(max_workers=N_workers, mp_context=ctx) as ex:
+        futures = [ex.submit(work, campaigndir, None, False)
+                   for _ in range(N_workers)]
+        while not all(f.done() for f in futures):
+            sleep(poll_sec)
+            if verbose:
+                print('{:.0f} s: {}'.format(time() - t_start,
+                                            get_progress(campaigndir)))
+        N_run = sum(f.result() for f in futures)
+
+    if verbose:
+        print('ran {} jobs in {:.0f} s; {}'.format(
+            N_run, time() - t_start, get_progress(campaigndir)))
+
+    return collect_results(campaigndir)
+
+
+def collect_results(campaigndir):
+    """
+    Every finished job's result, merged with its injected parameters.
+    """
+    rows = []
+    for path in sorted(glob(os.path.join(campaigndir, 'results', '*.json'))):
+        with open(path, 'r') as f:
+            rows.append(json.load(f))
+    jobs = pd.read_csv(os.path.join(campaigndir, 'jobs.csv'))
+    if len(rows) == 0:
+        return jobs.iloc[:0]
+    return jobs.merge(pd.DataFrame(rows), on='job_id', how='inner')
+
+
+def get_completeness(results, xkey, ykey, xbins=None, ybins=None,
+                     flag='recovered'):
+    """
+    Fraction of injections with `flag` set, over injected parameters xkey
+    and ykey (e.g., 'r' and 'amp_rot'). Without bins, each gridded value is
+    its own bin.
+
+    Returns (frac, N), DataFrames indexed by the y bins, with the x bins as
+    columns.
+    """
+    df = results.copy()
+    for key, bins in [(xkey, xbins), (ykey, ybins)]:
+        if bins is not None:
+            df[key] = pd.cut(df[key], bins)
+
+    g = df.groupby([ykey, xkey])[flag]
+    frac = g.mean().unstack(xkey)
+    N = g.size().unstack(xkey)
+    return frac, N
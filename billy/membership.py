@@ -0,0 +1,230 @@
+"""
+Kinematic cluster-membership selection on a locally indexed Gaia subset.
+
+Usage:
+
+    me = MembershipEngine.from_file('gaia_orion_subset.feather')
+    sel = me.query(ra=81.28, dec=1.57, radius_deg=5,
+                   pmra_range=(-1, 3), pmdec_range=(-1, 2),
+                   parallax_range=(2, 3.5))
+    info = me.get_nbhd_info(
+        3222255959210123904, 'PTFO 8-8695', '25 Ori-1',
+        cluster_catalogs={'k13': k13_df, 'cg18': cg18_df, ...}
+    )
+
+The engine keeps
+
+    * a KD-tree on unit vectors, for cone searches,
+    * sorted orderings of pmra, pmdec, and parallax, for range queries,
+
+and intersects the candidates of the most selective index before applying
+the exact (box or ellipse) cuts as vectorized masks. `get_nbhd_info` returns
+the 14-element tuple stored in the `nbhd_info_*.pkl` files, and consumed by
+plot_hr and billy.gaiatables.
+"""
+import os, pickle
+import numpy as np, pandas as pd
+
+from billy.catalogcache import radec_to_xyz
+
+GAIACOLS = [
+    'source_id', 'ra', 'dec', 'parallax', 'parallax_error', 'pmra', 'pmdec',
+    'phot_g_mean_mag', 'phot_bp_mean_mag', 'phot_rp_mean_mag',
+    'astrometric_chi2_al', 'astrometric_n_obs_al'
+]
+CATALOGNAMES = ['k13', 'cg18', 'kc19', 'k18']
+
+
+class MembershipEngine:
+
+    def __init__(self, df):
+        """
+        df: DataFrame of Gaia sources, with at least source_id, ra, dec,
+        parallax, pmra, and pmdec.
+        """
+        from scipy.spatial import cKDTree
+
+        self.df = df.reset_index(drop=True)
+        self.source_id = np.asarray(self.df['source_id']).astype(np.int64)
+
+        self.xyz_tree = cKDTree(
+            radec_to_xyz(np.asarray(self.df['ra']), np.asarray(self.df['dec']))
+        )
+
+        # range indexes: (sorted values, argsort) for each kinematic column.
+        self._sorted = {}
+        for k in ['pmra', 'pmdec', 'parallax']:
+            vals = np.asarray(self.df[k], dtype=float)
+            order = np.argsort(vals, kind='stable')
+            self._sorted[k] = (vals[order], order)
+
+    @classmethod
+    def from_file(cls, path, columns=GAIACOLS):
+        """
+        Load a Feather, Parquet, or CSV extract, reading only `columns`.
+        """
+        if path.endswith('.feather'):
+            df = pd.read_feather(path, columns=columns)
+        elif path.endswith('.parquet'):
+            df = pd.read_parquet(path, columns=columns)
+        else:
+            df = pd.read_csv(path, usecols=columns)
+        return cls(df)
+
+    def _range_inds(self, k, lo, hi):
+        vals, order = self._sorted[k]
+        i0 = np.searchsorted(vals, lo, side='left')
+        i1 = np.searchsorted(vals, hi, side='right')
+        return order[i0:i1]
+
+    def query(self, ra=None, dec=None, radius_deg=None, pmra_range=None,
+              pmdec_range=None, parallax_range=None, ellipse=None):
+        """
+        Returns the integer row indices of sources that satisfy every given
+        cut:
+
+            ra, dec, radius_deg: cone.
+            pmra_range, pmdec_range, parallax_range: (lo, hi) boxes.
+            ellipse: dict with "center" (pmra, pmdec, parallax) and "axes"
+                (semi-axes along each), selecting
+                Σ ((x - center)/axes)^2 <= 1. Axes can be np.inf to ignore a
+                dimension.
+        """
+        candidates = []
+
+        if radius_deg is not None:
+            chord = 2*np.sin(np.radians(radius_deg)/2)
+            candidates.append(np.array(
+                self.xyz_tree.query_ball_point(radec_to_xyz(ra, dec)[0], chord),
+                dtype=int
+            ))
+
+        ranges = {'pmra': pmra_range, 'pmdec': pmdec_range,
+                  'parallax': parallax_range}
+        if ellipse is not None:
+            # the ellipse's bounding box, for the index lookup.
+            for k, c, a in zip(['pmra', 'pmdec', 'parallax'],
+                               ellipse['center'], ellipse['axes']):
+                if np.isfinite(a):
+                    box = (c-a, c+a)
+                    if ranges[k] is not None:
+                        box = (max(box[0], ranges[k][0]),
+                               min(box[1], ranges[k][1]))
+                    ranges[k] = box
+
+        for k, r in ranges.items():
+            if r is not None:
+                candidates.append(self._range_inds(k, r[0], r[1]))
+
+        if len(candidates) == 0:
+            return np.arange(len(self.df))
+
+        # intersect, starting from the most selective index.
+        candidates = sorted(candidates, key=len)
+        inds = np.sort(candidates[0])
+        for c in candidates[1:]:
+            inds = inds[np.isin(inds, c, assume_unique=False)]
+
+        if ellipse is not None:
+            x = np.vstack([
+                np.asarray(self.df[k], dtype=float)[inds]
+                for k in ['pmra', 'pmdec', 'parallax']
+            ]).T
+            center = np.asarray(ellipse['center'], dtype=float)
+            axes = np.asarray(ellipse['axes'], dtype=float)
+            d2 = np.sum(((x - center)/axes)**2, axis=1)
+            inds = inds[d2 <= 1]
+
+        return inds
+
+    def crossmatch(self, cluster_catalogs, groupname, cutoff_probability=None,
+                   namecol='cluster', probcol='proba'):
+        """
+        cluster_catalogs: dict of catalog name (e.g., 'k13', 'cg18', 'kc19',
+        'k18') -> DataFrame with source_id and `namecol` columns (and
+        optionally `probcol` membership probabilities).
+
+        Returns (member_mask, flags): a boolean mask over the engine's
+        sources of members of `groupname` in any catalog (with probability >=
+        cutoff, where given), and a dict of catalog name -> whether the group
+        appears in that catalog.
+        """
+        member_mask = np.zeros(len(self.df), dtype=bool)
+        flags = {}
+        for name in CATALOGNAMES:
+            if name not in cluster_catalogs:
+                flags[name] = False
+                continue
+            cdf = cluster_catalogs[name]
+            sel = np.asarray(cdf[namecol].astype(str) == str(groupname))
+            if cutoff_probability is not None and probcol in cdf:
+                sel &= np.asarray(cdf[probcol] >= cutoff_probability)
+            flags[name] = bool(np.any(sel))
+            ids = np.asarray(cdf[sel]['source_id']).astype(np.int64)
+            member_mask |= np.isin(self.source_id, ids)
+        return member_mask, flags
+
+    def get_nbhd_info(self, target_source_id, targetname, groupname,
+                      cluster_catalogs, cutoff_probability=0.1,
+                      radius_deg=None, pm_padding=0.5, parallax_padding=0.5,
+                      outpath=None):
+        """
+        Build the neighborhood tuple:
+
+        (targetname, groupname, group_df_dr2, target_df, nbhd_df,
+         cutoff_probability, pmdec_min, pmdec_max, pmra_min, pmra_max,
+         group_in_k13, group_in_cg18, group_in_kc19, group_in_k18)
+
+        The group is the cross-matched members of `groupname`. The
+        neighborhood is every non-member within radius_deg of the target
+        (default: twice the members' maximum separation), within the
+        members' proper-motion box and parallax range (padded by pm_padding
+        mas/yr, and parallax_padding mas). If outpath is given, the tuple is
+        also pickled there.
+        """
+        member_mask, flags = self.crossmatch(
+            cluster_catalogs, groupname, cutoff_probability=cutoff_probability
+        )
+        if not np.any(member_mask):
+            raise ValueError('no members of {} found'.format(groupname))
+
+        tsel = (self.source_id == np.int64(target_source_id))
+        if not np.any(tsel):
+            raise ValueError('target {} not in the Gaia subset'.
+                             format(target_source_id))
+        target_df = self.df[tsel]
+        group_df = self.df[member_mask]
+
+        pmra_min = np.nanmin(group_df.pmra) - pm_padding
+        pmra_max = np.nanmax(group_df.pmra) + pm_padding
+        pmdec_min = np.nanmin(group_df.pmdec) - pm_padding
+        pmdec_max = np.nanmax(group_df.pmdec) + pm_padding
+        plx_min = np.nanmin(group_df.parallax) - parallax_padding
+        plx_max = np.nanmax(group_df.parallax) + parallax_padding
+
+        t_ra, t_dec = float(target_df.ra.iloc[0]), float(target_df.dec.iloc[0])
+        if radius_deg is None:
+            xyz = radec_to_xyz(np.asarray(group_df.ra),
+                               np.asarray(group_df.dec))
+            cosang = np.clip(xyz @ radec_to_xyz(t_ra, t_dec)[0], -1, 1)
+            radius_deg = 2*np.degrees(np.max(np.arccos(cosang)))
+
+        inds = self.query(ra=t_ra, dec=t_dec, radius_deg=radius_deg,
+                          pmra_range=(pmra_min, pmra_max),
+                          pmdec_range=(pmdec_min, pmdec_max),
+                          parallax_range=(plx_min, plx_max))
+        inds = inds[~member_mask[inds]]
+        nbhd_df = self.df.iloc[inds]
+
+        info = (
+            targetname, groupname, group_df, target_df, nbhd_df,
+            cutoff_probability, pmdec_min, pmdec_max, pmra_min, pmra_max,
+            flags['k13'], flags['cg18'], flags['kc19'], flags['k18']
+        )
+
+        if outpath is not None:
+            with open(outpath, 'wb') as buff:
+                pickle.dump(info, buff)
+            print('made {}'.format(outpath))
+
+        return info
@@ -0,0 +1,362 @@
+"""
+Information criteria evaluated over the whole posterior, rather than at the
+MAP alone (as in convenience.get_bic).
+
+    get_n_free_params: number of free parameters, from the model's free RVs
+    get_posterior_chisq: χ^2 and log-likelihood of every posterior draw
+    get_posterior_ic: distributions of χ^2, BIC, and AIC, plus DIC
+    get_pointwise_loglike: (N_draws x N_obs) log-likelihood of a block of
+        observations
+    psis_smooth: Pareto-smoothed importance sampling of log-ratios
+    get_loo_waic: PSIS-LOO and WAIC, with Pareto-k diagnostics
+    compare_models: LOO/WAIC of a grid of fitted models, in parallel
+
+The stored "mu_model" samples are read one chain at a time, and the
+per-draw quantities are accumulated over blocks of (chunksize draws x
+obs_chunksize timestamps) of that chain, so that the residual temporaries
+are set by the block size rather than by N_draws x N_obs (the chain itself
+is still read whole). LOO and WAIC are sums over observations, so they are
+computed one block of observations (all draws) at a time, and the full
+pointwise log-likelihood matrix is never held in memory.
+"""
+import os, pickle
+import numpy as np, pandas as pd
+import multiprocessing as mp
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from billy.posterior import _get_chain_values
+
+
+def get_n_free_params(model):
+    """
+    Total size of the model's free random variables (e.g., 2 for the "u"
+    limb-darkening vector), counted in the sampled (transformed) space.
+    """
+    return int(sum(
+        np.size(rv.tag.test_value) for rv in model.free_RVs
+    ))
+
+
+def get_posterior_chisq(trace, y_obs, y_err, varname='mu_model',
+                        chunksize=500, obs_chunksize=20000):
+    """
+    χ^2 = Σ (mu - y)^2 / σ^2 and the gaussian log-likelihood of every draw
+    (all chains concatenated, in chain order). Each chain's `varname`
+    samples are read whole; the residuals are formed in blocks of
+    chunksize draws x obs_chunksize timestamps.
+
+    Returns (chisq, lnlike), each of length N_draws.
+    """
+    y_obs = np.asarray(y_obs, dtype=float).flatten()
+    w = 1/np.asarray(y_err, dtype=float).flatten()
+    w = np.broadcast_to(w, y_obs.shape)
+    lnnorm = -np.sum(np.log(np.sqrt(2*np.pi)/w))
+
+    out = []
+    for vals in _get_chain_values(trace, varname):
+        vals = vals.reshape(vals.shape[0], -1)
+        chisq = np.zeros(vals.shape[0])
+        for i0 in range(0, vals.shape[0], chunksize):
+            for j0 in range(0, vals.shape[1], obs_chunksize):
+                block = vals[i0:i0+chunksize, j0:j0+obs_chunksize]
+                r = (block - y_obs[j0:j0+obs_chunksize]) * w[j0:j0+obs_chunksize]
+                chisq[i0:i0+chunksize] += np.einsum('ij,ij->i', r, r)
+        out.append(chisq)
+
+    chisq = np.concatenate(out)
+    return chisq, -0.5*chisq + lnnorm
+
+
+def _describe(x, quantiles=(0.025, 0.16, 0.5, 0.84, 0.975)):
+    d = OrderedDict([('min', np.min(x)), ('mean', np.mean(x))])
+    for q, v in zip(quantiles, np.quantile(x, quantiles)):
+        d['q{:g}'.format(100*q)] = v
+    return d
+
+
+def get_posterior_ic(m, varname='mu_model', chunksize=500,
+                     obs_chunksize=20000, verbose=True):
+    """
+    m: ModelFitter instance (with model, trace, y_obs, y_err).
+
+    Returns a dict with the per-draw arrays "chisq", "lnlike", "BIC"
+    (χ^2 + k ln n, as in convenience.bic), and "AIC" (χ^2 + 2k); the scalars
+    "Ndata", "Nparam", "DIC" and "p_DIC" (using p = var(-2 ln L)/2); and
+    "summary", a dict of name -> min, mean, and quantiles of each
+    distribution.
+    """
+    from billy.convenience import bic
+
+    k = get_n_free_params(m.model)
+    n = len(np.asarray(m.y_obs).flatten())
+
+    chisq, lnlike = get_posterior_chisq(
+        m.trace, m.y_obs, m.y_err, varname=varname, chunksize=chunksize,
+        obs_chunksize=obs_chunksize
+    )
+
+    BIC = bic(chisq, k, n)
+    AIC = chisq + 2*k
+
+    p_DIC = 0.5*np.var(-2*lnlike)
+    DIC = np.mean(-2*lnlike) + p_DIC
+
+    d = {
+        'modelid': getattr(m, 'modelid', None),
+        'Ndata': n,
+        'Nparam': k,
+        'chisq': chisq,
+        'lnlike': lnlike,
+        'BIC': BIC,
+        'AIC': AIC,
+        'DIC': DIC,
+        'p_DIC': p_DIC,
+        'summary': OrderedDict([
+            ('chisq', _describe(chisq)), ('redchisq', _describe(chisq/(n-k))),
+            ('BIC', _describe(BIC)), ('AIC', _describe(AIC))
+        ])
+    }
+
+    if verbose:
+        s = d['summary']
+        msg = (
+            '{}: Ndata = {:d}, Nparam = {:d}, χ2 = {:.1f} (+{:.1f}/-{:.1f}), '
+            'BIC = {:.1f} (min {:.1f}), DIC = {:.1f}'.format(
+                d['modelid'], n, k, s['chisq']['q50'],
+                s['chisq']['q84']-s['chisq']['q50'],
+                s['chisq']['q50']-s['chisq']['q16'],
+                s['BIC']['q50'], s['BIC']['min'], DIC
+            )
+        )
+        print(42*'=')
+        print(msg)
+        print(42*'=')
+
+    return d
+
+
+def get_pointwise_loglike(trace, y_obs, y_err, j0, j1, varname='mu_model'):
+    """
+    Gaussian log-likelihood of observations j0:j1 under every draw (all
+    chains concatenated): a (N_draws x (j1-j0)) array.
+    """
+    y = np.asarray(y_obs, dtype=float).flatten()
+    err = np.broadcast_to(np.asarray(y_err, dtype=float).flatten(), y.shape)
+    y, err = y[j0:j1], err[j0:j1]
+    mu = np.vstack([
+        v.reshape(v.shape[0], -1)[:, j0:j1]
+        for v in _get_chain_values(trace, varname)
+    ])
+    return -0.5*((mu - y)/err)**2 - np.log(np.sqrt(2*np.pi)*err)
+
+
+def _logsumexp(x, axis=0):
+    xmax = np.max(x, axis=axis, keepdims=True)
+    return np.squeeze(
+        xmax + np.log(np.sum(np.exp(x - xmax), axis=axis, keepdims=True)),
+        axis=axis
+    )
+
+
+def _gpdfit(x, prior_bs=3, prior_k=10):
+    """
+    Generalized Pareto fit to each column of x (n x C, sorted ascending,
+    non-negative), by the empirical-Bayes method of Zhang & Stephens (2009),
+    with the weakly informative prior on k of Vehtari et al. (2017).
+
+    Returns (k, sigma), each of length C.
+    """
+    n = x.shape[0]
+    m_est = 30 + int(n**0.5)
+    b = 1 - np.sqrt(m_est / (np.arange(1, m_est+1) - 0.5))
+    x_q = x[int(n/4 + 0.5) - 1]
+    x_q = np.where(x_q > 0, x_q, np.finfo(float).tiny)
+    x_max = np.where(x[-1] > 0, x[-1], np.finfo(float).tiny)
+    b = b[:, None] / (prior_bs * x_q[None, :]) + 1/x_max[None, :]
+
+    # profile log-likelihood of each candidate b, for every column.
+    k = np.mean(np.log1p(-b[:, None, :] * x[None, :, :]), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        L = n * (np.log(-b/k) - k - 1)
+    L = np.where(np.isfinite(L), L, -np.inf)
+    w = np.exp(L - _logsumexp(L, axis=0)[None, :])
+
+    b_post = np.sum(b*w, axis=0)
+    k_post = np.mean(np.log1p(-b_post[None, :] * x), axis=0)
+    sigma = -k_post / b_post
+    k_post = (n*k_post + prior_k*0.5) / (n + prior_k)
+    return k_post, sigma
+
+
+def _gpinv(p, k, sigma):
+    """
+    Generalized Pareto quantiles; p (n), k and sigma (C) -> (n x C).
+    """
+    p = p[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(
+            np.abs(k) < np.finfo(float).eps,
+            -np.log1p(-p),
+            np.expm1(-k * np.log1p(-p)) / k
+        )
+    return x * sigma
+
+
+def psis_smooth(log_ratios):
+    """
+    Pareto-smoothed importance sampling (Vehtari et al. 2017, 2022).
+
+    log_ratios: (S x C) array, one column per observation (for LOO, the
+    negative pointwise log-likelihood).
+
+    In each column, the largest M = min(S/5, 3 sqrt(S)) ratios are replaced
+    by the expected order statistics of a generalized Pareto fit to them,
+    and the result truncated at the largest raw ratio. Returns (log_weights,
+    k): normalized log-weights (S x C), and the Pareto shape of each column.
+    """
+    lw = np.asarray(log_ratios, dtype=float)
+    S, C = lw.shape
+    lw = lw - np.max(lw, axis=0)[None, :]
+
+    M = int(np.ceil(min(0.2*S, 3*np.sqrt(S))))
+    k = np.full(C, np.inf)
+    if M > 4:
+        order = np.argsort(lw, axis=0)
+        tail_ix = order[-M:]
+        cutoff = np.take_along_axis(lw, order[-M-1:-M], axis=0)[0]
+        cutoff = np.maximum(cutoff, np.log(np.finfo(float).tiny))
+        tail = np.exp(np.take_along_axis(lw, tail_ix, axis=0)) - np.exp(cutoff)
+
+        k, sigma = _gpdfit(tail)
+        p = (np.arange(M) + 0.5) / M
+        smoothed = np.log(_gpinv(p, k, sigma) + np.exp(cutoff)[None, :])
+
+        # columns whose fit failed keep their raw weights.
+        good = np.isfinite(k) & (sigma > 0)
+        smoothed = np.where(good[None, :], smoothed,
+                            np.take_along_axis(lw, tail_ix, axis=0))
+        k = np.where(good, k, np.inf)
+        np.put_along_axis(lw, tail_ix, smoothed, axis=0)
+        lw = np.minimum(lw, 0)
+
+    lw = lw - _logsumexp(lw, axis=0)[None, :]
+    return lw, k
+
+
+def get_loo_waic(trace, y_obs, y_err, varname='mu_model',
+                 obs_chunksize=500):
+    """
+    PSIS-LOO and WAIC of a fitted model, on the deviance-free "elpd" scale
+    (larger is better), computed one block of observations at a time.
+
+    Returns a dict with "elpd_loo", "se_elpd_loo", "p_loo", "looic" (-2
+    elpd_loo), "elpd_waic", "se_elpd_waic", "p_waic", "waic", the Pareto-k
+    summary "max_pareto_k" and "n_bad_k" (k > 0.7, where LOO is unreliable),
+    and the pointwise arrays "loo_i", "waic_i", and "pareto_k".
+    """
+    N_obs = len(np.asarray(y_obs).flatten())
+    loo_i, waic_i, p_waic_i, k_i = [], [], [], []
+
+    for j0 in range(0, N_obs, obs_chunksize):
+        j1 = min(j0 + obs_chunksize, N_obs)
+        ll = get_pointwise_loglike(trace, y_obs, y_err, j0, j1,
+                                   varname=varname)
+        S = ll.shape[0]
+
+        lw, k = psis_smooth(-ll)
+        loo_i.append(_logsumexp(lw + ll, axis=0))
+        k_i.append(k)
+
+        lppd = _logsumexp(ll, axis=0) - np.log(S)
+        p_w = np.var(ll, axis=0, ddof=1)
+        waic_i.append(lppd - p_w)
+        p_waic_i.append(p_w)
+
+    loo_i = np.concatenate(loo_i)
+    waic_i = np.concatenate(waic_i)
+    p_waic_i = np.concatenate(p_waic_i)
+    k_i = np.concatenate(k_i)
+
+    elpd_waic = np.sum(waic_i)
+    lppd = elpd_waic + np.sum(p_waic_i)
+    elpd_loo = np.sum(loo_i)
+
+    return {
+        'Ndata': N_obs,
+        'elpd_loo': elpd_loo,
+        'se_elpd_loo': np.sqrt(N_obs*np.var(loo_i)),
+        'p_loo': lppd - elpd_loo,
+        'looic': -2*elpd_loo,
+        'elpd_waic': elpd_waic,
+        'se_elpd_waic': np.sqrt(N_obs*np.var(waic_i)),
+        'p_waic': np.sum(p_waic_i),
+        'waic': -2*elpd_waic,
+        'max_pareto_k': np.max(k_i),
+        'n_bad_k': int(np.sum(k_i > 0.7)),
+        'loo_i': loo_i,
+        'waic_i': waic_i,
+        'pareto_k': k_i,
+    }
+
+
+def _loo_worker(modelid, pklpath, y_obs, y_err, obs_chunksize):
+    d = pickle.load(open(pklpath, 'rb'))
+    out = get_loo_waic(d['trace'], y_obs, y_err,
+                       obs_chunksize=obs_chunksize)
+    out['modelid'] = modelid
+    out['Nparam'] = get_n_free_params(d['model'])
+    return out
+
+
+def compare_models(pklpaths, y_obs, y_err, outdir=None, N_workers=4,
+                   obs_chunksize=500):
+    """
+    pklpaths: dict of modelid -> ModelFitter pickle path.
+
+    Computes LOO and WAIC of every model in parallel ("spawn"-started
+    worker processes, one model each). If outdir is given, each model's
+    result is written to {outdir}/{modelid}_loodict.pkl, alongside the
+    bicdicts of convenience.get_bic.
+
+    Returns a DataFrame in the format of the BIC comparison table (N, M,
+    Ndata, Nparam, ...), sorted by elpd_loo, with d_elpd_loo and its
+    standard error (from the pointwise differences) relative to the best
+    model.
+    """
+    ctx = mp.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=N_workers, mp_context=ctx) as ex:
+        futures = [
+            ex.submit(_loo_worker, modelid, p, y_obs, y_err, obs_chunksize)
+            for modelid, p in pklpaths.items()
+        ]
+        results = [f.result() for f in futures]
+
+    best = max(results, key=lambda r: r['elpd_loo'])
+
+    rows = []
+    for r in results:
+        N = int(r['modelid'].split('_')[1][0])
+        M = int(r['modelid'].split('_')[2][0])
+        diff = best['loo_i'] - r['loo_i']
+        r['N'], r['M'] = N, M
+        r['d_elpd_loo'] = np.sum(diff)
+        r['se_d_elpd_loo'] = np.sqrt(len(diff)*np.var(diff))
+
+        if outdir is not None:
+            outpath = os.path.join(outdir, r['modelid']+'_loodict.pkl')
+            with open(outpath, 'wb') as buff:
+                pickle.dump(r, buff)
+            print('Wrote {}'.format(outpath))
+
+        rows.append(OrderedDict(
+            (k, r[k]) for k in [
+                'modelid', 'N', 'M', 'Ndata', 'Nparam', 'elpd_loo',
+                'se_elpd_loo', 'p_loo', 'looic', 'elpd_waic', 'p_waic',
+                'waic', 'max_pareto_k', 'n_bad_k', 'd_elpd_loo',
+                'se_d_elpd_loo'
+            ]
+        ))
+
+    df = pd.DataFrame(rows)
+    return df.sort_values(by='elpd_loo', ascending=False).reset_index(drop=True)
@@ -1,5 +1,5 @@
 import numpy as np, matplotlib.pyplot as plt, pandas as pd, pymc3 as pm
-import pickle, os
+import pickle, os, time
 from copy import deepcopy
 from collections import OrderedDict
 from astropy import units as units, constants as const
@@ -10,6 +10,13 @@ from billy import __path__
 from billy.models import sin_model, cos_model, transit_model
 from billy.plotting import plot_test_data, savefig, plot_MAP_data
 from billy.convenience import flatten as bflatten
+from billy.harmonictrace import HarmonicTrace, expand_point
+from billy.chainpool import sample_chains
+from billy.multistart import multistart_map
+from billy.tuning import (
+    get_tuningpath, save_tuning, load_tuning, get_tuned_step,
+    get_hessian_tuning
+)
 
 from billy.convenience import (
     MSTAR_VANEYKEN, MSTAR_STDEV, RSTAR_VANEYKEN, RSTAR_STDEV
@@ -19,6 +26,16 @@ RESULTSDIR = os.path.join(os.path.dirname(__path__[0]), 'results')
 
 LINEAR_AMPLITUDES = 1
 LOG_AMPLITUDES = 0
+# if true, the amplitudes of each harmonic block are one vector-valued random
+# variable ("Aorb", shape N), and the harmonics are evaluated as broadcast
+# arrays. The per-harmonic names ("Aorb0", "mu_orbsin0", ...) are still
+# available from the trace and MAP estimate through billy.harmonictrace.
+VECTOR_HARMONICS = 1
+# if true, chains are sampled by billy.chainpool: one "spawn"-started worker
+# per chain, which rebuilds the model from its specification and reads the
+# observed data from shared memory, rather than pm.sample's forked copies.
+# calling scripts must guard their fitting with `if __name__ == "__main__"`.
+SHARED_MEMORY_CHAINS = 1
 
 class ModelParser:
 
@@ -48,57 +65,28 @@ class ModelParser:
                 raise ValueError(errmsg)
 
 
-class ModelFitter(ModelParser):
+class ModelBuilder(ModelParser):
     """
-    Given a modelid of the form "transit_NsincosPorb_NsincosProt", and
-    observed x and y values (typically time and flux), construct and
-    fit the model. In other words, run the inference.
-
-    The model implemented is of the form
-
-    Y ~ N(
-    [Mandel-Agol transit] +
-    Σ_n A_n sin(n*ωt + φ) +
-    Σ_n A_n cos(n*ωt + φ),
-    σ^2).
+    Construct (but do not fit) the pm.Model of a modelid, for observed x and
+    y values. This is all that a worker process needs to rebuild the model
+    from its specification (modelid, data, and prior_d), rather than
+    receiving a pickled copy of the graph.
     """
 
-    def __init__(self, modelid, x_obs, y_obs, y_err, prior_d,
-                 N_samples=2000, N_cores=16, N_chains=4,
-                 plotdir=None, pklpath=None, overwrite=1):
-
-        self.N_samples = N_samples
-        self.N_cores = N_cores
-        self.N_chains = N_chains
-        self.PLOTDIR = plotdir
-        self.OVERWRITE = overwrite
+    def __init__(self, modelid, x_obs, y_obs, y_err, t_exp=None):
         self.x_obs = x_obs
         self.y_obs = y_obs
         self.y_err = y_err
-        self.t_exp = np.nanmedian(np.diff(x_obs))
-
+        self.t_exp = (
+            np.nanmedian(np.diff(x_obs)) if t_exp is None else t_exp
+        )
         self.initialize_model(modelid)
-        self.verify_inputdata()
-        self.run_inference(prior_d, pklpath, make_threadsafe=True)
-
-
-    def verify_inputdata(self):
-        assert len(self.x_obs) == len(self.y_obs)
-        assert isinstance(self.x_obs, np.ndarray)
-        assert isinstance(self.y_obs, np.ndarray)
-
-
-    def run_inference(self, prior_d, pklpath, make_threadsafe=True):
-
-        # if the model has already been run, pull the result from the
-        # pickle. otherwise, run it.
-        if os.path.exists(pklpath):
-            d = pickle.load(open(pklpath, 'rb'))
-            self.model = d['model']
-            self.trace = d['trace']
-            self.map_estimate = d['map_estimate']
-            return 1
 
+    def _build_model(self, prior_d):
+        """
+        Construct the pm.Model for self.modelcomponents, with the priors of
+        `prior_d`.
+        """
         with pm.Model() as model:
 
             # Fixed data errors.
@@ -111,11 +99,18 @@ class ModelFitter(ModelParser):
 
                 if 'transit' in modelcomponent:
 
+                    # stellar priors: prior_d's "m_star" and "r_star" (and
+                    # optional "m_star_sd" and "r_star_sd"), defaulting to
+                    # van Eyken+12. see billy.priorsens for alternatives.
                     BoundedNormal = pm.Bound(pm.Normal, lower=0, upper=3)
-                    m_star = BoundedNormal("m_star", mu=MSTAR_VANEYKEN,
-                                           sd=MSTAR_STDEV)
-                    r_star = BoundedNormal("r_star", mu=RSTAR_VANEYKEN,
-                                           sd=RSTAR_STDEV)
+                    m_star = BoundedNormal(
+                        "m_star", mu=prior_d.get('m_star', MSTAR_VANEYKEN),
+                        sd=prior_d.get('m_star_sd', MSTAR_STDEV)
+                    )
+                    r_star = BoundedNormal(
+                        "r_star", mu=prior_d.get('r_star', RSTAR_VANEYKEN),
+                        sd=prior_d.get('r_star_sd', RSTAR_STDEV)
+                    )
 
                     # mean = pm.Normal(
                     #     "mean", mu=prior_d['mean'], sd=0.02, testval=prior_d['mean']
@@ -248,53 +243,58 @@ class ModelFitter(ModelParser):
                         )
 
                     N_harmonics = int(modelcomponent[0])
-                    for ix in range(N_harmonics):
-
-                        if LINEAR_AMPLITUDES:
-                            Akey = 'A{}{}'.format(k,ix)
-                            Bkey = 'B{}{}'.format(k,ix)
-
-                            A_d[Akey] = pm.Uniform(
-                                Akey,
-                                lower=-2*np.abs(prior_d[Akey]),
-                                upper=2*np.abs(prior_d[Akey]),
-                                testval=np.abs(prior_d[Akey]))
-
-                            B_d[Bkey] = pm.Uniform(
-                                Bkey,
-                                lower=-2*np.abs(prior_d[Bkey]),
-                                upper=2*np.abs(prior_d[Bkey]),
-                                testval=np.abs(prior_d[Bkey]))
-
-                        if LOG_AMPLITUDES:
-                            Akey = 'A{}{}'.format(k,ix)
-                            Bkey = 'B{}{}'.format(k,ix)
-                            logAkey = 'logA{}{}'.format(k,ix)
-                            logBkey = 'logB{}{}'.format(k,ix)
-
-                            if k == 'rot':
-                                mfact = 3
-                            elif k == 'orb':
-                                mfact = 10
-                            _A_d[logAkey] = pm.Uniform(
-                                logAkey,
-                                lower=np.log(prior_d[Akey]/mfact),
-                                upper=np.log(mfact*prior_d[Akey]),
-                                testval=np.log(prior_d[Akey])
-                            )
-                            A_d[Akey] = pm.Deterministic(
-                                Akey, pm.math.exp(_A_d[logAkey])
-                            )
-
-                            _B_d[logBkey] = pm.Uniform(
-                                logBkey,
-                                lower=np.log(prior_d[Bkey]/mfact),
-                                upper=np.log(mfact*prior_d[Bkey]),
-                                testval=np.log(prior_d[Bkey])
-                            )
-                            B_d[Bkey] = pm.Deterministic(
-                                Bkey, pm.math.exp(_B_d[logBkey])
-                            )
+                    if VECTOR_HARMONICS:
+                        A_d, B_d = self._add_vector_amplitudes(
+                            k, N_harmonics, prior_d, A_d, B_d
+                        )
+                    else:
+                        for ix in range(N_harmonics):
+
+                            if LINEAR_AMPLITUDES:
+                                Akey = 'A{}{}'.format(k,ix)
+                                Bkey = 'B{}{}'.format(k,ix)
+
+                                A_d[Akey] = pm.Uniform(
+                                    Akey,
+                                    lower=-2*np.abs(prior_d[Akey]),
+                                    upper=2*np.abs(prior_d[Akey]),
+                                    testval=np.abs(prior_d[Akey]))
+
+                                B_d[Bkey] = pm.Uniform(
+                                    Bkey,
+                                    lower=-2*np.abs(prior_d[Bkey]),
+                                    upper=2*np.abs(prior_d[Bkey]),
+                                    testval=np.abs(prior_d[Bkey]))
+
+                            if LOG_AMPLITUDES:
+                                Akey = 'A{}{}'.format(k,ix)
+                                Bkey = 'B{}{}'.format(k,ix)
+                                logAkey = 'logA{}{}'.format(k,ix)
+                                logBkey = 'logB{}{}'.format(k,ix)
+
+                                if k == 'rot':
+                                    mfact = 3
+                                elif k == 'orb':
+                                    mfact = 10
+                                _A_d[logAkey] = pm.Uniform(
+                                    logAkey,
+                                    lower=np.log(prior_d[Akey]/mfact),
+                                    upper=np.log(mfact*prior_d[Akey]),
+                                    testval=np.log(prior_d[Akey])
+                                )
+                                A_d[Akey] = pm.Deterministic(
+                                    Akey, pm.math.exp(_A_d[logAkey])
+                                )
+
+                                _B_d[logBkey] = pm.Uniform(
+                                    logBkey,
+                                    lower=np.log(prior_d[Bkey]/mfact),
+                                    upper=np.log(mfact*prior_d[Bkey]),
+                                    testval=np.log(prior_d[Bkey])
+                                )
+                                B_d[Bkey] = pm.Deterministic(
+                                    Bkey, pm.math.exp(_B_d[logBkey])
+                                )
 
             harmonic_d = {**A_d, **B_d, **omega_d, **phi_d}
 
@@ -321,33 +321,39 @@ class ModelFitter(ModelParser):
                         k = 'rot'
 
                     N_harmonics = int(modelcomponent[0])
-                    for ix in range(N_harmonics):
+                    if VECTOR_HARMONICS:
+                        if N_harmonics > 0:
+                            mu_model += self._vector_harmonic_model(
+                                k, N_harmonics, harmonic_d
+                            )
+                    else:
+                        for ix in range(N_harmonics):
 
-                        spnames = ['A{}{}'.format(k,ix), 'omega{}'.format(k),
-                                   'phi{}'.format(k)]
-                        cpnames = ['B{}{}'.format(k,ix), 'omega{}'.format(k),
-                                   'phi{}'.format(k)]
-                        sin_params = [harmonic_d[k] for k in spnames]
-                        cos_params = [harmonic_d[k] for k in cpnames]
+                            spnames = ['A{}{}'.format(k,ix), 'omega{}'.format(k),
+                                       'phi{}'.format(k)]
+                            cpnames = ['B{}{}'.format(k,ix), 'omega{}'.format(k),
+                                       'phi{}'.format(k)]
+                            sin_params = [harmonic_d[k] for k in spnames]
+                            cos_params = [harmonic_d[k] for k in cpnames]
 
-                        # harmonic multiplier
-                        mult = ix + 1
-                        sin_params[1] = pm.math.dot(sin_params[1], mult)
-                        cos_params[1] = pm.math.dot(cos_params[1], mult)
+                            # harmonic multiplier
+                            mult = ix + 1
+                            sin_params[1] = pm.math.dot(sin_params[1], mult)
+                            cos_params[1] = pm.math.dot(cos_params[1], mult)
 
-                        s_mod = sin_model(sin_params, self.x_obs)
-                        c_mod = cos_model(cos_params, self.x_obs)
+                            s_mod = sin_model(sin_params, self.x_obs)
+                            c_mod = cos_model(cos_params, self.x_obs)
 
-                        mu_model += s_mod
-                        mu_model += c_mod
+                            mu_model += s_mod
+                            mu_model += c_mod
 
-                        # save model components (rot and orb) for plotting
-                        pm.Deterministic(
-                            "mu_{}sin{}".format(k,ix), s_mod
-                        )
-                        pm.Deterministic(
-                            "mu_{}cos{}".format(k,ix), c_mod
-                        )
+                            # save model components (rot and orb) for plotting
+                            pm.Deterministic(
+                                "mu_{}sin{}".format(k,ix), s_mod
+                            )
+                            pm.Deterministic(
+                                "mu_{}cos{}".format(k,ix), c_mod
+                            )
 
             # track the total model to plot it
             pm.Deterministic("mu_model", mu_model)
@@ -355,39 +361,258 @@ class ModelFitter(ModelParser):
             likelihood = pm.Normal('obs', mu=mu_model, sigma=sigma,
                                    observed=self.y_obs)
 
+        return model
+
+
+    def _add_vector_amplitudes(self, k, N_harmonics, prior_d, A_d, B_d):
+        """
+        One shape-N_harmonics random variable each for the sine ("A{k}") and
+        cosine ("B{k}") amplitudes of frequency k ('orb' or 'rot'), with the
+        per-harmonic bounds of the scalar parameterization.
+        """
+        if N_harmonics == 0:
+            return A_d, B_d
+
+        for L, d in zip(['A', 'B'], [A_d, B_d]):
+            key = '{}{}'.format(L, k)
+            prior = np.array([prior_d['{}{}{}'.format(L, k, ix)]
+                              for ix in range(N_harmonics)])
+
+            if LINEAR_AMPLITUDES:
+                d[key] = pm.Uniform(
+                    key, lower=-2*np.abs(prior), upper=2*np.abs(prior),
+                    shape=N_harmonics, testval=np.abs(prior)
+                )
+
+            if LOG_AMPLITUDES:
+                mfact = 3 if k == 'rot' else 10
+                logkey = 'log{}'.format(key)
+                _logamp = pm.Uniform(
+                    logkey, lower=np.log(prior/mfact),
+                    upper=np.log(mfact*prior), shape=N_harmonics,
+                    testval=np.log(prior)
+                )
+                d[key] = pm.Deterministic(key, pm.math.exp(_logamp))
+
+        return A_d, B_d
+
+
+    def _vector_harmonic_model(self, k, N_harmonics, harmonic_d):
+        """
+        Σ_n A_n sin(n*ωt + φ) + B_n cos(n*ωt + φ), evaluated as (N_harmonics
+        x N_obs) arrays, and summed over harmonics. The per-harmonic
+        components are saved as the "mu_{k}sin" and "mu_{k}cos"
+        Deterministics, for plotting.
+        """
+        A = harmonic_d['A{}'.format(k)]
+        B = harmonic_d['B{}'.format(k)]
+        omega = harmonic_d['omega{}'.format(k)]
+        phi = harmonic_d['phi{}'.format(k)]
+
+        # harmonic multipliers, times the time grid.
+        mult_t = np.arange(1, N_harmonics+1)[:, None] * self.x_obs[None, :]
+        arg = omega*mult_t + phi
+
+        s_mod = A[:, None] * pm.math.sin(arg)
+        c_mod = B[:, None] * pm.math.cos(arg)
+
+        pm.Deterministic("mu_{}sin".format(k), s_mod)
+        pm.Deterministic("mu_{}cos".format(k), c_mod)
+
+        return (s_mod + c_mod).sum(axis=0)
+
+
+class ModelFitter(ModelBuilder):
+    """
+    Given a modelid of the form "transit_NsincosPorb_NsincosProt", and
+    observed x and y values (typically time and flux), construct and
+    fit the model. In other words, run the inference.
+
+    The model implemented is of the form
+
+    Y ~ N(
+    [Mandel-Agol transit] +
+    Σ_n A_n sin(n*ωt + φ) +
+    Σ_n A_n cos(n*ωt + φ),
+    σ^2).
+
+    With SHARED_MEMORY_CHAINS (the default), the chains, and the
+    billy.multistart optimizations if N_starts is given, run in
+    "spawn"-started worker processes, which re-import the caller's main
+    module. A calling script must therefore be importable without side
+    effects, with its fitting behind `if __name__ == "__main__":`;
+    otherwise every worker would rerun it.
+    """
+
+    def __init__(self, modelid, x_obs, y_obs, y_err, prior_d,
+                 N_samples=2000, N_cores=16, N_chains=4,
+                 plotdir=None, pklpath=None, overwrite=1, figqueue=None,
+                 resultsdb=None, run_id=None, target=None, tuningpath=None,
+                 N_retune=200, hessian_init=0, N_hessian_tune=500,
+                 N_starts=None, N_modes=1):
+
+        self.N_samples = N_samples
+        self.N_cores = N_cores
+        self.N_chains = N_chains
+        self.PLOTDIR = plotdir
+        self.OVERWRITE = overwrite
+        self.figqueue = figqueue
+        # if a billy.resultsdb.ResultsDB is given, new inferences are
+        # recorded in it under (run_id, target, modelid).
+        if resultsdb is not None and (run_id is None or target is None):
+            raise ValueError(
+                'recording in a resultsdb needs both run_id and target'
+            )
+        self.resultsdb = resultsdb
+        self.run_id = run_id
+        self.target = target
+        # if the billy.tuning file of an earlier fit of this modelid is
+        # given, start from its mass matrix and step size, and tune for only
+        # N_retune iterations.
+        self.tuningpath = tuningpath
+        self.N_retune = N_retune
+        # otherwise, if hessian_init, start from the inverse Hessian at the
+        # MAP, and tune for N_hessian_tune iterations.
+        self.hessian_init = hessian_init
+        self.N_hessian_tune = N_hessian_tune
+        # if N_starts, the MAP is the best of a billy.multistart search from
+        # N_starts prior draws, and the chains start from the top N_modes
+        # modes in turn.
+        self.N_starts = N_starts
+        self.N_modes = N_modes
+        self.x_obs = x_obs
+        self.y_obs = y_obs
+        self.y_err = y_err
+        self.t_exp = np.nanmedian(np.diff(x_obs))
+
+        self.initialize_model(modelid)
+        self.verify_inputdata()
+        self.run_inference(prior_d, pklpath, make_threadsafe=True)
+
+
+    def verify_inputdata(self):
+        assert len(self.x_obs) == len(self.y_obs)
+        assert isinstance(self.x_obs, np.ndarray)
+        assert isinstance(self.y_obs, np.ndarray)
+
+
+    def run_inference(self, prior_d, pklpath, make_threadsafe=True):
+
+        # if the model has already been run, pull the result from the
+        # pickle. otherwise, run it.
+        if os.path.exists(pklpath):
+            d = pickle.load(open(pklpath, 'rb'))
+            self.model = d['model']
+            self.trace = HarmonicTrace(d['trace'])
+            self.map_estimate = expand_point(d['map_estimate'])
+            return 1
+
+        model = self._build_model(prior_d)
+
+        with model:
+
             # Get MAP estimate from model.
-            map_estimate = pm.find_MAP(model=model)
+            t_start = time.time()
+            if self.N_starts:
+                ms = multistart_map(
+                    self, model, prior_d, N_starts=self.N_starts,
+                    N_workers=self.N_cores,
+                    outpath=pklpath.replace('.pkl', '_multistart.pkl')
+                )
+                modes = ms['modes'][:self.N_modes]
+                # polish the best mode here, for its Deterministics.
+                map_estimate = pm.find_MAP(start=modes[0]['point'],
+                                           model=model)
+                starts = [map_estimate] + [m['point'] for m in modes[1:]]
+            else:
+                map_estimate = pm.find_MAP(model=model)
+                starts = [map_estimate]
+            map_sec = time.time() - t_start
 
             # Plot the simulated data and the maximum a posteriori model to
             # make sure that our initialization looks ok.
             self.y_MAP = map_estimate['mu_model'].flatten()
 
-            if make_threadsafe:
+            if (make_threadsafe and self.figqueue is not None and
+                self.PLOTDIR is not None):
+                # rendered in a spawned billy.figurequeue worker, which shares
+                # no matplotlib state with the sampler's child processes.
+                outpath = os.path.join(self.PLOTDIR,
+                                       'test_{}_MAP.png'.format(self.modelid))
+                self.figqueue.submit('plot_MAP_data', self.x_obs, self.y_obs,
+                                     self.y_MAP, outpath)
+            elif make_threadsafe and not SHARED_MEMORY_CHAINS:
+                pass
+            elif SHARED_MEMORY_CHAINS and self.PLOTDIR is None:
                 pass
             else:
                 # as described in
                 # https://github.com/matplotlib/matplotlib/issues/15410
                 # matplotlib is not threadsafe. so do not make plots before
                 # sampling, because some child processes tries to close a
-                # cached file, and crashes the sampler.
+                # cached file, and crashes the sampler. (the chainpool
+                # workers are spawned, not forked, so this is safe there.)
                 if self.PLOTDIR is None:
                     raise NotImplementedError
                 outpath = os.path.join(self.PLOTDIR,
                                        'test_{}_MAP.png'.format(self.modelid))
                 plot_MAP_data(self.x_obs, self.y_obs, self.y_MAP, outpath)
 
+            tuning = load_tuning(self.tuningpath, model, self.modelid)
+            N_tune = self.N_samples
+            if tuning is not None:
+                N_tune = min(self.N_retune, self.N_samples)
+                print('reusing {}: tuning for {} rather than {} iterations '
+                      '({} saved over {} chains)'.format(
+                          self.tuningpath, N_tune, self.N_samples,
+                          (self.N_samples - N_tune)*self.N_chains,
+                          self.N_chains))
+            elif self.hessian_init:
+                tuning = get_hessian_tuning(model, map_estimate)
+                N_tune = min(self.N_hessian_tune, self.N_samples)
+
             # sample from the posterior defined by this model.
-            trace = pm.sample(
-                tune=self.N_samples, draws=self.N_samples,
-                start=map_estimate, cores=self.N_cores,
-                chains=self.N_chains,
-                step=xo.get_dense_nuts_step(target_accept=0.9),
+            t_start = time.time()
+            if SHARED_MEMORY_CHAINS:
+                trace = sample_chains(
+                    self, model, prior_d, starts,
+                    tune=N_tune, draws=self.N_samples,
+                    N_chains=self.N_chains, N_cores=self.N_cores,
+                    step_kwargs={'target_accept': 0.9}, tuning=tuning
+                )
+            else:
+                step = (
+                    xo.get_dense_nuts_step(target_accept=0.9)
+                    if tuning is None else
+                    get_tuned_step(model, tuning, target_accept=0.9)
+                )
+                trace = pm.sample(
+                    tune=N_tune, draws=self.N_samples,
+                    start=[starts[c % len(starts)]
+                           for c in range(self.N_chains)],
+                    cores=self.N_cores,
+                    chains=self.N_chains, step=step,
+                )
+            sample_sec = time.time() - t_start
+            self.map_sec, self.sample_sec, self.N_tune = (
+                map_sec, sample_sec, N_tune
             )
 
+            save_tuning(trace, model, self.modelid, get_tuningpath(pklpath),
+                        n_tune=N_tune)
+
         with open(pklpath, 'wb') as buff:
             pickle.dump({'model': model, 'trace': trace,
                          'map_estimate': map_estimate}, buff)
 
+        if self.resultsdb is not None:
+            self.resultsdb.record_run(
+                self.run_id, self.target, self.modelid,
+                n_data=len(self.x_obs), n_samples=self.N_samples,
+                n_chains=self.N_chains, n_cores=self.N_cores,
+                map_sec=map_sec, sample_sec=sample_sec, pklpath=pklpath
+            )
+
         self.model = model
-        self.trace = trace
-        self.map_estimate = map_estimate
+        self.trace = HarmonicTrace(trace)
+        self.map_estimate = expand_point(map_estimate)
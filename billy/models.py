@@ -1,21 +1,157 @@
+"""
+Model functions. Each takes a parameter list and a time (or epoch) array.
+
+The parameters can be scalars (or theano variables, inside a pm.Model), or
+stacked arrays of n_draws values each, in which case the output broadcasts
+to (n_draws x n_times). A 2-D array of shape (n_draws x n_params) can also
+be passed in place of the list. For large batches, `evaluate_in_chunks`
+bounds the memory of the intermediate arrays, optionally in float32.
+
+    sin_model, cos_model: one sinusoid
+    harmonic_model: Σ_n A_n sin(n ω t + φ) + B_n cos(n ω t + φ), for all
+        harmonics at once
+    transit_model, transit_model_batch: exoplanet light curves
+    linear_model, quadratic_model: ephemerides
+"""
 import numpy as np
 import exoplanet as xo
 
+
+def _col(p):
+    """
+    Stacked (n_draws) parameter values -> (n_draws x 1) column, so that they
+    broadcast against the time axis. Scalars and theano variables are
+    returned unchanged.
+    """
+    if isinstance(p, (np.ndarray, list, tuple)) and np.ndim(p) >= 1:
+        return np.asarray(p)[:, None]
+    return p
+
+
+def _unpack(params):
+    if isinstance(params, np.ndarray) and params.ndim == 2:
+        return list(params.T)
+    return list(params)
+
+
 def sin_model(params, t):
-    A = params[0]
-    ω = params[1]
-    φ = params[2]
+    A, ω, φ = [_col(p) for p in _unpack(params)]
     return A * np.sin(ω*t + φ)
 
 
 def cos_model(params, t):
-    B = params[0]
-    ω = params[1]
-    φ = params[2]
+    B, ω, φ = [_col(p) for p in _unpack(params)]
     return B * np.cos(ω*t + φ)
 
 
+def harmonic_model(params, t, return_components=False):
+    """
+    params: (A, B, ω, φ), with A and B the sine and cosine amplitudes of
+    each harmonic, shape (N) or (n_draws x N), and ω and φ scalars or
+    (n_draws).
+
+    Returns Σ_n A_n sin(n ω t + φ) + B_n cos(n ω t + φ), summed over n = 1..N
+    (the ix'th amplitude is harmonic ix+1, as in ModelFitter).
+
+    sin(ωt) and cos(ωt) are evaluated once; the higher harmonics follow from
+    the angle-addition recurrence
+
+        sin((n+1)θ) = sin(nθ) cos θ + cos(nθ) sin θ
+        cos((n+1)θ) = cos(nθ) cos θ - sin(nθ) sin θ,
+
+    and the phase is applied per draw. If `return_components`, also returns
+    the (N x ...) sine and cosine terms, as in the "mu_orbsin" and
+    "mu_orbcos" Deterministics.
+    """
+    A, B, ω, φ = params
+    A, B = np.asarray(A), np.asarray(B)
+    batched = A.ndim == 2
+    N = A.shape[-1]
+
+    θ = _col(ω)*t if batched else ω*t
+    s1, c1 = np.sin(θ), np.cos(θ)
+    sφ, cφ = np.sin(_col(φ) if batched else φ), np.cos(_col(φ) if batched else φ)
+
+    # batched amplitudes set the draws axis even if ω and φ are scalars.
+    shape = (np.broadcast(θ, sφ, A[:, :1]) if batched else
+             np.broadcast(θ, sφ)).shape
+    y = np.zeros(shape, dtype=np.result_type(θ, A, B))
+    s_comps, c_comps = [], []
+    s_n, c_n = s1, c1
+    for ix in range(N):
+        if ix > 0:
+            s_n, c_n = s_n*c1 + c_n*s1, c_n*c1 - s_n*s1
+        a = A[:, ix:ix+1] if batched else A[ix]
+        b = B[:, ix:ix+1] if batched else B[ix]
+        s_term = a * (s_n*cφ + c_n*sφ)
+        c_term = b * (c_n*cφ - s_n*sφ)
+        y += s_term + c_term
+        if return_components:
+            s_comps.append(s_term)
+            c_comps.append(c_term)
+
+    if return_components:
+        return y, np.array(s_comps), np.array(c_comps)
+    return y
+
+
+def evaluate_in_chunks(model, params, t, max_bytes=256*2**20,
+                       dtype=np.float64, out=None, **kwargs):
+    """
+    Evaluate `model(params, t, **kwargs)` for stacked parameters, in chunks
+    of draws small enough that each (chunk x n_times) intermediate array
+    fits in about max_bytes/4.
+
+    params: list of per-parameter arrays (leading axis n_draws; these are
+        sliced, and anything else is shared by every chunk), or an
+        (n_draws x n_params) array.
+    dtype: np.float32 halves the memory and roughly doubles the throughput.
+        Phases are then good to ~1e-7 of ωt, so subtract a reference time
+        from long baselines first.
+    out: optional preallocated (n_draws x n_times) array, e.g., a memmap.
+
+    Returns the (n_draws x n_times) array.
+    """
+    params = _unpack(params)
+    t = np.asarray(t, dtype=dtype)
+    # with only scalar params, there is a single draw.
+    n_draws = max(
+        [np.shape(p)[0] for p in params
+         if isinstance(p, (np.ndarray, list, tuple)) and np.ndim(p) >= 1],
+        default=1
+    )
+    params = [
+        np.asarray(p, dtype=dtype)
+        if isinstance(p, (np.ndarray, list, tuple)) else dtype(p)
+        for p in params
+    ]
+
+    itemsize = np.dtype(dtype).itemsize
+    chunksize = max(1, int(max_bytes // (4*len(t)*itemsize)))
+
+    if out is None:
+        out = np.empty((n_draws, len(t)), dtype=dtype)
+
+    for i0 in range(0, n_draws, chunksize):
+        sl = slice(i0, i0+chunksize)
+        _params = [
+            p[sl] if (np.ndim(p) >= 1 and np.shape(p)[0] == n_draws) else p
+            for p in params
+        ]
+        out[sl] = model(_params, t, **kwargs)
+
+    return out
+
+
 def transit_model(params, t, texp=30/(60*24), mstar=1, rstar=1):
+    """
+    params: (period, t0, r, b, u, mean), with u the two quadratic
+    limb-darkening coefficients.
+
+    With numeric params, this is evaluated by the compiled, cached
+    transit_model_batch. If any param is a theano variable, the graph is built
+    and evaluated directly.
+    """
     period = params[0]
     t0 = params[1]
     r = params[2]
@@ -23,6 +159,18 @@ def transit_model(params, t, texp=30/(60*24), mstar=1, rstar=1):
     u = params[4]
     mean = params[5]
 
+    # u may be a theano vector itself, which cannot be iterated, or a list
+    # that holds theano scalars.
+    symbolic = (
+        any(_is_symbolic(p) for p in [period, t0, r, b, mean, u]) or
+        (isinstance(u, (list, tuple)) and any(_is_symbolic(p) for p in u))
+    )
+    if not symbolic:
+        return transit_model_batch(
+            [period], [t0], [r], [b], [u], [mean], t, texp=texp, mstar=mstar,
+            rstar=rstar
+        )[0]
+
     orbit = xo.orbits.KeplerianOrbit(period=period, t0=t0, b=b, mstar=mstar,
                                      rstar=rstar)
 
@@ -34,6 +182,82 @@ def transit_model(params, t, texp=30/(60*24), mstar=1, rstar=1):
     )
 
 
+def _is_symbolic(p):
+    import theano
+    return isinstance(p, theano.gof.Variable)
+
+
+# compiled transit evaluators, keyed by (n_times, texp, mstar, rstar).
+_TRANSIT_FUNCTIONS = {}
+
+
+def get_transit_function(n_times, texp=30/(60*24), mstar=1, rstar=1):
+    """
+    Compile (once per key) a theano function
+
+        f(t, period, t0, r, b, u) -> (n_planets x n_times) transit signals
+
+    for vectors period, t0, r, b (one entry per light curve, evaluated as the
+    "planets" dimension of a single exoplanet orbit) and a shared
+    two-element u.
+    """
+    key = (int(n_times), None if texp is None else float(texp),
+           float(mstar), float(rstar))
+
+    if key not in _TRANSIT_FUNCTIONS:
+        import theano, theano.tensor as tt
+
+        t = tt.dvector('t')
+        period, t0 = tt.dvector('period'), tt.dvector('t0')
+        r, b = tt.dvector('r'), tt.dvector('b')
+        u = tt.dvector('u')
+
+        orbit = xo.orbits.KeplerianOrbit(period=period, t0=t0, b=b,
+                                         mstar=mstar, rstar=rstar)
+        lc = xo.LimbDarkLightCurve(u).get_light_curve(
+            orbit=orbit, r=r, t=t, texp=texp
+        )
+        _TRANSIT_FUNCTIONS[key] = theano.function(
+            [t, period, t0, r, b, u], lc.T
+        )
+
+    return _TRANSIT_FUNCTIONS[key]
+
+
+def transit_model_batch(period, t0, r, b, u, mean, t, texp=30/(60*24),
+                        mstar=1, rstar=1, chunksize=1000):
+    """
+    Evaluate many transit light curves on one time grid.
+
+    period, t0, r, b, mean: (n_params) arrays.
+    u: (n_params x 2) array, or a single (2) pair shared by all.
+
+    Light curves that share u are evaluated together, `chunksize` at a time,
+    by a single call to the cached compiled function (see
+    get_transit_function). Returns an (n_params x n_times) array.
+    """
+    period, t0, r, b, mean = [
+        np.atleast_1d(np.asarray(x, dtype=float))
+        for x in (period, t0, r, b, mean)
+    ]
+    t = np.asarray(t, dtype=float)
+    u = np.asarray(u, dtype=float)
+    if u.ndim == 1:
+        u = np.broadcast_to(u, (len(period), 2))
+
+    f = get_transit_function(len(t), texp=texp, mstar=mstar, rstar=rstar)
+
+    out = np.empty((len(period), len(t)))
+    u_unique, u_inv = np.unique(u, axis=0, return_inverse=True)
+    for ix, _u in enumerate(u_unique):
+        inds = np.flatnonzero(u_inv.ravel() == ix)
+        for i0 in range(0, len(inds), chunksize):
+            sel = inds[i0:i0+chunksize]
+            out[sel] = f(t, period[sel], t0[sel], r[sel], b[sel], _u)
+
+    return out + mean[:, None]
+
+
 def linear_model(params, x, x_occ=None):
     """
     Linear model. Parameters (t0, P).
@@ -42,7 +266,7 @@ def linear_model(params, x, x_occ=None):
     If x_occ is none, returns model t_tra array.
     If x_occ is a numpy array, returns tuple of model t_tra and t_occ arrays.
     """
-    t0, period = params
+    t0, period = [_col(p) for p in _unpack(params)]
     if not isinstance(x_occ,np.ndarray):
         return t0 + period*x
     else:
@@ -57,7 +281,7 @@ def quadratic_model(params, x, x_occ=None):
     If x_occ is none, returns model t_tra array.
     If x_occ is a numpy array, returns tuple of model t_tra and t_occ arrays.
     """
-    t0, period, half_dP_dE = params
+    t0, period, half_dP_dE = [_col(p) for p in _unpack(params)]
     if not isinstance(x_occ,np.ndarray):
         return t0 + period*x + half_dP_dE*x**2
     else:
@@ -0,0 +1,216 @@
+"""
+Multi-start MAP optimization.
+
+pm.find_MAP from the single test point of prior_d can land in the wrong
+mode: the harmonic phases, and the phirot window of ±π/8, make the posterior
+multimodal. `multistart_map` instead:
+
+    * draws N_starts starting points from the model's priors,
+    * optimizes them in parallel "spawn"-started workers, each of which
+      rebuilds the model once from its specification (ModelBuilder, with the
+      observed data read from shared memory, as in billy.chainpool) and runs
+      pm.find_MAP from each of its starts,
+    * deduplicates the converged optima (same log posterior, and the same
+      location in the sampled space, to within a fraction of the posterior
+      width), and ranks the
+      distinct modes by log posterior,
+    * saves every optimum and mode to a pickle.
+
+ModelFitter(..., N_starts=64) uses the best mode as its MAP estimate; with
+N_modes > 1, its chains start from the top N_modes modes in turn.
+"""
+import pickle
+import numpy as np, pandas as pd
+import multiprocessing as mp
+from time import time
+from concurrent.futures import ProcessPoolExecutor
+
+from billy.chainpool import _SharedArrays, _attach, _get_bijection
+from billy.tuning import get_hessian_tuning
+
+
+def _get_freenames(model):
+    """
+    Untransformed names of the free random variables (e.g., "mean", not
+    "mean_interval__"), which is what find_MAP accepts as a start.
+    """
+    import pymc3 as pm
+    names = []
+    for v in model.free_RVs:
+        name = v.name
+        if pm.util.is_transformed_name(name):
+            name = pm.util.get_untransformed_name(name)
+        names.append(name)
+    return names
+
+
+def draw_starts(model, N_starts, seed=None):
+    """
+    N_starts prior draws of the free variables, as a list of points.
+    """
+    import pymc3 as pm
+    names = _get_freenames(model)
+    prior = pm.sample_prior_predictive(samples=N_starts, model=model,
+                                       var_names=names, random_seed=seed)
+    return [
+        {k: np.asarray(prior[k][ix]) for k in names}
+        for ix in range(N_starts)
+    ]
+
+
+def _optimize_starts(spec, start_ixs, starts):
+    """
+    Worker: rebuild the model, then find the MAP from each start. Returns
+    one dict per start, with its start index, the optimum (free variables,
+    in the sampled and the untransformed space), and its log posterior.
+    """
+    import pymc3 as pm
+    from billy.modelfitter import ModelBuilder
+
+    handles = []
+    a = {}
+    out = []
+    try:
+        for k in ['x_obs', 'y_obs', 'y_err']:
+            a[k] = _attach(spec[k], handles)
+
+        mb = ModelBuilder(spec['modelid'], np.array(a['x_obs']),
+                          np.array(a['y_obs']), np.array(a['y_err']),
+                          t_exp=spec['t_exp'])
+        model = mb._build_model(spec['prior_d'])
+        sampled = [v.name for v in model.vars]
+        keep = sampled + [k for k in _get_freenames(model)
+                          if k not in sampled]
+
+        for ix, start in zip(start_ixs, starts):
+            t_start = time()
+            try:
+                with model:
+                    point = pm.find_MAP(start=start, model=model,
+                                        progressbar=False)
+                point = {k: np.asarray(point[k]) for k in keep}
+                out.append({'start_ix': ix, 'point': point,
+                            'logp': float(model.logp(
+                                {k: point[k] for k in sampled})),
+                            'ok': True,
+                            'sec': time() - t_start})
+            except Exception as e:
+                out.append({'start_ix': ix, 'point': None, 'logp': -np.inf,
+                            'ok': False, 'error': repr(e),
+                            'sec': time() - t_start})
+    finally:
+        a.clear()
+        for shm in handles:
+            try:
+                shm.close()
+            except BufferError:
+                pass
+
+    return out
+
+
+def dedupe_optima(optima, bij, scale, logp_tol=1e-2, x_tol=0.1):
+    """
+    Group optima (sorted by decreasing logp) into modes: an optimum joins
+    the first mode whose logp is within logp_tol, and whose location in
+    the sampled space is within x_tol (in units of `scale`, per dimension).
+
+    Returns a list of modes, each a dict with the point and logp of its best
+    optimum, and the start indices that converged to it.
+    """
+    modes = []
+    for o in optima:
+        x = bij.map(o['point'])
+        for mode in modes:
+            if (np.abs(mode['logp'] - o['logp']) < logp_tol and
+                np.max(np.abs(mode['x'] - x)/scale) < x_tol):
+                mode['start_ixs'].append(o['start_ix'])
+                break
+        else:
+            modes.append({'point': o['point'], 'logp': o['logp'], 'x': x,
+                          'start_ixs': [o['start_ix']]})
+    for mode in modes:
+        mode['N_converged'] = len(mode['start_ixs'])
+    return modes
+
+
+def multistart_map(builder, model, prior_d, N_starts=64, N_workers=8,
+                   seed=42, outpath=None, logp_tol=1e-2, x_tol=0.1,
+                   verbose=True):
+    """
+    builder: ModelBuilder (or ModelFitter) with modelid, x_obs, y_obs, y_err,
+        t_exp; model: the parent's builder._build_model(prior_d).
+
+    Returns a dict with "modes" (distinct optima, best first), "optima"
+    (every converged optimum, best first), "failed" (starts whose
+    optimization raised), and "summary" (a DataFrame of the modes). If
+    outpath is given, the dict is pickled there.
+    """
+    starts = draw_starts(model, N_starts, seed=seed)
+    # include the usual prior_d test point, so that the best mode is never
+    # worse than the single-start MAP.
+    starts = [dict(model.test_point)] + starts
+
+    shared = _SharedArrays()
+    b = {}
+    t_start = time()
+    try:
+        keys = {}
+        for k in ['x_obs', 'y_obs', 'y_err']:
+            b[k], keys[k] = shared.share(
+                np.asarray(getattr(builder, k), dtype=float)
+            )
+        spec = {'modelid': builder.modelid, 'prior_d': prior_d,
+                't_exp': builder.t_exp}
+        spec.update(keys)
+
+        # one batch of starts per worker, so each compiles the model once.
+        batches = np.array_split(np.arange(len(starts)), N_workers)
+        ctx = mp.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=N_workers, mp_context=ctx) as ex:
+            futures = [
+                ex.submit(_optimize_starts, spec, list(ixs),
+                          [starts[ix] for ix in ixs])
+                for ixs in batches if len(ixs)
+            ]
+            results = [r for f in futures for r in f.result()]
+    finally:
+        b.clear()
+        shared.close()
+
+    optima = sorted([r for r in results if r['ok']],
+                    key=lambda r: -r['logp'])
+    failed = [r for r in results if not r['ok']]
+    if len(optima) == 0:
+        raise RuntimeError('every multi-start optimization failed')
+
+    # distances are in units of the posterior width at the best optimum
+    # (from the inverse Hessian there).
+    bij = _get_bijection(model, optima[0]['point'])
+    cov = get_hessian_tuning(model, optima[0]['point'])['cov']
+    scale = np.sqrt(np.diag(cov))
+    modes = dedupe_optima(optima, bij, scale, logp_tol=logp_tol,
+                          x_tol=x_tol)
+
+    summary = pd.DataFrame([
+        {'mode': ix, 'logp': mode['logp'],
+         'd_logp': modes[0]['logp'] - mode['logp'],
+         'N_converged': mode['N_converged']}
+        for ix, mode in enumerate(modes)
+    ])
+
+    if verbose:
+        print('{} starts -> {} optima ({} failed) -> {} modes, in {:.0f} s'
+              .format(len(starts), len(optima), len(failed), len(modes),
+                      time() - t_start))
+        print(summary.head(10).to_string(index=False))
+
+    out = {'modes': modes, 'optima': optima, 'failed': failed,
+           'summary': summary, 'N_starts': len(starts)}
+    if outpath is not None:
+        with open(outpath, 'wb') as buff:
+            pickle.dump(out, buff)
+        if verbose:
+            print('wrote {}'.format(outpath))
+
+    return out
@@ -22,19 +22,26 @@ Plots:
     plot_brethren
 
 Convenience:
+    get_posterior_bands
+    get_splitsignal_map_ydict
     savefig
+    start_figwriter
+    flush_figwriter
     format_ax
 """
 import os, corner, pickle
 from glob import glob
 import numpy as np, matplotlib.pyplot as plt, pandas as pd
 from datetime import datetime
-from pymc3.backends.tracetab import trace_to_dataframe
 from itertools import product
+from collections import OrderedDict
 
 from billy.convenience import flatten as bflatten
 from billy.convenience import get_clean_ptfo_data
 from billy.models import linear_model
+from billy.posterior import (
+    get_scalar_varnames, get_samples, thin_to_ess, get_corner_histograms
+)
 
 from astrobase.lcmath import (
     phase_magseries, phase_bin_magseries, sigclip_magseries,
@@ -115,32 +122,50 @@ def plot_MAP_data(x_obs, y_obs, y_MAP, outpath, ms=4):
     savefig(fig, outpath, writepdf=0, dpi=300)
 
 
-def plot_sampleplot(m, outpath, N_samples=100, ms=4, malpha=1):
+def plot_sampleplot(m, outpath, N_samples=100, ms=4, malpha=1,
+                    quantiles=(0.025, 0.16, 0.84, 0.975), spaghetti=False):
+    """
+    Data, MAP model, and posterior model bands. The bands are quantiles of
+    `mu_model` computed over the full trace in one vectorized call, and drawn
+    as a few filled regions, so the rendering cost does not scale with
+    N_samples. If `spaghetti`, N_samples randomly drawn models are also
+    overplotted as a single LineCollection.
+    """
 
     if os.path.exists(outpath) and not m.OVERWRITE:
         return
 
+    from matplotlib.collections import LineCollection
+
     plt.close('all')
     fig, ax = plt.subplots(figsize=(14, 4))
-    ax.plot(m.x_obs, m.y_obs, ".k", ms=ms, label="data", zorder=N_samples+1,
+    ax.plot(m.x_obs, m.y_obs, ".k", ms=ms, label="data", zorder=4,
             alpha=malpha)
     ax.plot(m.x_obs, m.map_estimate['mu_model'], lw=0.5, label='MAP',
-            zorder=N_samples+2, color='C1', alpha=1)
-
-    np.random.seed(42)
-    y_mod_samples = (
-        m.trace.mu_model[
-            np.random.choice(
-                m.trace.mu_model.shape[0], N_samples, replace=False
-            ), :
-        ]
-    )
+            zorder=5, color='C1', alpha=1)
+
+    y_mod = m.trace.mu_model
+    bands = get_posterior_bands(y_mod, quantiles=quantiles)
+
+    # nested bands: outermost (widest) first, progressively more opaque.
+    N_bands = len(quantiles)//2
+    for ix in range(N_bands):
+        lo, hi = quantiles[ix], quantiles[-(ix+1)]
+        ax.fill_between(
+            m.x_obs, bands[lo], bands[hi], color='C0', alpha=0.2+0.2*ix,
+            linewidth=0, zorder=2+ix/N_bands, rasterized=True,
+            label='{:.0f}%'.format(100*(hi-lo))
+        )
 
-    for i in range(N_samples):
-        if i % 10 == 0:
-            print(i)
-        ax.plot(m.x_obs, y_mod_samples[i,:], color='C0', alpha=0.3,
-                rasterized=True, lw=0.5)
+    if spaghetti:
+        np.random.seed(42)
+        sel = np.random.choice(y_mod.shape[0], N_samples, replace=False)
+        segments = np.stack(
+            np.broadcast_arrays(m.x_obs[None, :], y_mod[sel, :]), axis=-1
+        )
+        lc = LineCollection(segments, colors='C0', alpha=0.3, linewidths=0.5,
+                            rasterized=True, zorder=3)
+        ax.add_collection(lc)
 
     ax.set_ylabel("relative flux")
     ax.set_xlabel("time [days]")
@@ -148,6 +173,17 @@ def plot_sampleplot(m, outpath, N_samples=100, ms=4, malpha=1):
     savefig(fig, outpath, writepdf=0, dpi=300)
 
 
+def get_posterior_bands(y_samples, quantiles=(0.025, 0.16, 0.84, 0.975)):
+    """
+    y_samples: (N_draws x N_times) array of posterior model draws.
+
+    Returns a dict keyed by quantile, with each value the (N_times) array of
+    that quantile across draws. Computed in a single np.quantile call.
+    """
+    qvals = np.quantile(y_samples, quantiles, axis=0)
+    return dict(zip(quantiles, qvals))
+
+
 def plot_splitsignal_map(m, outpath, part='i'):
     """
     y_obs + y_MAP + y_rot + y_orb
@@ -174,23 +210,8 @@ def plot_splitsignal_map(m, outpath, part='i'):
     axs[0].plot(m.x_obs[g], m.map_estimate['mu_model'][g], lw=0.5, label='MAP',
                 color='C0', alpha=1, zorder=1)
 
-    y_tra = m.map_estimate['mu_transit']
-    for ix, f in enumerate(['rot', 'orb']):
-        N_harmonics = int([c for c in m.modelcomponents if f in c][0][0])
-        yval = np.zeros_like(m.x_obs)
-        for n in range(N_harmonics):
-            k0 = "mu_{}sin{}".format(f,n)
-            k1 = "mu_{}cos{}".format(f,n)
-            yval += m.map_estimate[k0]
-            yval += m.map_estimate[k1]
-        if f == 'rot':
-            y_rot = yval
-            # axs[0].plot(m.x_obs, y_rot, lw=0.5, label='model '+f,
-            #             color='C{}'.format(ix+1), alpha=1, zorder=ix+3)
-        if f == 'orb':
-            y_orb = yval + y_tra
-            # axs[0].plot(m.x_obs, y_orb, lw=0.5, label='model '+f,
-            #             color='C{}'.format(ix+1), alpha=1, zorder=ix+3)
+    ydict = get_splitsignal_map_ydict(m)
+    y_rot, y_orb = ydict['y_mod_rot'], ydict['y_mod_orb']
 
     axs[1].set_ylabel('Longer period',
                       fontsize='x-large')
@@ -247,6 +268,31 @@ def plot_splitsignal_map(m, outpath, part='i'):
     if not os.path.exists(outpath) or m.OVERWRITE:
         savefig(fig, outpath, writepdf=1, dpi=300)
 
+    return ydict
+
+
+def get_splitsignal_map_ydict(m):
+    """
+    Split the MAP model into its transit, rotation, and orbital-frequency
+    parts. Returns the `ydict` consumed by plot_splitsignal_map_periodogram,
+    plot_phasefold_map, and convenience.get_bic. No plotting is done, so this
+    can be called before handing the plots off to a FigureQueue.
+    """
+
+    y_tra = m.map_estimate['mu_transit']
+    for ix, f in enumerate(['rot', 'orb']):
+        N_harmonics = int([c for c in m.modelcomponents if f in c][0][0])
+        yval = np.zeros_like(m.x_obs)
+        for n in range(N_harmonics):
+            k0 = "mu_{}sin{}".format(f,n)
+            k1 = "mu_{}cos{}".format(f,n)
+            yval += m.map_estimate[k0]
+            yval += m.map_estimate[k1]
+        if f == 'rot':
+            y_rot = yval
+        if f == 'orb':
+            y_orb = yval + y_tra
+
     ydict = {
         'x_obs': m.x_obs,
         'y_obs': m.y_obs,
@@ -581,33 +627,253 @@ def plot_phasefold_post(m, d, outpath):
 
 
 
-def plot_traceplot(m, outpath):
-    # trace plot from PyMC3
+def plot_traceplot(m, outpath, varnames=None):
+    # trace plot from PyMC3, of only the scalar parameters (not the
+    # per-timestamp Deterministics). PyMC3 needs the underlying MultiTrace,
+    # and so the vector harmonic names ("Aorb", not "Aorb0").
+    import pymc3 as pm
+    trace = getattr(m.trace, 'raw', m.trace)
+    if varnames is None:
+        varnames = get_scalar_varnames(trace, N_obs=len(m.x_obs))
     if not os.path.exists(outpath):
         plt.figure(figsize=(7, 7))
-        pm.traceplot(m.trace[100:])
+        pm.traceplot(trace[100:], varnames=varnames)
         plt.tight_layout()
         plt.savefig(outpath)
         plt.close('all')
 
 
-def plot_cornerplot(true_d, m, outpath):
+def plot_completeness_map(frac, N, outpath, xlabel=None, ylabel=None):
+    """
+    frac, N: recovery fraction and number of injections per bin, as returned
+    by billy.injrecov.get_completeness (y bins as the index, x bins as the
+    columns).
+    """
+    plt.close('all')
+    fig, ax = plt.subplots(figsize=(4.5, 3.5))
+
+    im = ax.imshow(np.asarray(frac, dtype=float), origin='lower',
+                   aspect='auto', cmap='viridis', vmin=0, vmax=1)
+    for (iy, ix), n in np.ndenumerate(np.asarray(N)):
+        if np.isfinite(n) and n > 0:
+            ax.text(ix, iy, '{:.0f}'.format(n), ha='center', va='center',
+                    fontsize='xx-small', color='white')
+
+    ax.set_xticks(range(frac.shape[1]))
+    ax.set_xticklabels([str(c) for c in frac.columns], rotation=45,
+                       ha='right', fontsize='x-small')
+    ax.set_yticks(range(frac.shape[0]))
+    ax.set_yticklabels([str(c) for c in frac.index], fontsize='x-small')
+    ax.set_xlabel(frac.columns.name if xlabel is None else xlabel)
+    ax.set_ylabel(frac.index.name if ylabel is None else ylabel)
+
+    cb = fig.colorbar(im, ax=ax)
+    cb.set_label('fraction recovered')
+
+    fig.tight_layout()
+    savefig(fig, outpath, writepdf=0, dpi=300)
+
+
+def plot_rank_histograms(ranks, outpath, N_thin=99, N_bins=20):
+    """
+    One rank histogram per parameter of a billy.sbc run (`ranks` from
+    billy.sbc.get_rank_statistics), with the 99% band of bin counts expected
+    if the ranks are uniform on 0..N_thin.
+    """
+    from scipy import stats
+    from billy.sbc import get_paramcolumns
+
+    params = get_paramcolumns(ranks)
+    N_cols = 4
+    N_rows = int(np.ceil(len(params)/N_cols))
+    N_replicas = len(ranks)
+
+    edges = np.linspace(0, N_thin+1, N_bins+1)
+    p_bin = 1/N_bins
+    lo, hi = stats.binom.ppf([0.005, 0.995], N_replicas, p_bin)
+
+    plt.close('all')
+    fig, axs = plt.subplots(nrows=N_rows, ncols=N_cols,
+                            figsize=(2.5*N_cols, 2*N_rows), squeeze=False)
+
+    for ax, k in zip(axs.flatten(), params):
+        ax.fill_between([0, N_thin+1], lo, hi, color='gray', alpha=0.3,
+                        lw=0, zorder=1)
+        ax.axhline(N_replicas*p_bin, color='gray', lw=0.5, zorder=2)
+        ax.hist(np.asarray(ranks[k].dropna()), bins=edges, color='C0',
+                histtype='stepfilled', alpha=0.8, zorder=3)
+        ax.set_title(k, fontsize='small')
+        ax.set_xlim((0, N_thin+1))
+        ax.set_yticks([])
+        format_ax(ax)
+
+    for ax in axs.flatten()[len(params):]:
+        ax.axis('off')
+
+    fig.text(0.5, 0, 'rank of prior draw among {} posterior draws'.format(
+        N_thin), ha='center')
+    fig.tight_layout(h_pad=0.5, w_pad=0.5)
+    savefig(fig, outpath, writepdf=0, dpi=300)
+
+
+def plot_cornerplot(true_d, m, outpath, method='histogram', bins=30,
+                    thin='ess', N_workers=4):
+    """
+    Corner plot of the `true_d` parameters.
+
+    method: 'histogram' reads only the requested trace columns, optionally
+    thins them (thin='ess' for about one draw per effective sample, an int
+    for a target number of draws, or None), and draws precomputed 1-D and 2-D
+    histograms from billy.posterior.get_corner_histograms. 'corner' hands the
+    full set of draws to corner.corner.
+    """
 
     if os.path.exists(outpath) and not m.OVERWRITE:
         return
 
-    # corner plot of posterior samples
-    plt.close('all')
-    trace_df = trace_to_dataframe(m.trace, varnames=list(true_d.keys()))
     truths = [true_d[k] for k in true_d.keys()]
     truths = list(bflatten(truths))
-    fig = corner.corner(trace_df, quantiles=[0.16, 0.5, 0.84],
-                        show_titles=True, title_kwargs={"fontsize": 12},
-                        truths=truths, title_fmt='.2g')
+
+    if method == 'corner':
+        # corner plot of posterior samples
+        plt.close('all')
+        trace_df = _trace_to_dataframe(m.trace, list(true_d.keys()))
+        fig = corner.corner(trace_df, quantiles=[0.16, 0.5, 0.84],
+                            show_titles=True, title_kwargs={"fontsize": 12},
+                            truths=truths, title_fmt='.2g')
+        savefig(fig, outpath, writepdf=0, dpi=100)
+        return
+
+    names, samples = get_samples(m.trace, list(true_d.keys()))
+    if thin == 'ess':
+        samples = thin_to_ess(samples)
+    elif isinstance(thin, int):
+        samples = thin_to_ess(samples, target=thin)
+    print('{}: cornerplot from {} draws'.format(m.modelid, samples.shape[0]))
+
+    h = get_corner_histograms(samples, bins=bins, N_workers=N_workers)
+    q_lo, q_mid, q_hi = np.quantile(samples, [0.16, 0.5, 0.84], axis=0)
+
+    N_params = len(names)
+    plt.close('all')
+    fig, axs = plt.subplots(nrows=N_params, ncols=N_params,
+                            figsize=(2*N_params, 2*N_params))
+    axs = np.atleast_2d(axs)
+
+    for i, j in product(range(N_params), range(N_params)):
+
+        ax = axs[i, j]
+
+        if j > i:
+            ax.set_visible(False)
+            continue
+
+        if i == j:
+            ax.step(h['edges'][i], np.append(h['hist1d'][i], 0), where='post',
+                    color='k', lw=0.8)
+            for q in [q_lo[i], q_mid[i], q_hi[i]]:
+                ax.axvline(q, color='k', ls='--', lw=0.5)
+            ax.axvline(truths[i], color='C0', lw=1)
+            ax.set_yticks([])
+            ax.set_title('{} = {:.2g}$^{{+{:.2g}}}_{{-{:.2g}}}$'.format(
+                names[i], q_mid[i], q_hi[i]-q_mid[i], q_mid[i]-q_lo[i]),
+                fontsize='small')
+        else:
+            H = h['hist2d'][(j, i)]
+            xc = 0.5*(h['edges'][j][1:] + h['edges'][j][:-1])
+            yc = 0.5*(h['edges'][i][1:] + h['edges'][i][:-1])
+            levels = np.unique(h['levels'][(j, i)])
+            if len(levels) > 0 and levels[0] > 0:
+                ax.contourf(xc, yc, H, levels=np.append(levels, H.max()+1),
+                            colors=['0.7', '0.4'][-len(levels):], zorder=1)
+                ax.contour(xc, yc, H, levels=levels, colors='k',
+                           linewidths=0.5, zorder=2)
+            ax.axvline(truths[j], color='C0', lw=1)
+            ax.axhline(truths[i], color='C0', lw=1)
+            ax.plot(truths[j], truths[i], 's', color='C0', ms=2)
+
+        ax.set_xlim((h['edges'][j][0], h['edges'][j][-1]))
+        if i != j:
+            ax.set_ylim((h['edges'][i][0], h['edges'][i][-1]))
+
+        if i < N_params - 1:
+            ax.set_xticklabels([])
+        else:
+            ax.set_xlabel(names[j])
+            for t in ax.get_xticklabels():
+                t.set_rotation(45)
+        if j > 0 or i == 0:
+            ax.set_yticklabels([])
+        else:
+            ax.set_ylabel(names[i])
+
+    fig.subplots_adjust(hspace=0.05, wspace=0.05)
     savefig(fig, outpath, writepdf=0, dpi=100)
 
 
+def _trace_to_dataframe(trace, varnames):
+    """
+    Like pymc3's trace_to_dataframe, but only uses `trace[varname]` lookups,
+    so that it also works on the array-backed traces of
+    billy.figurequeue.ModelSnapshot. Vector-valued variables get columns
+    named "u__0", "u__1", ... following the pymc3 convention.
+    """
+    cols = OrderedDict()
+    for k in varnames:
+        vals = np.asarray(trace[k])
+        if vals.ndim == 1:
+            cols[k] = vals
+        else:
+            vals = vals.reshape(vals.shape[0], -1)
+            for ix in range(vals.shape[1]):
+                cols['{}__{}'.format(k, ix)] = vals[:, ix]
+    return pd.DataFrame(cols)
+
+
+_FIGWRITER = None
+
+def start_figwriter(maxsize=8):
+    """
+    Route subsequent savefig calls through a background
+    billy.figwriter.FigureWriter process. Call flush_figwriter at the end of
+    the driver to wait for the files to be written.
+    """
+    global _FIGWRITER
+    from billy.figwriter import FigureWriter
+    if _FIGWRITER is None:
+        _FIGWRITER = FigureWriter(maxsize=maxsize)
+    return _FIGWRITER
+
+
+def flush_figwriter(close=True):
+    """
+    Wait until every figure queued by savefig has been written. Returns the
+    list of (path, seconds, error) from FigureWriter.flush.
+    """
+    global _FIGWRITER
+    if _FIGWRITER is None:
+        return []
+    written = _FIGWRITER.flush()
+    if close:
+        _FIGWRITER.close()
+        _FIGWRITER = None
+    return written
+
+
 def savefig(fig, figpath, writepdf=True, dpi=450):
+
+    if _FIGWRITER is not None:
+        try:
+            _FIGWRITER.submit(fig, figpath, writepdf=writepdf, dpi=dpi)
+            print('{}: queued {}'.format(datetime.utcnow().isoformat(),
+                                         figpath))
+            plt.close('all')
+            return
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            # e.g., WCSAxes figures do not always pickle. write it here.
+            print('WRN! could not queue {} ({}), writing it directly'.
+                  format(figpath, repr(e)))
+
     fig.savefig(figpath, dpi=dpi, bbox_inches='tight')
     print('{}: made {}'.format(datetime.utcnow().isoformat(), figpath))
 
@@ -631,15 +897,25 @@ def format_ax(ax):
 
 
 def plot_scene(c_obj, img_wcs, img, outpath, Tmag_cutoff=17, showcolorbar=0,
-               ap_mask=0, bkgd_mask=0):
+               ap_mask=0, bkgd_mask=0, catalog=None, stamps=None):
+    """
+    catalog: billy.catalogcache.CatalogStore for the TIC neighbors, and
+    stamps: billy.catalogcache.StampCache for the DSS2 Red image. Both
+    default to the on-disk caches in ~/.billy/catalog-cache, which only go to
+    the network on a cache miss.
+    """
 
-    from astrobase.plotbase import skyview_stamp
     from astropy.wcs import WCS
-    from astroquery.mast import Catalogs
+    from billy.catalogcache import CatalogStore, StampCache
     import astropy.visualization as vis
     import matplotlib as mpl
     from matplotlib import patches
 
+    if catalog is None:
+        catalog = CatalogStore(catalog='TIC')
+    if stamps is None:
+        stamps = StampCache()
+
     plt.close('all')
 
     # standard tick formatting fails for these images.
@@ -653,10 +929,9 @@ def plot_scene(c_obj, img_wcs, img, outpath, Tmag_cutoff=17, showcolorbar=0,
     #
     radius = 5.0*u.arcminute
 
-    nbhr_stars = Catalogs.query_region(
-        "{} {}".format(float(c_obj.ra.value), float(c_obj.dec.value)),
-        catalog="TIC",
-        radius=radius
+    nbhr_stars = catalog.query_region(
+        float(c_obj.ra.value), float(c_obj.dec.value),
+        radius.to(u.deg).value
     )
 
     try:
@@ -691,25 +966,11 @@ def plot_scene(c_obj, img_wcs, img, outpath, Tmag_cutoff=17, showcolorbar=0,
     dec = c_obj.dec.value
     sizepix = 220
     try:
-        dss, dss_hdr = skyview_stamp(ra, dec, survey='DSS2 Red',
-                                     scaling='Linear', convolvewith=None,
-                                     sizepix=sizepix, flip=False,
-                                     cachedir='~/.astrobase/stamp-cache',
-                                     verbose=True, savewcsheader=True)
-    except (OSError, IndexError, TypeError) as e:
-        print('downloaded FITS appears to be corrupt, retrying...')
-        try:
-            dss, dss_hdr = skyview_stamp(ra, dec, survey='DSS2 Red',
-                                         scaling='Linear', convolvewith=None,
-                                         sizepix=sizepix, flip=False,
-                                         cachedir='~/.astrobase/stamp-cache',
-                                         verbose=True, savewcsheader=True,
-                                         forcefetch=True)
-
-        except Exception as e:
-            print('failed to get DSS stamp ra {} dec {}, error was {}'.
-                  format(ra, dec, repr(e)))
-            return None, None
+        dss, dss_hdr = stamps.get(ra, dec, survey='DSS2 Red', sizepix=sizepix)
+    except Exception as e:
+        print('failed to get DSS stamp ra {} dec {}, error was {}'.
+              format(ra, dec, repr(e)))
+        return None, None
 
 
     ##########################################
@@ -813,12 +1074,12 @@ def plot_scene(c_obj, img_wcs, img, outpath, Tmag_cutoff=17, showcolorbar=0,
 
 def plot_hr(outdir):
 
-    pklpath = '/Users/luke/Dropbox/proj/billy/results/cluster_membership/nbhd_info_3222255959210123904.pkl'
-    info = pickle.load(open(pklpath, 'rb'))
-    (targetname, groupname, group_df_dr2, target_df, nbhd_df,
-     cutoff_probability, pmdec_min, pmdec_max, pmra_min, pmra_max,
-     group_in_k13, group_in_cg18, group_in_kc19, group_in_k18
-    ) = info
+    from billy.gaiatables import load_nbhd_table
+
+    cols = ['bp_rp', 'M_G']
+    nbhd_df = load_nbhd_table('nbhd', columns=cols)
+    group_df_dr2 = load_nbhd_table('group', columns=cols)
+    target_df = load_nbhd_table('target', columns=cols)
 
     ##########
 
@@ -826,27 +1087,20 @@ def plot_hr(outdir):
 
     f, ax = plt.subplots(figsize=(4,3))
 
-    nbhd_yval = np.array([nbhd_df['phot_g_mean_mag'] +
-                          5*np.log10(nbhd_df['parallax']/1e3) + 5])
     ax.scatter(
-        nbhd_df['phot_bp_mean_mag']-nbhd_df['phot_rp_mean_mag'], nbhd_yval,
+        nbhd_df['bp_rp'], nbhd_df['M_G'],
         c='gray', alpha=1., zorder=2, s=7, rasterized=True, linewidths=0,
         label='Neighborhood', marker='.'
     )
 
-    yval = group_df_dr2['phot_g_mean_mag'] + 5*np.log10(group_df_dr2['parallax']/1e3) + 5
     ax.scatter(
-        group_df_dr2['phot_bp_mean_mag']-group_df_dr2['phot_rp_mean_mag'],
-        yval,
+        group_df_dr2['bp_rp'], group_df_dr2['M_G'],
         c='k', alpha=1., zorder=3, s=9, rasterized=True, linewidths=0,
         label='Members'
     )
 
-    target_yval = np.array([target_df['phot_g_mean_mag'] +
-                            5*np.log10(target_df['parallax']/1e3) + 5])
     ax.plot(
-        target_df['phot_bp_mean_mag']-target_df['phot_rp_mean_mag'],
-        target_yval,
+        target_df['bp_rp'], target_df['M_G'],
         alpha=1, mew=0.5, zorder=8, label='PTFO 8-8695', markerfacecolor='yellow',
         markersize=12, marker='*', color='black', lw=0
     )
@@ -875,24 +1129,13 @@ def plot_hr(outdir):
 
 def plot_astrometric_excess(outdir, ruwe=0):
 
-    varamppath = '/Users/luke/Dropbox/proj/billy/data/25ori-1/var_amps.csv'
-    va_df = pd.read_csv(varamppath)
+    from billy.gaiatables import load_nbhd_table
 
-    if not ruwe:
-        pklpath = '/Users/luke/Dropbox/proj/billy/results/cluster_membership/nbhd_info_3222255959210123904.pkl'
-        d = pickle.load(open(pklpath, 'rb'))
-        g_df = d[2]
-    else:
-        csvpath = '/Users/luke/Dropbox/proj/billy/results/cluster_membership/25ori-1_group_ruwe.csv'
-        g_df = pd.read_csv(csvpath)
-
-    g_df = g_df.merge(va_df, on='source_id', how='left')
-
-    chisq_red = g_df.astrometric_chi2_al / (g_df.astrometric_n_obs_al - 5)
-    if not ruwe:
-        yval = chisq_red
-    else:
-        yval = np.array(g_df.ruwe)
+    ycol = 'ruwe' if ruwe else 'chisq_red'
+    g_df = load_nbhd_table(
+        'group', columns=['source_id', 'phot_rp_mean_mag', 'var_amp', ycol]
+    )
+    yval = np.array(g_df[ycol])
 
     ######
 
@@ -902,7 +1145,7 @@ def plot_astrometric_excess(outdir, ruwe=0):
                marker='s', rasterized=True, linewidths=0, label='All members',
                alpha=1)
 
-    ptfosel = (g_df.source_id.astype(str) == '3222255959210123904')
+    ptfosel = np.array(g_df.source_id.astype(str) == '3222255959210123904')
     ptfo_amp = float(g_df[ptfosel].var_amp)
     sel = (g_df.var_amp > ptfo_amp)
 
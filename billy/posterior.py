@@ -0,0 +1,286 @@
+"""
+Array-level tools for working with posterior samples, without going through
+pymc3's DataFrame or arviz conversions.
+
+    get_scalar_varnames: names of the non-per-timestamp variables in a trace
+    get_samples: (N_draws x N_params) array of only the requested columns
+    get_ess: effective sample size of each column, in one FFT pass
+    thin_to_ess: thin draws to roughly one per effective sample
+    get_corner_histograms: 1-D and 2-D histograms + contour levels
+    get_hdi: highest-density intervals of each column
+    summarize: per-chain-parallel posterior summary of chosen variables,
+        in the format of pm.summary
+"""
+import numpy as np, pandas as pd
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+
+
+def get_scalar_varnames(trace, N_obs=None, include_transformed=False):
+    """
+    Variables in `trace` that are not per-timestamp Deterministics (e.g.,
+    "mu_model"). If N_obs is given, a variable is per-timestamp if any of its
+    dimensions has length N_obs; otherwise if its name starts with "mu_".
+    Transformed variables (e.g., "r_star_interval__") are dropped unless
+    `include_transformed`.
+    """
+    varnames = []
+    for k in trace.varnames:
+        if k.endswith('__') and not include_transformed:
+            continue
+        if N_obs is None:
+            if k.startswith('mu_'):
+                continue
+        else:
+            shape = np.shape(trace[k])[1:]
+            if N_obs in shape:
+                continue
+        varnames.append(k)
+    return varnames
+
+
+def get_samples(trace, varnames):
+    """
+    Read only the `varnames` columns of the trace. Vector-valued variables
+    are expanded into "u__0", "u__1", ... following the pymc3 convention.
+
+    Returns (names, samples), with samples a (N_draws x N_params) array.
+    """
+    names, cols = [], []
+    for k in varnames:
+        vals = np.asarray(trace[k])
+        if vals.ndim == 1:
+            names.append(k)
+            cols.append(vals[:, None])
+        else:
+            vals = vals.reshape(vals.shape[0], -1)
+            names.extend(['{}__{}'.format(k, ix) for ix in range(vals.shape[1])])
+            cols.append(vals)
+    return names, np.hstack(cols)
+
+
+def get_ess(samples):
+    """
+    Effective sample size of each column of a (N_draws x N_params) array.
+
+    The autocorrelation of all columns is computed in one FFT, and summed
+    using Geyer's initial positive sequence: pairs of consecutive
+    autocorrelations are accumulated until the first negative pair.
+    """
+    x = np.asarray(samples, dtype=float)
+    if x.ndim == 1:
+        x = x[:, None]
+    N = x.shape[0]
+
+    x = x - x.mean(axis=0)
+    n_fft = 2**int(np.ceil(np.log2(2*N)))
+    f = np.fft.rfft(x, n=n_fft, axis=0)
+    acov = np.fft.irfft(f * np.conjugate(f), n=n_fft, axis=0)[:N]
+    var = acov[0]
+    var[var == 0] = np.inf
+    rho = acov / var
+
+    N_pairs = N//2
+    pairs = rho[:2*N_pairs:2] + rho[1:2*N_pairs:2]
+    positive = np.cumprod(pairs > 0, axis=0).astype(bool)
+    tau = -1 + 2*np.sum(np.where(positive, pairs, 0), axis=0)
+    tau = np.maximum(tau, 1/np.log10(N)) if N > 1 else np.ones_like(tau)
+
+    return N / tau
+
+
+def thin_to_ess(samples, target=None):
+    """
+    Thin the draws to about one per effective sample of the worst-mixing
+    column, or to `target` draws if given. Returns the thinned array.
+    """
+    N = samples.shape[0]
+    if target is None:
+        target = np.nanmin(get_ess(samples))
+    stride = max(int(N // max(target, 1)), 1)
+    return samples[::stride]
+
+
+def _get_levels(H, sigmas=(1, 2)):
+    """
+    Density thresholds enclosing the 2-D gaussian-equivalent probability mass
+    of each of `sigmas` (e.g., 39% and 86% for 1 and 2 sigma, as in corner).
+    """
+    Hflat = np.sort(H.ravel())[::-1]
+    cdf = np.cumsum(Hflat)
+    if cdf[-1] == 0:
+        return np.zeros(len(sigmas))
+    cdf /= cdf[-1]
+    masses = 1 - np.exp(-0.5*np.array(sigmas)**2)
+    levels = Hflat[np.searchsorted(cdf, masses).clip(0, len(Hflat)-1)]
+    return np.sort(levels)
+
+
+def get_corner_histograms(samples, bins=30, ranges=None, N_workers=4,
+                          sigmas=(1, 2)):
+    """
+    samples: (N_draws x N_params) array.
+
+    The bin index of every sample in every column is computed once, in a
+    single vectorized step. The 1-D histograms are then bincounts of each
+    column, and the 2-D histogram of each pair (i, j) is a bincount of the
+    flattened index idx_i*bins + idx_j. The pairs are histogrammed in
+    parallel threads.
+
+    Returns a dict with keys "edges" (N_params x bins+1), "hist1d"
+    (N_params x bins), "hist2d" (dict of (i, j) -> bins x bins array, with
+    rows indexing parameter j, as for imshow / contour), and "levels" (dict
+    of (i, j) -> contour levels).
+    """
+    N_draws, N_params = samples.shape
+
+    if ranges is None:
+        lo, hi = np.nanmin(samples, axis=0), np.nanmax(samples, axis=0)
+    else:
+        lo, hi = np.array(ranges, dtype=float).T
+    span = np.where(hi > lo, hi - lo, 1)
+
+    idx = np.floor((samples - lo) / span * bins).astype(int)
+    idx = np.clip(idx, 0, bins-1)
+    edges = lo[:, None] + span[:, None] * np.linspace(0, 1, bins+1)[None, :]
+
+    hist1d = np.stack([
+        np.bincount(idx[:, i], minlength=bins) for i in range(N_params)
+    ])
+
+    def _hist2d(pair):
+        i, j = pair
+        H = np.bincount(idx[:, j]*bins + idx[:, i], minlength=bins*bins)
+        H = H.reshape(bins, bins)
+        return pair, H, _get_levels(H, sigmas=sigmas)
+
+    pairs = list(combinations(range(N_params), 2))
+    hist2d, levels = OrderedDict(), OrderedDict()
+    with ThreadPoolExecutor(max_workers=N_workers) as executor:
+        for pair, H, lev in executor.map(_hist2d, pairs):
+            hist2d[pair] = H
+            levels[pair] = lev
+
+    return {
+        'edges': edges,
+        'hist1d': hist1d,
+        'hist2d': hist2d,
+        'levels': levels
+    }
+
+
+def _get_chains(trace):
+    """
+    Chain ids of a pymc3 MultiTrace, or [None] for a dict-like trace
+    (treated as one chain).
+    """
+    if hasattr(trace, 'chains') and hasattr(trace, 'get_values'):
+        return list(trace.chains)
+    return [None]
+
+
+def _read_chain(trace, varname, chain):
+    """
+    (N_draws x ...) array of a single variable in a single chain.
+    """
+    if chain is None:
+        return np.asarray(trace[varname])
+    return np.asarray(
+        trace.get_values(varname, chains=[chain], combine=False)[0]
+    )
+
+
+def _get_chain_values(trace, varname):
+    """
+    (N_draws x ...) arrays of a single variable, yielded one chain at a
+    time, so that only one chain is held at once.
+    """
+    for c in _get_chains(trace):
+        yield _read_chain(trace, varname, c)
+
+
+def _get_point(trace, varnames, ix=0):
+    """
+    Values of `varnames` at draw ix (of the last chain, for a MultiTrace).
+    """
+    if hasattr(trace, 'point'):
+        point = trace.point(ix)
+        return {k: point[k] for k in varnames}
+    return {k: np.asarray(trace[k])[ix] for k in varnames}
+
+
+def _expand_names(varname, val):
+    """
+    Row names following pm.summary: "u[0]", "u[1]", ... for vector
+    variables; val is the variable's value at a single draw.
+    """
+    shape = np.shape(val)
+    if len(shape) == 0:
+        return [varname]
+    return [
+        '{}[{}]'.format(varname, ','.join(str(i) for i in ix))
+        for ix in np.ndindex(*shape)
+    ]
+
+
+def get_hdi(x, hdi_prob=0.94):
+    """
+    Highest-density interval of each column of a (N_draws x N_params) array:
+    the narrowest window containing hdi_prob of the sorted draws, found for
+    all columns at once. Returns (lower, upper).
+    """
+    x = np.sort(x, axis=0)
+    N = x.shape[0]
+    N_in = int(np.floor(hdi_prob*N))
+    widths = x[N_in:] - x[:N-N_in]
+    i_min = np.argmin(widths, axis=0)
+    cols = np.arange(x.shape[1])
+    return x[i_min, cols], x[i_min + N_in, cols]
+
+
+def summarize(trace, varnames, hdi_prob=0.94, quantiles=None, N_workers=4):
+    """
+    Posterior summary of only `varnames` (which can include Deterministics,
+    like "rhostar" or "a_Rs"), without touching any other trace columns.
+
+    Each chain's selected columns are read one variable at a time, with the
+    chains read in parallel threads, and stacked into one (N_draws x
+    N_cols) array, from which the moments, HDI (and optional quantiles) are
+    computed.
+
+    Returns a DataFrame indexed like pm.summary ("u[0]", ...), with columns
+    mean, sd, hpd_{lo}%, hpd_{hi}%, and one column per quantile.
+    """
+    # per chain: the (N_draws x N_cols) selected columns.
+    def _read_columns(chain):
+        cols = []
+        for k in varnames:
+            v = _read_chain(trace, k, chain)
+            cols.append(v.reshape(v.shape[0], -1))
+        return np.hstack(cols)
+
+    point = _get_point(trace, varnames)
+    names = []
+    for k in varnames:
+        names.extend(_expand_names(k, point[k]))
+
+    with ThreadPoolExecutor(max_workers=N_workers) as executor:
+        x = np.vstack(list(executor.map(_read_columns, _get_chains(trace))))
+
+    mean = np.mean(x, axis=0)
+    sd = np.std(x, axis=0, ddof=1)
+    lo, hi = get_hdi(x, hdi_prob=hdi_prob)
+
+    lo_pct = '{:g}'.format(100*(1-hdi_prob)/2)
+    hi_pct = '{:g}'.format(100*(1+hdi_prob)/2)
+    d = OrderedDict([
+        ('mean', mean), ('sd', sd),
+        ('hpd_{}%'.format(lo_pct), lo), ('hpd_{}%'.format(hi_pct), hi)
+    ])
+    if quantiles is not None:
+        qvals = np.quantile(x, quantiles, axis=0)
+        for q, qv in zip(quantiles, qvals):
+            d['{:g}%'.format(100*q)] = qv
+
+    return pd.DataFrame(d, index=names)
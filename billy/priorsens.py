@@ -0,0 +1,201 @@
+"""
+Sensitivity of a fit to its stellar priors, by importance reweighting of the
+stored trace rather than refitting.
+
+ModelFitter's m_star and r_star priors are normals truncated to [0, 3], with
+means and widths from prior_d (default: MSTAR_VANEYKEN ± MSTAR_STDEV and
+RSTAR_VANEYKEN ± RSTAR_STDEV). The literature allows other values (e.g., an
+m_star of 0.34 rather than 0.39, or an r_star of 1.39 or 1.07 rather than
+1.23). Since the likelihood does not change, the posterior under an
+alternative prior p' is the stored posterior reweighted by
+
+    w_s ∝ p'(m_star_s, r_star_s) / p(m_star_s, r_star_s),
+
+which is evaluated for every draw at once. The weights are Pareto-smoothed
+(billy.modelcomparison.psis_smooth); their Pareto shape k says whether the
+reweighting can be trusted (k < 0.7), and if it cannot, the variant is
+refit.
+
+Usage:
+
+    variants = {
+        'briceno05': {'m_star': (0.34, 0.25), 'r_star': (1.39, 0.40)},
+        'vaneyken12': {'r_star': (1.07, 0.40)},
+    }
+    df = get_sensitivity_table(m, prior_d, variants,
+                               ['r', 'b', 'rhostar', 'a_Rs', 'r_planet'],
+                               refit_pklprefix='/path/to/PTFO_priorsens')
+"""
+import numpy as np, pandas as pd
+from math import erf, sqrt
+from collections import OrderedDict
+
+from billy.modelcomparison import psis_smooth
+from billy.posterior import get_samples
+from billy.convenience import (
+    MSTAR_VANEYKEN, MSTAR_STDEV, RSTAR_VANEYKEN, RSTAR_STDEV
+)
+
+# truncation of the stellar-parameter priors, as in ModelBuilder.
+STELLARBOUNDS = (0, 3)
+PARETO_K_MAX = 0.7
+
+
+def get_stellar_priors(prior_d):
+    """
+    {'m_star': (mu, sd), 'r_star': (mu, sd)} used by ModelBuilder for
+    prior_d.
+    """
+    return OrderedDict([
+        ('m_star', (prior_d.get('m_star', MSTAR_VANEYKEN),
+                    prior_d.get('m_star_sd', MSTAR_STDEV))),
+        ('r_star', (prior_d.get('r_star', RSTAR_VANEYKEN),
+                    prior_d.get('r_star_sd', RSTAR_STDEV))),
+    ])
+
+
+def get_variant_prior_d(prior_d, variant):
+    """
+    Copy of prior_d, with the (mu, sd) of each parameter in `variant`.
+    """
+    out = OrderedDict(prior_d)
+    for k, (mu, sd) in variant.items():
+        out[k] = mu
+        out['{}_sd'.format(k)] = sd
+    return out
+
+
+def truncnorm_logpdf(x, mu, sd, lower=STELLARBOUNDS[0],
+                     upper=STELLARBOUNDS[1]):
+    """
+    Log density of a normal truncated to [lower, upper], for an array x.
+    """
+    def Phi(z):
+        return 0.5*(1 + erf(z/sqrt(2)))
+
+    x = np.asarray(x, dtype=float)
+    lognorm = np.log(Phi((upper-mu)/sd) - Phi((lower-mu)/sd))
+    logp = (-0.5*((x - mu)/sd)**2 - np.log(sd*np.sqrt(2*np.pi)) - lognorm)
+    return np.where((x >= lower) & (x <= upper), logp, -np.inf)
+
+
+def get_log_ratios(trace, base, variant):
+    """
+    log p'(θ_s) - log p(θ_s) for every draw s, summed over the parameters
+    in `variant` (dict of name -> (mu, sd)); `base` is the fitted prior
+    (as from get_stellar_priors).
+    """
+    lr = 0
+    for k, (mu, sd) in variant.items():
+        x = np.asarray(trace[k]).flatten()
+        lr = lr + truncnorm_logpdf(x, mu, sd) - truncnorm_logpdf(x, *base[k])
+    return lr
+
+
+def weighted_summary(samples, names, w, quantiles=(0.16, 0.5, 0.84)):
+    """
+    Weighted mean, sd, and quantiles of each column of a (N_draws x
+    N_params) array, with normalized weights w (N_draws).
+    """
+    mean = np.sum(w[:, None]*samples, axis=0)
+    sd = np.sqrt(np.sum(w[:, None]*(samples - mean[None, :])**2, axis=0))
+
+    order = np.argsort(samples, axis=0)
+    cw = np.cumsum(w[order], axis=0)
+    d = OrderedDict([('mean', mean), ('sd', sd)])
+    for q in quantiles:
+        ix = np.argmax(cw >= q, axis=0)
+        d['{:g}%'.format(100*q)] = samples[order[ix, np.arange(len(names))],
+                                           np.arange(len(names))]
+    return pd.DataFrame(d, index=names)
+
+
+def reweight(trace, base, variant, varnames, quantiles=(0.16, 0.5, 0.84)):
+    """
+    Posterior summary of `varnames` under the `variant` stellar priors, by
+    Pareto-smoothed importance reweighting of `trace`.
+
+    Returns a dict with the summary DataFrame, the Pareto k, the effective
+    sample size of the weights, and whether the weights can be trusted
+    (k < PARETO_K_MAX).
+    """
+    lr = get_log_ratios(trace, base, variant)
+    lw, k = psis_smooth(lr[:, None])
+    w = np.exp(lw[:, 0])
+
+    names, samples = get_samples(trace, varnames)
+    return {
+        'summary': weighted_summary(samples, names, w, quantiles=quantiles),
+        'pareto_k': float(k[0]),
+        'ess': float(1/np.sum(w**2)),
+        'reliable': bool(k[0] < PARETO_K_MAX),
+    }
+
+
+def get_sensitivity_table(m, prior_d, variants, varnames,
+                          quantiles=(0.16, 0.5, 0.84), refit_pklprefix=None,
+                          verbose=True):
+    """
+    m: fitted ModelFitter (or anything with a `trace`; a ModelFitter is
+        needed to refit).
+    prior_d: the prior_d that m was fit with.
+    variants: dict of variant name -> {param: (mu, sd)}.
+    refit_pklprefix: if given, a variant whose weights are unreliable is
+        refit with ModelFitter (at m's sampling budget), cached at
+        {refit_pklprefix}_{variant}.pkl. Otherwise it is reported with
+        method "unreliable".
+
+    Returns a DataFrame with one row per (variant, parameter): the summary
+    columns, plus the variant's method ("reweight", "refit", or
+    "unreliable"), pareto_k, and ess. The "baseline" variant is the fitted
+    prior.
+    """
+    base = get_stellar_priors(prior_d)
+
+    names, samples = get_samples(m.trace, varnames)
+    w = np.full(samples.shape[0], 1/samples.shape[0])
+    rows = [(
+        'baseline', weighted_summary(samples, names, w, quantiles=quantiles),
+        'fit', 0., float(samples.shape[0])
+    )]
+
+    for name, variant in variants.items():
+        d = reweight(m.trace, base, variant, varnames, quantiles=quantiles)
+        method, summary = 'reweight', d['summary']
+
+        if not d['reliable'] and refit_pklprefix is not None:
+            from billy.modelfitter import ModelFitter
+            pklpath = '{}_{}.pkl'.format(refit_pklprefix, name)
+            m_new = ModelFitter(
+                m.modelid, m.x_obs, m.y_obs, m.y_err,
+                get_variant_prior_d(prior_d, variant),
+                N_samples=m.N_samples, N_cores=m.N_cores,
+                N_chains=m.N_chains, pklpath=pklpath
+            )
+            _names, _samples = get_samples(m_new.trace, varnames)
+            summary = weighted_summary(
+                _samples, _names, np.full(_samples.shape[0],
+                                          1/_samples.shape[0]),
+                quantiles=quantiles
+            )
+            method = 'refit'
+        elif not d['reliable']:
+            method = 'unreliable'
+
+        if verbose:
+            print('{}: pareto k = {:.2f}, ess = {:.0f} -> {}'.format(
+                name, d['pareto_k'], d['ess'], method))
+        rows.append((name, summary, method, d['pareto_k'], d['ess']))
+
+    dfs = []
+    for name, summary, method, k, ess in rows:
+        df = summary.copy()
+        df['method'] = method
+        df['pareto_k'] = k
+        df['ess'] = ess
+        df.index.name = 'param'
+        df = df.reset_index()
+        df.insert(0, 'variant', name)
+        dfs.append(df)
+
+    return pd.concat(dfs, ignore_index=True)
@@ -0,0 +1,193 @@
+"""
+Local SQLite database of fit results, replacing the per-model pickles that
+used to be globbed from Dropbox.
+
+Tables (each indexed on target, modelid, and run_id):
+
+    runs        one row per ModelFitter inference: sampler settings, data
+                size, wall-clock timings of the MAP and sampling steps.
+    bic         one row per convenience.get_bic call: N, M, Ndata, Nparam,
+                chisq, redchisq, BIC.
+    summaries   one row per parameter of a posterior summary: mean, sd, and
+                HDI bounds.
+
+Usage:
+
+    db = ResultsDB()
+    df = db.get_bic_table('20200513_v0', target='PTFO_8-8695')
+    df = db.query('SELECT modelid, AVG(sample_sec) FROM runs GROUP BY modelid')
+
+Rows are upserted on their natural keys, so re-running a fit or a table
+overwrites the previous entry rather than duplicating it.
+"""
+import os, pickle, sqlite3, time
+from contextlib import contextmanager
+import numpy as np, pandas as pd
+
+from billy import __path__
+
+RESULTSDIR = os.path.join(os.path.dirname(__path__[0]), 'results')
+DEFAULTDBPATH = os.path.join(RESULTSDIR, 'billy_results.sqlite')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT NOT NULL,
+    target TEXT NOT NULL,
+    modelid TEXT NOT NULL,
+    created REAL,
+    n_data INTEGER,
+    n_samples INTEGER,
+    n_chains INTEGER,
+    n_cores INTEGER,
+    map_sec REAL,
+    sample_sec REAL,
+    pklpath TEXT,
+    PRIMARY KEY (run_id, target, modelid)
+);
+CREATE TABLE IF NOT EXISTS bic (
+    run_id TEXT NOT NULL,
+    target TEXT NOT NULL,
+    modelid TEXT NOT NULL,
+    created REAL,
+    N INTEGER,
+    M INTEGER,
+    Ndata INTEGER,
+    Nparam INTEGER,
+    chisq REAL,
+    redchisq REAL,
+    BIC REAL,
+    PRIMARY KEY (run_id, target, modelid)
+);
+CREATE TABLE IF NOT EXISTS summaries (
+    run_id TEXT NOT NULL,
+    target TEXT NOT NULL,
+    modelid TEXT NOT NULL,
+    param TEXT NOT NULL,
+    created REAL,
+    mean REAL,
+    sd REAL,
+    hdi_lo REAL,
+    hdi_hi REAL,
+    PRIMARY KEY (run_id, target, modelid, param)
+);
+"""
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS {t}_target ON {t} (target)',
+    'CREATE INDEX IF NOT EXISTS {t}_modelid ON {t} (modelid)',
+    'CREATE INDEX IF NOT EXISTS {t}_run_id ON {t} (run_id)',
+]
+
+
+def _py(v):
+    # sqlite3 does not adapt numpy scalars.
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+class ResultsDB:
+
+    def __init__(self, dbpath=DEFAULTDBPATH):
+        self.dbpath = dbpath
+        dirname = os.path.dirname(dbpath)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with self._connect() as con:
+            con.executescript(SCHEMA)
+            for t in ['runs', 'bic', 'summaries']:
+                for ix in INDEXES:
+                    con.execute(ix.format(t=t))
+
+    @contextmanager
+    def _connect(self):
+        # a fresh connection per call, so that the object can be shared
+        # between threads and pickled into worker processes.
+        con = sqlite3.connect(self.dbpath, timeout=60)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def __getstate__(self):
+        return {'dbpath': self.dbpath}
+
+    def __setstate__(self, d):
+        self.dbpath = d['dbpath']
+
+    def _upsert(self, table, rows):
+        if len(rows) == 0:
+            return
+        cols = list(rows[0].keys())
+        sql = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+            table, ', '.join(cols), ', '.join('?' for _ in cols)
+        )
+        with self._connect() as con:
+            con.executemany(sql, [[_py(r[c]) for c in cols] for r in rows])
+
+    def record_run(self, run_id, target, modelid, n_data=None, n_samples=None,
+                   n_chains=None, n_cores=None, map_sec=None, sample_sec=None,
+                   pklpath=None):
+        self._upsert('runs', [dict(
+            run_id=run_id, target=target, modelid=modelid,
+            created=time.time(), n_data=n_data, n_samples=n_samples,
+            n_chains=n_chains, n_cores=n_cores, map_sec=map_sec,
+            sample_sec=sample_sec, pklpath=pklpath
+        )])
+
+    def record_bic(self, run_id, target, bicdict):
+        """
+        bicdict: as made by convenience.get_bic.
+        """
+        row = dict(run_id=run_id, target=target, created=time.time())
+        for k in ['modelid', 'N', 'M', 'Ndata', 'Nparam', 'chisq',
+                  'redchisq', 'BIC']:
+            row[k] = bicdict[k]
+        self._upsert('bic', [row])
+
+    def record_summary(self, run_id, target, modelid, df):
+        """
+        df: posterior summary indexed by parameter name, with columns mean,
+        sd, and two "hpd_*%" columns (as from posterior.summarize or
+        pm.summary).
+        """
+        hpdcols = [c for c in df.columns if c.startswith('hpd_')]
+        t = time.time()
+        rows = [
+            dict(run_id=run_id, target=target, modelid=modelid,
+                 param=str(param), created=t, mean=r['mean'], sd=r['sd'],
+                 hdi_lo=r[hpdcols[0]], hdi_hi=r[hpdcols[1]])
+            for param, r in df.iterrows()
+        ]
+        self._upsert('summaries', rows)
+
+    def import_bicdicts(self, pklpaths, run_id, target):
+        """
+        Load `*_bicdict.pkl` files written before the database existed.
+        """
+        for p in pklpaths:
+            self.record_bic(run_id, target, pickle.load(open(p, 'rb')))
+
+    def query(self, sql, params=()):
+        """
+        Run a SELECT, returning a DataFrame.
+        """
+        with self._connect() as con:
+            return pd.read_sql_query(sql, con, params=params)
+
+    def get_bic_table(self, run_id, target=None):
+        """
+        BIC rows of every model in `run_id`, sorted by BIC, with D_BIC
+        relative to the best model.
+        """
+        sql = (
+            'SELECT modelid, N, M, Ndata, Nparam, chisq, redchisq, BIC, '
+            'BIC - MIN(BIC) OVER () AS D_BIC FROM bic WHERE run_id = ?'
+        )
+        params = [run_id]
+        if target is not None:
+            sql += ' AND target = ?'
+            params.append(target)
+        sql += ' ORDER BY BIC'
+        return self.query(sql, params)
@@ -0,0 +1,238 @@
+"""
+Simulation-based calibration (SBC; Talts et al. 2018) of ModelFitter's
+model and priors.
+
+For each of N_replicas draws θ̃ from the prior (the ModelBuilder model, with
+the priors of billy.convenience.initialize_ptfo_prior_d), a light curve is
+simulated from the model's likelihood at θ̃, and fit with a reduced NUTS
+budget. If the posteriors are calibrated, the rank of θ̃ among L thinned
+posterior draws is uniform on 0..L for every parameter; rank histograms
+that are ∪-shaped mean the posteriors are too narrow, ∩-shaped too wide,
+and sloped biased.
+
+Usage:
+
+    ranks = run_sbc('transit_1sincosPorb_1sincosProt', x_obs, y_err,
+                    outdir, N_replicas=300, N_workers=16)
+    print(get_rank_uniformity(ranks, N_thin=99))
+    billy.plotting.plot_rank_histograms(ranks, outpath, N_thin=99)
+
+The simulated light curves are written once to outdir as a .npy array that
+each worker memory-maps, reading only its replica. Every fit runs in its
+own "spawn"-started worker, with its chains sampled one after another in
+that process, so N_workers fits run at once. Each replica's ranks are
+written as soon as its fit finishes, so an interrupted (e.g., overnight)
+run resumes with the replicas that are left.
+"""
+import os, json
+import numpy as np, pandas as pd
+import multiprocessing as mp
+from glob import glob
+from time import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from billy.posterior import get_samples, get_ess
+
+
+def _get_paramnames(model):
+    """
+    The free random variables of `model`, by their untransformed names
+    (e.g., "mean" rather than "mean_interval__").
+    """
+    import pymc3 as pm
+    names = []
+    for v in model.free_RVs:
+        name = v.name
+        if pm.util.is_transformed_name(name):
+            name = pm.util.get_untransformed_name(name)
+        names.append(name)
+    return names
+
+
+def draw_replicas(modelid, x_obs, y_err, outdir, N_replicas=200, seed=42):
+    """
+    Draw N_replicas parameter sets from the prior, and simulate a light curve
+    from each. Writes {outdir}/sbc_obs.npy (N_replicas x N_obs) and
+    {outdir}/sbc_true.npz (the drawn parameters), unless they exist.
+    """
+    import pymc3 as pm
+    from billy.modelfitter import ModelBuilder
+    from billy.convenience import initialize_ptfo_prior_d
+
+    obspath = os.path.join(outdir, 'sbc_obs.npy')
+    truepath = os.path.join(outdir, 'sbc_true.npz')
+    if os.path.exists(obspath) and os.path.exists(truepath):
+        return obspath, truepath
+
+    mb = ModelBuilder(modelid, x_obs, np.zeros_like(x_obs), y_err)
+    prior_d = initialize_ptfo_prior_d(x_obs, mb.modelcomponents)
+    model = mb._build_model(prior_d)
+    paramnames = _get_paramnames(model)
+
+    prior = pm.sample_prior_predictive(
+        samples=N_replicas, model=model, var_names=paramnames + ['obs'],
+        random_seed=seed
+    )
+
+    np.save(obspath, np.asarray(prior['obs']).reshape(N_replicas, -1))
+    np.savez(truepath, **{k: np.asarray(prior[k]) for k in paramnames})
+    print('drew {} prior replicas for {}'.format(N_replicas, modelid))
+
+    return obspath, truepath
+
+
+def get_ranks(samples, true, N_thin):
+    """
+    Rank of each true parameter value (1 x N_params, or N_params) among
+    L = N_thin draws evenly spaced through the (combined) chains of samples
+    (N_draws x N_params): the number of those draws below it, in 0..L.
+    """
+    sel = np.linspace(0, samples.shape[0]-1, N_thin).astype(int)
+    return np.sum(samples[sel] < np.atleast_2d(true), axis=0)
+
+
+def _fit_replica(spec, ix):
+    """
+    Worker: fit replica ix, and write the ranks of its true parameters among
+    N_thin posterior draws.
+    """
+    import pymc3 as pm, exoplanet as xo
+    from billy.modelfitter import ModelBuilder
+    from billy.convenience import initialize_ptfo_prior_d
+
+    t_start = time()
+    y_obs = np.array(np.load(spec['obspath'], mmap_mode='r')[ix])
+    truth = np.load(spec['truepath'])
+
+    mb = ModelBuilder(spec['modelid'], spec['x_obs'], y_obs, spec['y_err'])
+    prior_d = initialize_ptfo_prior_d(spec['x_obs'], mb.modelcomponents)
+    model = mb._build_model(prior_d)
+    paramnames = _get_paramnames(model)
+
+    with model:
+        start = pm.find_MAP(model=model, progressbar=False)
+        trace = pm.sample(
+            tune=spec['tune'], draws=spec['draws'], chains=spec['N_chains'],
+            cores=1, start=start, random_seed=int(spec['seed']) + ix,
+            step=xo.get_dense_nuts_step(target_accept=0.9),
+            progressbar=False, compute_convergence_checks=False
+        )
+
+    names, samples = get_samples(trace, paramnames)
+    _, true = get_samples({k: truth[k][ix:ix+1] for k in paramnames},
+                          paramnames)
+
+    ranks = get_ranks(samples, true, spec['N_thin'])
+
+    result = {
+        'replica': ix,
+        'ranks': dict(zip(names, ranks.tolist())),
+        'true': dict(zip(names, true[0].tolist())),
+        # the ranks are only uniform if the L draws are ~independent.
+        'min_ess': float(np.nanmin(get_ess(samples))),
+        'N_divergent': int(np.sum(trace.get_sampler_stats('diverging'))),
+        'sec': time() - t_start,
+    }
+    outpath = os.path.join(spec['outdir'], 'ranks',
+                           'replica{:05d}.json'.format(ix))
+    with open(outpath + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(outpath + '.tmp', outpath)
+
+    return ix, result['sec']
+
+
+def run_sbc(modelid, x_obs, y_err, outdir, N_replicas=200, N_thin=99,
+            tune=500, draws=500, N_chains=2, N_workers=8, seed=42,
+            verbose=True):
+    """
+    Draw (or load) the replicas, and fit every one that has no ranks yet,
+    N_workers at a time. tune, draws, and N_chains are the reduced budget of
+    each fit; N_thin is L, so that each rank is in 0..L.
+
+    Returns get_rank_statistics(outdir).
+    """
+    os.makedirs(os.path.join(outdir, 'ranks'), exist_ok=True)
+    obspath, truepath = draw_replicas(modelid, x_obs, y_err, outdir,
+                                      N_replicas=N_replicas, seed=seed)
+
+    done = set(
+        int(os.path.basename(p)[7:12])
+        for p in glob(os.path.join(outdir, 'ranks', 'replica*.json'))
+    )
+    todo = [ix for ix in range(N_replicas) if ix not in done]
+
+    spec = {
+        'modelid': modelid, 'x_obs': np.asarray(x_obs),
+        'y_err': y_err, 'obspath': obspath, 'truepath': truepath,
+        'outdir': outdir, 'N_thin': N_thin, 'tune': tune, 'draws': draws,
+        'N_chains': N_chains, 'seed': seed,
+    }
+
+    if verbose:
+        print('{} of {} replicas already fit; fitting {}'.format(
+            len(done), N_replicas, len(todo)))
+
+    ctx = mp.get_context('spawn')
+    t_start = time()
+    with ProcessPoolExecutor(max_workers=N_workers, mp_context=ctx) as ex:
+        futures = {ex.submit(_fit_replica, spec, ix): ix for ix in todo}
+        for N_done, f in enumerate(as_completed(futures)):
+            try:
+                ix, sec = f.result()
+            except Exception as e:
+                print('replica {} failed: {}'.format(futures[f], e))
+                continue
+            if verbose:
+                elapsed = time() - t_start
+                print('replica {} in {:.0f} s ({} of {}; ~{:.1f} hr left)'.format(
+                    ix, sec, N_done+1, len(todo),
+                    elapsed/(N_done+1)*(len(todo)-N_done-1)/3600))
+
+    return get_rank_statistics(outdir)
+
+
+def get_rank_statistics(outdir):
+    """
+    DataFrame with one row per fit replica: the rank of each parameter, and
+    the replica's min_ess, N_divergent, and fit time.
+    """
+    rows = []
+    for path in sorted(glob(os.path.join(outdir, 'ranks', 'replica*.json'))):
+        with open(path, 'r') as f:
+            d = json.load(f)
+        row = {'replica': d['replica']}
+        row.update(d['ranks'])
+        for k in ['min_ess', 'N_divergent', 'sec']:
+            row[k] = d[k]
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def get_paramcolumns(ranks):
+    return [c for c in ranks.columns
+            if c not in ['replica', 'min_ess', 'N_divergent', 'sec']]
+
+
+def get_rank_uniformity(ranks, N_thin=99, N_bins=20):
+    """
+    χ² test of each parameter's rank histogram against uniform on 0..N_thin,
+    in N_bins bins. Small p-values flag miscalibrated parameters; the sign
+    of the mean rank offset tells whether the posteriors are biased low
+    (positive: the truth tends to be above the draws) or high.
+    """
+    from scipy import stats
+
+    edges = np.linspace(0, N_thin+1, N_bins+1)
+    rows = []
+    for k in get_paramcolumns(ranks):
+        r = np.asarray(ranks[k].dropna())
+        counts, _ = np.histogram(r, bins=edges)
+        expected = len(r) * np.diff(edges) / (N_thin+1)
+        chisq = np.sum((counts - expected)**2 / expected)
+        rows.append({
+            'param': k, 'N_replicas': len(r), 'chisq': chisq,
+            'p_value': stats.chi2.sf(chisq, N_bins-1),
+            'mean_rank_offset': np.mean(r)/N_thin - 0.5,
+        })
+    return pd.DataFrame(rows).set_index('param')
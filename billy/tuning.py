@@ -0,0 +1,179 @@
+"""
+Save and reuse the adapted NUTS step size and dense mass matrix of a fit.
+
+xo.get_dense_nuts_step spends the whole tuning phase (tune=N_samples in
+ModelFitter) learning the posterior covariance of the free variables, in the
+sampled (transformed) space, and a step size for it. A rerun of the same
+modelid on slightly different data or priors learns almost the same thing.
+So:
+
+    save_tuning: after a fit, write the final step size (from the sampler
+        statistics) and the posterior mean and covariance of the sampled
+        variables next to the fit's pickle, as {pkl}_tuning.npz.
+    load_tuning: read them back, checking that the variables (names and
+        sizes) match the new model.
+    get_tuned_step: a NUTS step whose mass matrix starts from the saved
+        covariance (pm's QuadPotentialFullAdapt, with a large initial
+        weight, so that the short re-tune refines rather than replaces it),
+        and whose step size starts from the saved one.
+
+ModelFitter(..., tuningpath=...) uses these to run only `N_retune` tuning
+iterations instead of N_samples.
+
+Without an earlier fit, get_hessian_tuning makes the same kind of starting
+point from the MAP alone: the inverse of the (regularized) Hessian of -logp
+at the MAP, in the sampled space, as the initial mass matrix
+(ModelFitter(..., hessian_init=1)).
+"""
+import os
+import numpy as np
+
+
+def get_tuningpath(pklpath):
+    return pklpath.replace('.pkl', '_tuning.npz')
+
+
+def _get_varinfo(model):
+    # ordering of the sampled variables, as in pm's ArrayOrdering.
+    names = [v.name for v in model.vars]
+    sizes = [int(np.prod(v.dshape)) if len(v.dshape) else 1
+             for v in model.vars]
+    return names, sizes
+
+
+def get_sampled_array(trace, model):
+    """
+    (N_draws x N_free) array of the draws in the sampled space, in the
+    ordering of model.vars, combined over chains.
+    """
+    names, _ = _get_varinfo(model)
+    cols = []
+    for k in names:
+        v = np.asarray(trace.get_values(k, combine=True))
+        cols.append(v.reshape(v.shape[0], -1))
+    return np.hstack(cols)
+
+
+def get_final_step_size(trace):
+    """
+    Median over chains of each chain's step size after tuning.
+    """
+    stats = trace.get_sampler_stats('step_size', combine=False)
+    if not isinstance(stats, list):
+        stats = [stats]
+    return float(np.median([np.asarray(s).flatten()[-1] for s in stats]))
+
+
+def save_tuning(trace, model, modelid, outpath, n_tune=None):
+    names, sizes = _get_varinfo(model)
+    x = get_sampled_array(trace, model)
+    np.savez(
+        outpath, modelid=modelid, names=np.array(names), sizes=np.array(sizes),
+        step_size=get_final_step_size(trace), mean=np.mean(x, axis=0),
+        cov=np.atleast_2d(np.cov(x, rowvar=False)), n_draws=x.shape[0],
+        n_tune=-1 if n_tune is None else n_tune
+    )
+    print('wrote {}'.format(outpath))
+
+
+def load_tuning(path, model, modelid=None):
+    """
+    Saved tuning of `path` as a dict (step_size, mean, cov, n_tune), or None
+    if it is missing or does not match model's sampled variables (or
+    modelid, if given).
+    """
+    if path is None or not os.path.exists(path):
+        return None
+
+    d = np.load(path)
+    names, sizes = _get_varinfo(model)
+    if (list(d['names']) != names or list(d['sizes']) != sizes or
+        (modelid is not None and str(d['modelid']) != modelid)):
+        print('{} does not match the model; not reusing it'.format(path))
+        return None
+
+    return {
+        'step_size': float(d['step_size']),
+        'mean': np.array(d['mean']),
+        'cov': np.array(d['cov']),
+        'n_tune': int(d['n_tune']),
+    }
+
+
+def get_hessian_tuning(model, map_estimate, eig_floor=1e-3,
+                       initial_weight=10):
+    """
+    Starting mass matrix from the curvature at the MAP: the Hessian H of
+    -logp with respect to the sampled variables, symmetrized and inverted
+    through its eigendecomposition. Each eigenvalue is replaced by its
+    absolute value (a negative one, if the optimizer stopped short of the
+    maximum, still gives the scale of that direction), and floored at
+    eig_floor times the median, so that flat directions get a width
+    comparable to the others rather than an arbitrarily large one. The step
+    size starts at pm.NUTS's default.
+
+    Returns a dict in the form of load_tuning, plus "N_floored" and
+    "N_negative", the numbers of eigenvalues that were floored and that
+    were negative. Its initial_weight is small, since the Hessian only
+    describes the posterior near the MAP.
+    """
+    import pymc3 as pm
+    from billy.chainpool import _get_bijection
+
+    point = {v.name: np.asarray(map_estimate[v.name]) for v in model.vars}
+    bij = _get_bijection(model, point)
+
+    H = np.atleast_2d(pm.find_hessian(point, vars=model.vars, model=model))
+    H = 0.5*(H + H.T)
+    lam, V = np.linalg.eigh(H)
+    N_negative = int(np.sum(lam < 0))
+    lam = np.abs(lam)
+    lam_min = eig_floor * np.median(lam)
+    if not lam_min > 0:
+        # at least half the directions are flat: fall back to unit width.
+        lam_min = 1.
+    N_floored = int(np.sum(lam < lam_min))
+    lam = np.maximum(lam, lam_min)
+    cov = (V / lam[None, :]) @ V.T
+
+    if N_floored or N_negative:
+        print('Hessian at the MAP: {} of {} eigenvalues negative, {} '
+              'floored'.format(N_negative, len(lam), N_floored))
+
+    n = cov.shape[0]
+    return {
+        'step_size': 0.25 / n**0.25,
+        'mean': bij.map(point),
+        'cov': cov,
+        'n_tune': 0,
+        'initial_weight': initial_weight,
+        'N_floored': N_floored,
+        'N_negative': N_negative,
+    }
+
+
+def get_tuned_step(model, tuning, target_accept=0.9, initial_weight=None,
+                   adaptation_window=101):
+    """
+    NUTS step starting from the saved mass matrix and step size.
+
+    initial_weight: how many draws the saved covariance counts for, against
+        the draws of the re-tune (default: the tuning's own
+        "initial_weight", or 1000).
+    """
+    import pymc3 as pm
+    from pymc3.step_methods.hmc.quadpotential import QuadPotentialFullAdapt
+
+    if initial_weight is None:
+        initial_weight = tuning.get('initial_weight', 1000)
+
+    n = tuning['mean'].size
+    potential = QuadPotentialFullAdapt(
+        n, tuning['mean'], initial_cov=tuning['cov'],
+        initial_weight=initial_weight, adaptation_window=adaptation_window
+    )
+    # pm.NUTS starts from step_size = step_scale / n**(1/4).
+    return pm.NUTS(
+        vars=model.vars, model=model, potential=potential,
+        step_scale=tuning['step_size'] * n**0.25, target_accept=target_accept
+    )
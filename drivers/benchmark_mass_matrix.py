@@ -0,0 +1,96 @@
+"""
+Benchmark the initial dense mass matrix by effective samples per second:
+ModelFitter's default (xo.get_dense_nuts_step, tuned for N_samples), versus
+the inverse Hessian at the MAP with a shortened tune (hessian_init=1).
+
+Each configuration is fit from scratch (its benchmark pickle is removed
+first), and scored by the minimum and median ESS over the scalar
+parameters, summed over chains, per second of sampling (tuning included).
+"""
+import os, sys, json
+import numpy as np, pandas as pd
+
+from billy.modelfitter import ModelFitter, ModelParser
+from billy.posterior import get_scalar_varnames, get_ess
+from billy.convenience import get_clean_ptfo_data, initialize_ptfo_prior_d
+from billy import __path__
+
+def get_chain_ess(trace, varnames):
+    """
+    ESS of each varname column, computed per chain and summed.
+    """
+    ess = 0
+    for c in trace.chains:
+        cols = []
+        for k in varnames:
+            v = np.asarray(trace.get_values(k, chains=c))
+            cols.append(v.reshape(v.shape[0], -1))
+        ess = ess + get_ess(np.hstack(cols))
+    return ess
+
+
+def main(modelid, N_samples=2000, N_hessian_tune=500, N_repeats=1):
+
+    REALID = 'PTFO_8-8695'
+    RESULTSDIR = os.path.join(os.path.dirname(__path__[0]), 'results')
+    PLOTDIR = os.path.join(RESULTSDIR, '{}_results'.format(REALID),
+                           'benchmarks')
+    if not os.path.exists(PLOTDIR):
+        os.mkdir(PLOTDIR)
+    benchdir = os.path.join(os.path.expanduser('~'), 'local', 'billy',
+                            'benchmarks')
+    if not os.path.exists(benchdir):
+        os.makedirs(benchdir)
+
+    x_obs, y_obs, y_err = get_clean_ptfo_data()
+    mp = ModelParser(modelid)
+    prior_d = initialize_ptfo_prior_d(x_obs, mp.modelcomponents)
+
+    configs = [
+        ('default', {}),
+        ('hessian', {'hessian_init': 1, 'N_hessian_tune': N_hessian_tune}),
+    ]
+
+    rows = []
+    for repeat in range(N_repeats):
+        for name, kwargs in configs:
+            pklpath = os.path.join(
+                benchdir, '{}_{}_{}_{}.pkl'.format(REALID, modelid, name,
+                                                   repeat)
+            )
+            if os.path.exists(pklpath):
+                os.remove(pklpath)
+
+            np.random.seed(42 + repeat)
+            m = ModelFitter(modelid, x_obs, y_obs, y_err, prior_d,
+                            N_samples=N_samples, pklpath=pklpath, **kwargs)
+
+            varnames = get_scalar_varnames(m.trace.raw, N_obs=len(x_obs))
+            ess = get_chain_ess(m.trace.raw, varnames)
+            rows.append({
+                'config': name, 'repeat': repeat, 'N_tune': m.N_tune,
+                'N_samples': N_samples, 'map_sec': m.map_sec,
+                'sample_sec': m.sample_sec, 'min_ess': np.min(ess),
+                'median_ess': np.median(ess),
+                'min_ess_per_sec': np.min(ess)/m.sample_sec,
+                'median_ess_per_sec': np.median(ess)/m.sample_sec,
+            })
+            print(json.dumps(rows[-1]))
+
+    df = pd.DataFrame(rows)
+    outpath = os.path.join(PLOTDIR, 'mass_matrix_benchmark_{}.csv'.format(
+        modelid))
+    df.to_csv(outpath, index=False)
+
+    print(df.groupby('config')[['N_tune', 'sample_sec', 'min_ess',
+                                'min_ess_per_sec',
+                                'median_ess_per_sec']].mean())
+    print('wrote {}'.format(outpath))
+
+
+if __name__ == "__main__":
+
+    modelid = (
+        sys.argv[1] if len(sys.argv) > 1 else 'transit_2sincosPorb_2sincosProt'
+    )
+    main(modelid)
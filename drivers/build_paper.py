@@ -0,0 +1,199 @@
+"""
+Incrementally rebuild the paper figures and tables.
+
+Each driver is declared as a node of a billy.build.BuildGraph, with its
+inputs (light curves, fit caches, CSVs, and the billy source it depends on)
+and its outputs. Only stale nodes are re-run, and independent nodes run in
+parallel. For instance, editing the rotation priors in
+billy/convenience.py re-runs the fits and everything downstream of them, but
+not the scene, HR, or O-C figures.
+
+Usage:
+    python build_paper.py              # rebuild anything stale
+    python build_paper.py --dry-run    # list what would be rebuilt
+    python build_paper.py f3 f6        # rebuild only these (and their deps)
+"""
+import os, sys
+from os.path import join
+from itertools import product
+
+from billy.build import BuildGraph
+from billy.resultsdb import DEFAULTDBPATH
+from billy import __path__
+
+REALID = 'PTFO_8-8695'
+RUNID = '20200513_v0'
+BILLYDIR = __path__[0]
+DRIVERDIR = os.path.dirname(os.path.abspath(__file__))
+PAPERDIR = join(os.path.dirname(BILLYDIR), 'paper')
+RESULTSDIR = join(os.path.dirname(BILLYDIR), 'results')
+FITRESULTSDIR = join(RESULTSDIR, '{}_results'.format(REALID), RUNID)
+FITCACHEDIR = join(os.path.expanduser('~'), 'local', 'billy')
+DROPBOXDIR = '/Users/luke/Dropbox/proj/billy'
+
+SPOCLC = join(
+    DROPBOXDIR, 'data', 'PTFO_8-8695',
+    'tess2018349182459-s0006-0000000264461976-0126-s',
+    'tess2018349182459-s0006-0000000264461976-0126-s_lc.fits'
+)
+SPOCTP = join(
+    os.path.dirname(BILLYDIR), 'data', 'PTFO_8-8695',
+    'tess2018349182459-s0006-0000000264461976-0126-s',
+    'tess2018349182459-s0006-0000000264461976-0126-s_tp.fits'
+)
+NBHDPKL = join(DROPBOXDIR, 'results', 'cluster_membership',
+               'nbhd_info_3222255959210123904.pkl')
+VARAMPCSV = join(DROPBOXDIR, 'data', '25ori-1', 'var_amps.csv')
+RUWECSV = join(DROPBOXDIR, 'results', 'cluster_membership',
+               '25ori-1_group_ruwe.csv')
+EPHEMCSV = join(DROPBOXDIR, 'data', 'ephemeris',
+                'PTFO_8-8695_manual_all.csv')
+
+# everything ModelFitter runs through when it fits: the model, the chain
+# workers, the trace wrapper, the mass-matrix tuning, and the multi-start MAP.
+FITSOURCE = [join(BILLYDIR, f) for f in
+             ['modelfitter.py', 'models.py', 'convenience.py',
+              'chainpool.py', 'harmonictrace.py', 'tuning.py',
+              'multistart.py']]
+COMPARISONSOURCE = [join(BILLYDIR, f) for f in
+                    ['resultsdb.py', 'modelcomparison.py', 'posterior.py']]
+PLOTSOURCE = [join(BILLYDIR, 'plotting.py')]
+
+MODELIDS = [
+    'transit_{}sincosPorb_{}sincosProt'.format(N,M)
+    for N, M in product(range(1,4), range(1,4))
+]
+PAPERMODELID = 'transit_3sincosPorb_2sincosProt'
+TABLEMODELIDS = [
+    'transit_2sincosPorb_2sincosProt',
+    'transit_2sincosPorb_3sincosProt',
+    'transit_3sincosPorb_2sincosProt'
+]
+
+
+def fitpath(modelid):
+    return join(FITCACHEDIR, '{}_model_{}.pkl'.format(REALID, modelid))
+
+
+def fitplotpath(modelid, kind):
+    return join(FITRESULTSDIR, '{}_{}_{}'.format(REALID, modelid, kind))
+
+
+def make_graph(statepath):
+
+    g = BuildGraph(statepath)
+
+    #
+    # fits, and the per-model figures and BIC records made from them.
+    #
+    for modelid in MODELIDS:
+        g.add('fit_{}'.format(modelid),
+              'python real.py {} fit'.format(modelid),
+              inputs=[SPOCLC]+FITSOURCE,
+              outputs=[fitpath(modelid)],
+              cwd=DRIVERDIR, clean=True)
+
+        g.add('fitplots_{}'.format(modelid),
+              'python real.py {} plot'.format(modelid),
+              inputs=[fitpath(modelid), SPOCLC]+PLOTSOURCE,
+              outputs=[
+                  fitplotpath(modelid, 'splitsignalmap_i.pdf'),
+                  fitplotpath(modelid, 'splitsignalmap_ii.pdf'),
+                  fitplotpath(modelid, 'phasefoldmap.pdf'),
+                  fitplotpath(modelid, 'phasefoldmap_points.pkl'),
+                  join(FITRESULTSDIR, '{}_bicdict.pkl'.format(modelid))
+              ],
+              cwd=DRIVERDIR)
+
+    #
+    # tables
+    #
+    # the BIC columns are read from the results database (or imported from
+    # the bicdicts), and the LOO columns from every fit's stored trace.
+    g.add('model_comparison_table',
+          'python make_model_comparison_table.py',
+          inputs=(
+              [join(FITRESULTSDIR, '{}_bicdict.pkl'.format(modelid))
+               for modelid in MODELIDS] +
+              [fitpath(modelid) for modelid in MODELIDS] +
+              [DEFAULTDBPATH, SPOCLC] + COMPARISONSOURCE
+          ),
+          outputs=[join(FITRESULTSDIR, 'bic_table_data.tex')],
+          cwd=DRIVERDIR)
+
+    for modelid in TABLEMODELIDS:
+        g.add('posterior_table_{}'.format(modelid),
+              'python -c "from make_posterior_table import main; '
+              'main(\'{}\')"'.format(modelid),
+              inputs=[fitpath(modelid), SPOCLC]+FITSOURCE,
+              outputs=[
+                  join(FITRESULTSDIR,
+                       'posterior_table_raw_{}.csv'.format(modelid)),
+                  join(FITRESULTSDIR,
+                       'posterior_table_clean_{}.tex'.format(modelid))
+              ],
+              cwd=DRIVERDIR, clean=True)
+
+    #
+    # stand-alone figures
+    #
+    g.add('scene', 'python plot_scene.py',
+          inputs=[SPOCTP]+PLOTSOURCE,
+          outputs=[join(RESULTSDIR, '{}_results'.format(REALID), 'scene.pdf')],
+          cwd=DRIVERDIR)
+
+    g.add('hr', 'python plot_hr.py',
+          inputs=[NBHDPKL]+PLOTSOURCE,
+          outputs=[join(RESULTSDIR, 'cluster_membership', 'hr.pdf')],
+          cwd=DRIVERDIR)
+
+    g.add('astrometric_excess', 'python plot_astrometric_excess.py',
+          inputs=[NBHDPKL, VARAMPCSV, RUWECSV]+PLOTSOURCE,
+          outputs=[
+              join(RESULTSDIR, 'cluster_membership', 'astrometric_excess.pdf'),
+              join(RESULTSDIR, 'cluster_membership',
+                   'astrometric_excess_ruwe.pdf')
+          ],
+          cwd=DRIVERDIR)
+
+    g.add('O_minus_C', 'python plot_O_minus_C.py',
+          inputs=[EPHEMCSV]+PLOTSOURCE,
+          outputs=[join(RESULTSDIR, 'ephemeris', 'O_minus_C.pdf')],
+          cwd=DRIVERDIR)
+
+    g.add('brethren', 'python plot_brethren.py',
+          inputs=[fitplotpath(PAPERMODELID, 'phasefoldmap_points.pkl'),
+                  join(RESULTSDIR, 'brethren', 'k2data.pkl')]+PLOTSOURCE,
+          outputs=[join(RESULTSDIR, 'brethren', 'brethren.pdf')],
+          cwd=DRIVERDIR)
+
+    #
+    # copy into paper/, following collect.sh
+    #
+    copies = [
+        ('f1', fitplotpath(PAPERMODELID, 'splitsignalmap_i.pdf')),
+        ('f2', fitplotpath(PAPERMODELID, 'splitsignalmap_ii.pdf')),
+        ('f3', fitplotpath(PAPERMODELID, 'phasefoldmap.pdf')),
+        ('f4', join(RESULTSDIR, '{}_results'.format(REALID), 'scene.pdf')),
+        ('f5a', join(RESULTSDIR, 'cluster_membership', 'hr.pdf')),
+        ('f5b', join(RESULTSDIR, 'cluster_membership',
+                     'astrometric_excess.pdf')),
+        ('f6', join(RESULTSDIR, 'ephemeris', 'O_minus_C.pdf')),
+        ('f7', join(RESULTSDIR, 'brethren', 'brethren.pdf')),
+    ]
+    for name, src in copies:
+        dst = join(PAPERDIR, '{}.pdf'.format(name))
+        g.add(name, 'cp {} {}'.format(src, dst), inputs=[src], outputs=[dst])
+
+    return g
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    dry_run = '--dry-run' in args
+    targets = [a for a in args if not a.startswith('--')] or None
+
+    statepath = join(PAPERDIR, '.build_state.json')
+    g = make_graph(statepath)
+    g.build(targets=targets, N_workers=4, dry_run=dry_run)
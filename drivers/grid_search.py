@@ -0,0 +1,41 @@
+"""
+Successive-halving search over the (N, M) harmonic grid for PTFO 8-8695,
+instead of fitting every model to full depth.
+"""
+import os
+import numpy as np
+from billy.gridsearch import successive_halving, get_modelid_grid
+from billy.convenience import get_clean_ptfo_data, initialize_ptfo_prior_d
+from billy import __path__
+
+def main():
+
+    REALID = 'PTFO_8-8695'
+    RESULTSDIR = os.path.join(os.path.dirname(__path__[0]), 'results')
+    PLOTDIR = os.path.join(RESULTSDIR, '{}_results'.format(REALID),
+                           'gridsearch')
+    if not os.path.exists(PLOTDIR):
+        os.mkdir(PLOTDIR)
+
+    pklprefix = os.path.join(
+        os.path.expanduser('~'), 'local', 'billy',
+        '{}_gridsearch'.format(REALID)
+    )
+    np.random.seed(42)
+
+    x_obs, y_obs, y_err = get_clean_ptfo_data()
+
+    def get_prior_d(modelid):
+        return initialize_ptfo_prior_d(x_obs, modelid.split('_'))
+
+    result = successive_halving(
+        get_modelid_grid(N_max=3, M_max=3), x_obs, y_obs, y_err, get_prior_d,
+        pklprefix, budgets=[(200, 2), (500, 2), (2000, 4)],
+        keep_fraction=1/3, logpath=os.path.join(PLOTDIR, 'gridsearch_log.csv')
+    )
+
+    print('best model: {}'.format(result['best']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Injection-recovery campaign for PTFO 8-8695: transit plus rotation signals
+of various sizes, injected into the residuals of the best-fit model of the
+real light curve.
+
+    python injection_recovery.py setup   # write and queue the campaign
+    python injection_recovery.py work    # run jobs here (on any host that
+                                         # sees CAMPAIGNDIR)
+    python injection_recovery.py plot    # completeness maps
+
+Without arguments, does all three on this host.
+"""
+import os, sys, pickle
+import numpy as np
+from billy.injrecov import (
+    make_jobs, setup_campaign, run_campaign, collect_results,
+    get_completeness, get_progress
+)
+from billy.plotting import plot_completeness_map
+from billy.convenience import get_clean_ptfo_data
+from billy import __path__
+
+REALID = 'PTFO_8-8695'
+BESTMODELID = 'transit_2sincosPorb_2sincosProt'
+RESULTSDIR = os.path.join(os.path.dirname(__path__[0]), 'results')
+PLOTDIR = os.path.join(RESULTSDIR, '{}_results'.format(REALID), 'injrecov')
+CAMPAIGNDIR = os.path.join(
+    os.path.expanduser('~'), 'local', 'billy', '{}_injrecov'.format(REALID)
+)
+
+def setup():
+
+    x_obs, y_obs, y_err = get_clean_ptfo_data()
+
+    # the residuals of the MAP model of the real data are the noise.
+    pklpath = os.path.join(
+        os.path.expanduser('~'), 'local', 'billy',
+        '{}_model_{}.pkl'.format(REALID, BESTMODELID)
+    )
+    d = pickle.load(open(pklpath, 'rb'))
+    noise = y_obs - d['map_estimate']['mu_model'].flatten()
+
+    jobs = make_jobs(
+        {'r': [0.02, 0.04, 0.06, 0.08, 0.11],
+         'amp_rot': [1e-3, 3e-3, 1e-2, 3e-2],
+         'P_rot': [0.3, 0.49845, 1.0, 2.0]},
+        N_phases=8, seed=42
+    )
+    setup_campaign(CAMPAIGNDIR, x_obs, noise, y_err, jobs)
+
+
+def plot():
+
+    if not os.path.exists(PLOTDIR):
+        os.mkdir(PLOTDIR)
+
+    results = collect_results(CAMPAIGNDIR)
+    print('{} results; {}'.format(len(results), get_progress(CAMPAIGNDIR)))
+
+    for xkey, ykey, flag in [('r', 'amp_rot', 'recovered'),
+                             ('r', 'amp_rot', 'transit_recovered'),
+                             ('P_rot', 'amp_rot', 'rot_recovered')]:
+        frac, N = get_completeness(results, xkey, ykey, flag=flag)
+        outpath = os.path.join(
+            PLOTDIR, 'completeness_{}_{}_{}.png'.format(flag, xkey, ykey)
+        )
+        plot_completeness_map(frac, N, outpath)
+
+
+if __name__ == "__main__":
+
+    modes = sys.argv[1:] if len(sys.argv) > 1 else ['setup', 'work', 'plot']
+
+    if 'setup' in modes:
+        setup()
+    if 'work' in modes:
+        run_campaign(CAMPAIGNDIR, N_workers=8)
+    if 'plot' in modes:
+        plot()
@@ -1,32 +1,72 @@
-import pickle, os
+import os
 import numpy as np, pandas as pd
 from glob import glob
+from itertools import product
 
-run_id = '20200513_v0'
+from billy.resultsdb import ResultsDB, RESULTSDIR
+from billy.modelcomparison import compare_models
+from billy.convenience import get_clean_ptfo_data
 
-pklpaths = glob(
-    '/Users/luke/Dropbox/proj/billy/results/PTFO_8-8695_results/{}/*bicdict*'
-    .format(run_id)
-)
-ds = []
-for p in pklpaths:
-    d = pickle.load(open(p,'rb'))
-    ds.append(d)
 
-df = pd.DataFrame(ds)
+def main():
+    # NOTE: the LOO workers are "spawn"-started, and re-import this module,
+    # so nothing can run at import time.
 
-df = df.sort_values(by='BIC')
+    run_id = '20200513_v0'
+    target = 'PTFO_8-8695'
+    do_loo = 1
 
-df['D_BIC'] = df.BIC - df.BIC.min()
+    fitdir = os.path.join(RESULTSDIR, '{}_results'.format(target), run_id)
 
-df = df.drop('modelid', axis=1)
+    db = ResultsDB()
 
-df['chisq'] = np.round(df.chisq, 1)
-df['redchisq'] = np.round(df.redchisq, 3)
-df['BIC'] = np.round(df.BIC, 1)
-df['D_BIC'] = np.round(df.D_BIC, 1)
+    df = db.get_bic_table(run_id, target=target)
 
-outpath = '../results/PTFO_8-8695_results/{}/bic_table_data.tex'.format(run_id)
+    if len(df) == 0:
+        # fits made before the results database existed.
+        pklpaths = glob(
+            '/Users/luke/Dropbox/proj/billy/results/{}_results/{}/*bicdict*'
+            .format(target, run_id)
+        )
+        db.import_bicdicts(pklpaths, run_id, target)
+        df = db.get_bic_table(run_id, target=target)
 
-df.to_latex(outpath, index=False)
-print('wrote {}'.format(outpath))
+    if do_loo:
+        # PSIS-LOO and WAIC of every fitted model, from the stored traces.
+        pklpaths = {}
+        for N, M in product(range(1,4), range(1,4)):
+            modelid = 'transit_{}sincosPorb_{}sincosProt'.format(N, M)
+            p = os.path.join(os.path.expanduser('~'), 'local', 'billy',
+                             '{}_model_{}.pkl'.format(target, modelid))
+            if os.path.exists(p):
+                pklpaths[modelid] = p
+
+        if len(pklpaths) > 0:
+            x_obs, y_obs, y_err = get_clean_ptfo_data()
+            loo_df = compare_models(pklpaths, y_obs, y_err, outdir=fitdir)
+            df = df.merge(
+                loo_df[['modelid', 'elpd_loo', 'se_elpd_loo', 'p_loo',
+                        'max_pareto_k', 'waic', 'd_elpd_loo', 'se_d_elpd_loo']],
+                on='modelid', how='left'
+            )
+            for k in ['elpd_loo', 'se_elpd_loo', 'waic', 'd_elpd_loo',
+                      'se_d_elpd_loo']:
+                df[k] = np.round(df[k], 1)
+            df['p_loo'] = np.round(df.p_loo, 1)
+            df['max_pareto_k'] = np.round(df.max_pareto_k, 2)
+
+    df = df.drop('modelid', axis=1)
+
+    df['chisq'] = np.round(df.chisq, 1)
+    df['redchisq'] = np.round(df.redchisq, 3)
+    df['BIC'] = np.round(df.BIC, 1)
+    df['D_BIC'] = np.round(df.D_BIC, 1)
+
+    outpath = os.path.join(fitdir, 'bic_table_data.tex')
+
+    df.to_latex(outpath, index=False)
+    print('wrote {}'.format(outpath))
+
+
+if __name__ == "__main__":
+    main()
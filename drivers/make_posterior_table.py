@@ -9,15 +9,18 @@ import billy.plotting as bp
 from billy.convenience import (
     get_clean_ptfo_data, get_ptfo_data, initialize_ptfo_prior_d, get_bic
 )
+from billy.posterior import summarize
+from billy.resultsdb import ResultsDB
 from billy import __path__
+from collections import OrderedDict
 
 def main(modelid):
 
     OVERWRITE = 0
     REALID = 'PTFO_8-8695'
+    RUNID = '20200513_v0'
     RESULTSDIR = os.path.join(os.path.dirname(__path__[0]), 'results')
-    PLOTDIR = os.path.join(RESULTSDIR, '{}_results'.format(REALID),
-                           '20200513_v0')
+    PLOTDIR = os.path.join(RESULTSDIR, '{}_results'.format(REALID), RUNID)
 
     assert modelid in [
         'transit_2sincosPorb_2sincosProt',
@@ -40,25 +43,6 @@ def main(modelid):
     mp = ModelParser(modelid)
     prior_d = initialize_ptfo_prior_d(x_obs, mp.modelcomponents)
 
-    if not os.path.exists(summarypath):
-
-        m = ModelFitter(modelid, x_obs, y_obs, y_err, prior_d, plotdir=PLOTDIR,
-                        pklpath=pklpath, overwrite=OVERWRITE)
-
-        # NOTE: you could pass "varnames = varnames", but don't to enable
-        # derived parameter collection
-        # varnames = list(prior_d.keys())
-
-        df = pm.summary(
-            m.trace,
-            round_to=10, kind='stats'
-        )
-
-        df.to_csv(summarypath, index=True)
-
-    else:
-        df = pd.read_csv(summarypath, index_col=0)
-
     srows = [
         # fitted params
         'period', 't0', 'r', 'b', 'u[0]', 'u[1]', 'mean', 'r_star', 'm_star',
@@ -82,10 +66,30 @@ def main(modelid):
             'omegaorb', 'rhostar', 'r_planet', 'a_Rs'
         ]
 
+    if not os.path.exists(summarypath):
+
+        m = ModelFitter(modelid, x_obs, y_obs, y_err, prior_d, plotdir=PLOTDIR,
+                        pklpath=pklpath, overwrite=OVERWRITE)
+
+        # summarize only the table's parameters (including the derived
+        # ones), rather than every per-timestamp Deterministic.
+        varnames = list(OrderedDict.fromkeys(
+            [r.split('[')[0] for r in srows
+             if r.split('[')[0] in m.trace.varnames]
+        ))
+        df = summarize(m.trace, varnames, hdi_prob=0.94)
+
+        df.to_csv(summarypath, index=True)
+
+    else:
+        df = pd.read_csv(summarypath, index_col=0)
+
     df = df.loc[srows]
+    ResultsDB().record_summary(RUNID, REALID, modelid, df)
 
-    from billy.convenience import (
-        MSTAR_VANEYKEN, MSTAR_STDEV, RSTAR_VANEYKEN, RSTAR_STDEV
+    from billy.priorsens import get_stellar_priors
+    (MSTAR_MU, MSTAR_SD), (RSTAR_MU, RSTAR_SD) = (
+        get_stellar_priors(prior_d).values()
     )
 
     pr = {
@@ -98,9 +102,9 @@ def main(modelid):
         'u[1]': '(2)',
         'mean': uniform_str(lower=prior_d['mean']-1e-2,
                             upper=prior_d['mean']+1e-2),
-        'r_star': truncnormal_str(mu=RSTAR_VANEYKEN, sd=RSTAR_STDEV,
+        'r_star': truncnormal_str(mu=RSTAR_MU, sd=RSTAR_SD,
                                   fmtstr='({:.2f}; {:.2f})'),
-        'm_star': truncnormal_str(mu=MSTAR_VANEYKEN, sd=MSTAR_STDEV,
+        'm_star': truncnormal_str(mu=MSTAR_MU, sd=MSTAR_SD,
                                   fmtstr='({:.2f}; {:.2f})'),
         'Aorb0': uniform_str(lower=-2*np.abs(prior_d['Aorb0']),
                              upper=2*np.abs(prior_d['Aorb0'])),
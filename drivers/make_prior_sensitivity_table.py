@@ -0,0 +1,63 @@
+"""
+Sensitivity of the PTFO 8-8695 transit parameters to the stellar mass and
+radius priors, by reweighting the stored fit (billy.priorsens). Variants
+whose importance weights are unreliable are refit.
+"""
+import os, sys
+import numpy as np, pandas as pd
+
+from billy.modelfitter import ModelFitter, ModelParser
+from billy.priorsens import get_sensitivity_table
+from billy.convenience import (
+    get_clean_ptfo_data, initialize_ptfo_prior_d, MSTAR_STDEV, RSTAR_STDEV
+)
+from billy import __path__
+
+# the alternatives noted next to MSTAR_VANEYKEN and RSTAR_VANEYKEN.
+VARIANTS = {
+    'mstar0.34': {'m_star': (0.34, MSTAR_STDEV)},
+    'rstar1.39': {'r_star': (1.39, RSTAR_STDEV)},
+    'rstar1.07': {'r_star': (1.07, RSTAR_STDEV)},
+    'briceno05': {'m_star': (0.34, MSTAR_STDEV), 'r_star': (1.39, RSTAR_STDEV)},
+    'mstar0.34_rstar1.07': {'m_star': (0.34, MSTAR_STDEV),
+                            'r_star': (1.07, RSTAR_STDEV)},
+}
+
+def main(modelid):
+
+    REALID = 'PTFO_8-8695'
+    RUNID = '20200513_v0'
+    RESULTSDIR = os.path.join(os.path.dirname(__path__[0]), 'results')
+    PLOTDIR = os.path.join(RESULTSDIR, '{}_results'.format(REALID), RUNID)
+
+    pklpath = os.path.join(
+        os.path.expanduser('~'), 'local', 'billy',
+        '{}_model_{}.pkl'.format(REALID, modelid)
+    )
+    refit_pklprefix = pklpath.replace('.pkl', '_priorsens')
+
+    x_obs, y_obs, y_err = get_clean_ptfo_data()
+    mp = ModelParser(modelid)
+    prior_d = initialize_ptfo_prior_d(x_obs, mp.modelcomponents)
+
+    m = ModelFitter(modelid, x_obs, y_obs, y_err, prior_d, plotdir=PLOTDIR,
+                    pklpath=pklpath, overwrite=0)
+
+    varnames = ['r', 'b', 'm_star', 'r_star', 'rhostar', 'r_planet', 'a_Rs']
+    df = get_sensitivity_table(m, prior_d, VARIANTS, varnames,
+                               refit_pklprefix=refit_pklprefix)
+
+    outpath = os.path.join(
+        PLOTDIR, 'prior_sensitivity_{}.csv'.format(modelid)
+    )
+    df.to_csv(outpath, index=False)
+    print(df)
+    print('wrote {}'.format(outpath))
+
+
+if __name__ == "__main__":
+
+    modelid = (
+        sys.argv[1] if len(sys.argv) > 1 else 'transit_2sincosPorb_2sincosProt'
+    )
+    main(modelid)
@@ -4,9 +4,9 @@ make O-C model figure
 import pandas as pd, numpy as np
 import os
 from numpy import array as nparr
-from astrobase.timeutils import get_epochs_given_midtimes_and_period
 
 import billy.plotting as bp
+from billy.ephemeris import assign_epochs, compare_ephemerides
 
 EPOCH = 2455543.94300
 PERIOD = 0.448399
@@ -30,14 +30,15 @@ def get_data(
 
     y, sigma_y, refs = y[sel], sigma_y[sel], refs[sel]
 
-    if not plongphasing:
-        x, _ = get_epochs_given_midtimes_and_period(
-            y, PERIOD, t0_fixed=EPOCH, verbose=True
-        )
+    period = PERIOD if not plongphasing else 0.4991110
+    if is_occultation:
+        x, ambiguous = assign_epochs(y - period/2, period, EPOCH)
     else:
-        x, _ = get_epochs_given_midtimes_and_period(
-            y, 0.4991110, t0_fixed=EPOCH, verbose=True
-        )
+        x, ambiguous = assign_epochs(y, period, EPOCH)
+
+    if np.any(ambiguous):
+        print('WRN! ambiguous epochs for {} of {} times: {}'.format(
+            np.sum(ambiguous), len(y), y[ambiguous]))
 
     return x, y, sigma_y, refs
 
@@ -55,10 +56,21 @@ def main(xlim=None, ylim=None, include_all_points=False, ylim1=None,
     print('getting data from {:s}'.format(transitpath))
     x, y, sigma_y, refs = get_data(datacsv=transitpath,
                                    plongphasing=plongphasing)
-    print('getting data from {:s}'.format(occpath))
-
+    x_occ, y_occ, sigma_y_occ = None, None, None
     if os.path.exists(occpath):
-        raise NotImplementedError
+        print('getting data from {:s}'.format(occpath))
+        x_occ, y_occ, sigma_y_occ, _ = get_data(
+            datacsv=occpath, is_occultation=True, plongphasing=plongphasing
+        )
+
+    c = compare_ephemerides(x, y, sigma_y, epochs_occ=x_occ,
+                            times_occ=y_occ, sigmas_occ=sigma_y_occ)
+    for k in ['linear', 'quadratic']:
+        print('{}: params {}, errs {}, chi2 = {:.1f}, BIC = {:.1f}'.format(
+            k, c[k]['params'], c[k]['param_errs'], c[k]['chisq'],
+            c[k]['bic']))
+    print('ΔBIC (quadratic - linear) = {:.1f}, ΔlnZ = {:.1f}'.format(
+        c['delta_bic'], c['delta_lnZ']))
 
     linear_params = nparr([EPOCH,  PERIOD])
     if plongphasing:
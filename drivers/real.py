@@ -1,21 +1,31 @@
 """
 Fit data for "transit_NsincosPorb_NsincosProt" model.
 """
-import os
+import os, sys, pickle
 import numpy as np, pandas as pd, matplotlib.pyplot as plt, pymc3 as pm
 from os.path import join
 from itertools import product
 
 from billy.modelfitter import ModelFitter, ModelParser
 import billy.plotting as bp
+from billy.figurequeue import FigureQueue
+from billy.resultsdb import ResultsDB
+from billy.modelcomparison import get_posterior_ic
+from billy.posterior import summarize
 from billy.convenience import (
     get_clean_ptfo_data, get_ptfo_data, initialize_ptfo_prior_d, get_bic
 )
 from billy import __path__
 
-def main(modelid):
+def main(modelid, fq=None, makeplots=True):
+    """
+    If a billy.figurequeue.FigureQueue `fq` is passed, the figures are
+    rendered in its worker processes, concurrently with whatever is run next.
+    Otherwise they are made here, one after another. If not `makeplots`, only
+    run (or load) the fit.
+    """
 
-    make_threadsafe = 0
+    make_threadsafe = 0 if makeplots else 1
 
     traceplot = 0
     sampleplot = 1
@@ -24,9 +34,9 @@ def main(modelid):
 
     OVERWRITE = 1
     REALID = 'PTFO_8-8695'
+    RUNID = '20200513_v0'
     RESULTSDIR = os.path.join(os.path.dirname(__path__[0]), 'results')
-    PLOTDIR = os.path.join(RESULTSDIR, '{}_results'.format(REALID),
-                           '20200513_v0')
+    PLOTDIR = os.path.join(RESULTSDIR, '{}_results'.format(REALID), RUNID)
 
     ##########
 
@@ -47,9 +57,16 @@ def main(modelid):
     mp = ModelParser(modelid)
     prior_d = initialize_ptfo_prior_d(x_obs, mp.modelcomponents)
     m = ModelFitter(modelid, x_obs, y_obs, y_err, prior_d, plotdir=PLOTDIR,
-                    pklpath=pklpath, overwrite=OVERWRITE)
+                    pklpath=pklpath, overwrite=OVERWRITE, figqueue=fq,
+                    resultsdb=ResultsDB(), run_id=RUNID, target=REALID)
 
-    print(pm.summary(m.trace, varnames=list(prior_d.keys())))
+    print(summarize(m.trace, [k for k in prior_d if k in m.trace.varnames]))
+
+    if fq is None:
+        def plot(funcname, *args, **kwargs):
+            return getattr(bp, funcname)(*args, **kwargs)
+    else:
+        plot = fq.submit
 
     if make_threadsafe:
         pass
@@ -61,7 +78,7 @@ def main(modelid):
 
         if sampleplot:
             outpath = join(PLOTDIR, '{}_{}_sampleplot.png'.format(REALID, modelid))
-            bp.plot_sampleplot(m, outpath, N_samples=10)
+            plot('plot_sampleplot', m, outpath, N_samples=10)
 
         if splitsignalplot:
             do_post = 0
@@ -72,35 +89,51 @@ def main(modelid):
                 outpath = join(PLOTDIR, '{}_{}_phasefoldpost.png'.format(REALID, modelid))
                 bp.plot_phasefold_post(m, ydict, outpath)
             if do_map:
+                ydict = bp.get_splitsignal_map_ydict(m)
                 outpath = join(PLOTDIR, '{}_{}_splitsignalmap_i.png'.format(REALID, modelid))
-                ydict = bp.plot_splitsignal_map(m, outpath, part='i')
+                plot('plot_splitsignal_map', m, outpath, part='i')
                 outpath = join(PLOTDIR, '{}_{}_splitsignalmap_ii.png'.format(REALID, modelid))
-                ydict = bp.plot_splitsignal_map(m, outpath, part='ii')
+                plot('plot_splitsignal_map', m, outpath, part='ii')
                 outpath = join(PLOTDIR, '{}_{}_splitsignalmap_periodogram.png'.format(REALID, modelid))
                 if not os.path.exists(outpath) or m.OVERWRITE:
-                    bp.plot_splitsignal_map_periodogram(ydict, outpath)
+                    plot('plot_splitsignal_map_periodogram', ydict, outpath)
                 outpath = join(PLOTDIR, '{}_{}_phasefoldmap.png'.format(REALID, modelid))
-                bp.plot_phasefold_map(m, ydict, outpath)
+                plot('plot_phasefold_map', m, ydict, outpath)
                 get_bic(m, ydict, PLOTDIR)
+                icdict = get_posterior_ic(m)
+                icpath = join(PLOTDIR, '{}_posterior_ic.pkl'.format(modelid))
+                with open(icpath, 'wb') as buff:
+                    pickle.dump(icdict, buff)
 
         if cornerplot:
             prior_d.pop('omegaorb', None) # not sampled; only used in data generation
             prior_d.pop('phiorb', None) # not sampled; only used in data generation
             outpath = join(PLOTDIR, '{}_{}_cornerplot.png'.format(REALID, modelid))
-            bp.plot_cornerplot(prior_d, m, outpath)
+            plot('plot_cornerplot', prior_d, m, outpath)
 
 
 if __name__ == "__main__":
 
+    # e.g., `python real.py transit_3sincosPorb_2sincosProt [fit|plot]`, as
+    # called by build_paper.py.
+    if len(sys.argv) > 1:
+        main(sys.argv[1], makeplots=(sys.argv[2:] != ['fit']))
+        sys.exit(0)
+
     DEBUG = 0
 
+    fq = FigureQueue(N_workers=4)
+
     if DEBUG:
-        main('transit_2sincosPorb_2sincosProt')
+        main('transit_2sincosPorb_2sincosProt', fq=fq)
 
     else:
         for N, M in product(range(1,4), range(1,4)):
-            main('transit_{}sincosPorb_{}sincosProt'.format(N,M))
+            main('transit_{}sincosPorb_{}sincosProt'.format(N,M), fq=fq)
         # DEPRECATED
         # main('transit_2sincosPorb_2sincosProt')
         # main('transit_1sincosPorb_2sincosProt')
         # main('transit_2sincosPorb_1sincosProt')
+
+    fq.wait()
+    fq.close()
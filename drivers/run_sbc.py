@@ -0,0 +1,49 @@
+"""
+Simulation-based calibration of the "transit_NsincosPorb_NsincosProt" model
+and the PTFO 8-8695 priors, on the real time sampling and noise level.
+Several hundred replicas at a reduced budget; meant to run overnight.
+"""
+import os, sys
+import numpy as np
+from billy.sbc import run_sbc, get_rank_uniformity
+from billy.plotting import plot_rank_histograms
+from billy.convenience import get_clean_ptfo_data
+from billy import __path__
+
+def main(modelid):
+
+    REALID = 'PTFO_8-8695'
+    N_THIN = 99
+    RESULTSDIR = os.path.join(os.path.dirname(__path__[0]), 'results')
+    PLOTDIR = os.path.join(RESULTSDIR, '{}_results'.format(REALID), 'sbc')
+    if not os.path.exists(PLOTDIR):
+        os.mkdir(PLOTDIR)
+    outdir = os.path.join(
+        os.path.expanduser('~'), 'local', 'billy',
+        '{}_sbc_{}'.format(REALID, modelid)
+    )
+
+    x_obs, _, y_err = get_clean_ptfo_data()
+
+    ranks = run_sbc(modelid, x_obs, y_err, outdir, N_replicas=400,
+                    N_thin=N_THIN, tune=500, draws=500, N_chains=2,
+                    N_workers=16)
+
+    uniformity = get_rank_uniformity(ranks, N_thin=N_THIN)
+    print(uniformity)
+    uniformity.to_csv(os.path.join(PLOTDIR, '{}_rank_uniformity.csv'.format(
+        modelid)))
+
+    print('{} replicas; {} with divergences; median min ESS {:.0f}'.format(
+        len(ranks), np.sum(ranks.N_divergent > 0), np.median(ranks.min_ess)))
+
+    outpath = os.path.join(PLOTDIR, '{}_rank_histograms.png'.format(modelid))
+    plot_rank_histograms(ranks, outpath, N_thin=N_THIN)
+
+
+if __name__ == "__main__":
+
+    modelid = (
+        sys.argv[1] if len(sys.argv) > 1 else 'transit_1sincosPorb_1sincosProt'
+    )
+    main(modelid)
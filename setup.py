@@ -43,7 +43,8 @@ INSTALL_REQUIRES = [
 EXTRAS_REQUIRE = {
     'all':[
         'pymc3',
-        'corner'
+        'corner',
+        'pyarrow'
     ]
 }
 
@@ -0,0 +1,113 @@
+import numpy as np
+from billy.ephemeris import fit_ephemeris, pad_timing_sets, assign_epochs
+
+def main():
+    test_weighted_linear_ephemeris()
+    test_weighted_quadratic_ephemeris()
+    test_padded_batch()
+    test_padded_epochs()
+    test_all_padded_set()
+
+def _make_times(rng, epochs, params, sigmas):
+    t = sum(p*epochs**ix for ix, p in enumerate(params))
+    return t + rng.normal(scale=sigmas)
+
+def test_weighted_linear_ephemeris():
+
+    rng = np.random.default_rng(42)
+    epochs = np.arange(-300, 900, 7).astype(float)
+    sigmas = rng.uniform(1e-4, 3e-3, size=len(epochs))
+    times = _make_times(rng, epochs, (2458000.1234, 0.448413), sigmas)
+
+    d = fit_ephemeris(epochs, times, sigmas, order=1)
+
+    # np.polyfit weights the residuals by w, i.e., w = 1/σ; its unscaled
+    # covariance is (X^T W X)^{-1}, as in fit_ephemeris.
+    p, cov = np.polyfit(epochs, times, 1, w=1/sigmas, cov='unscaled')
+    assert np.allclose(d['params'], p[::-1], rtol=0, atol=1e-9)
+    assert np.allclose(d['cov'], cov[::-1, ::-1], rtol=1e-6, atol=0)
+
+    resid = times - (d['params'][0] + d['params'][1]*epochs)
+    assert np.isclose(d['chisq'], np.sum((resid/sigmas)**2), rtol=1e-6)
+    assert d['n_data'] == len(epochs) and d['dof'] == len(epochs) - 2
+
+def test_weighted_quadratic_ephemeris():
+
+    rng = np.random.default_rng(43)
+    epochs = np.arange(0, 2000, 11).astype(float)
+    sigmas = rng.uniform(1e-4, 1e-3, size=len(epochs))
+    times = _make_times(rng, epochs, (2458000.5, 0.448413, 1e-9), sigmas)
+
+    d = fit_ephemeris(epochs, times, sigmas, order=2)
+    p = np.polyfit(epochs, times, 2, w=1/sigmas)
+    assert np.allclose(d['params'], p[::-1], rtol=1e-6, atol=1e-9)
+
+def test_padded_batch():
+
+    # sets of different lengths, fit together, agree with separate fits;
+    # the padding (infinite σ) carries no weight.
+    rng = np.random.default_rng(44)
+    sets, epoch_sets = [], []
+    for N in [12, 30, 21]:
+        e = np.sort(rng.choice(500, size=N, replace=False)).astype(float)
+        s = rng.uniform(5e-4, 2e-3, size=N)
+        t = _make_times(rng, e, (2458000.3, 0.448413), s)
+        sets.append((t, s))
+        epoch_sets.append(e)
+
+    times, sigmas = pad_timing_sets(sets)
+    epochs = np.zeros_like(times)
+    for ix, e in enumerate(epoch_sets):
+        epochs[ix, :len(e)] = e
+
+    d = fit_ephemeris(epochs, times, sigmas, order=1)
+    for ix, (e, (t, s)) in enumerate(zip(epoch_sets, sets)):
+        d_ix = fit_ephemeris(e, t, s, order=1)
+        assert np.allclose(d['params'][ix], d_ix['params'], rtol=0,
+                           atol=1e-9)
+        assert np.isclose(d['chisq'][ix], d_ix['chisq'], rtol=1e-6)
+        assert d['n_data'][ix] == len(e)
+
+def test_padded_epochs():
+
+    # padding is neither a duplicate epoch nor ambiguous; real duplicates
+    # still are.
+    period, t0 = 0.448413, 2458000.3
+    sets = [
+        (t0 + period*np.array([0, 3, 7.]), np.full(3, 1e-3)),
+        (t0 + period*np.array([0, 2, 2.01, 5, 9]), np.full(5, 1e-3)),
+    ]
+    times, sigmas = pad_timing_sets(sets)
+
+    epochs, ambiguous = assign_epochs(times, period, t0, sigmas=sigmas)
+    assert list(epochs[0]) == [0, 3, 7, 0, 0]
+    assert not np.any(ambiguous[0])
+    assert list(ambiguous[1]) == [False, True, True, False, False]
+
+    # infinite σ alone (with a finite padding time) also marks padding.
+    times[0, 3:] = 0
+    epochs, ambiguous = assign_epochs(times, period, t0, sigmas=sigmas)
+    assert not np.any(ambiguous[0])
+
+def test_all_padded_set():
+
+    # a set with no (or too few) usable times is blanked, without breaking
+    # the fits of the other sets in the batch.
+    rng = np.random.default_rng(45)
+    e = np.arange(10).astype(float)
+    s = np.full(10, 1e-3)
+    t = _make_times(rng, e, (2458000.3, 0.448413), s)
+
+    times, sigmas = pad_timing_sets([(t, s), (t[:1], s[:1])])
+    times[1] = np.nan
+    sigmas[1] = np.inf
+    epochs = np.vstack([e, e])
+
+    with np.errstate(all='raise'):
+        d = fit_ephemeris(epochs, times, sigmas, order=1)
+    assert np.allclose(d['params'][0],
+                       fit_ephemeris(e, t, s, order=1)['params'])
+    assert np.all(np.isnan(d['params'][1])) and d['n_data'][1] == 0
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import numpy as np
+from billy.models import harmonic_model, evaluate_in_chunks
+
+def main():
+    test_harmonic_model_batched()
+    test_harmonic_model_scalar_frequency()
+    test_evaluate_in_chunks()
+
+def _direct(A, B, ω, φ, t):
+    # Σ_n A_n sin(n ω t + φ) + B_n cos(n ω t + φ), one harmonic at a time.
+    return sum(
+        A[ix]*np.sin((ix+1)*ω*t + φ) + B[ix]*np.cos((ix+1)*ω*t + φ)
+        for ix in range(len(A))
+    )
+
+def test_harmonic_model_batched():
+
+    rng = np.random.default_rng(42)
+    n_draws, N = 50, 3
+    t = np.linspace(0, 10, 500)
+    A = rng.normal(scale=0.01, size=(n_draws, N))
+    B = rng.normal(scale=0.01, size=(n_draws, N))
+    ω = rng.uniform(1, 3, size=n_draws)
+    φ = rng.uniform(-np.pi, np.pi, size=n_draws)
+
+    y = harmonic_model((A, B, ω, φ), t)
+    assert y.shape == (n_draws, len(t))
+
+    for ix in range(n_draws):
+        y_ix = harmonic_model((A[ix], B[ix], ω[ix], φ[ix]), t)
+        assert np.allclose(y[ix], y_ix, rtol=0, atol=1e-12)
+        assert np.allclose(y_ix, _direct(A[ix], B[ix], ω[ix], φ[ix], t),
+                           rtol=0, atol=1e-12)
+
+def test_harmonic_model_scalar_frequency():
+
+    # batched amplitudes, with ω and φ shared by every draw.
+    rng = np.random.default_rng(43)
+    n_draws, N = 7, 2
+    t = np.linspace(0, 5, 200)
+    A = rng.normal(size=(n_draws, N))
+    B = rng.normal(size=(n_draws, N))
+
+    y = harmonic_model((A, B, 2.1, 0.3), t)
+    assert y.shape == (n_draws, len(t))
+    for ix in range(n_draws):
+        assert np.allclose(y[ix], _direct(A[ix], B[ix], 2.1, 0.3, t),
+                           rtol=0, atol=1e-12)
+
+def test_evaluate_in_chunks():
+
+    rng = np.random.default_rng(44)
+    n_draws, N = 40, 2
+    t = np.linspace(0, 5, 300)
+    A = rng.normal(size=(n_draws, N))
+    B = rng.normal(size=(n_draws, N))
+    ω = rng.uniform(1, 3, size=n_draws)
+    φ = rng.uniform(-np.pi, np.pi, size=n_draws)
+
+    # chunks of a few draws give the same answer as one batch.
+    y = evaluate_in_chunks(harmonic_model, [A, B, ω, φ], t,
+                           max_bytes=4*8*len(t)*3)
+    assert np.allclose(y, harmonic_model((A, B, ω, φ), t), rtol=0,
+                       atol=1e-12)
+
+    # all-scalar parameters are a single draw.
+    y = evaluate_in_chunks(lambda p, t: p[0]*np.sin(p[1]*t), [0.5, 2.], t)
+    assert y.shape == (1, len(t))
+    assert np.allclose(y[0], 0.5*np.sin(2*t))
+
+if __name__ == "__main__":
+    main()
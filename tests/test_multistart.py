@@ -0,0 +1,38 @@
+import numpy as np
+from billy.multistart import dedupe_optima
+
+def main():
+    test_dedupe_optima()
+
+class _Bijection(object):
+    # stands in for pm's DictToArrayBijection: points are {'x': array}.
+    def map(self, point):
+        return np.asarray(point['x'], dtype=float)
+
+def test_dedupe_optima():
+
+    scale = np.array([1., 0.1])
+    optima = [
+        # mode 0: three starts, within a few % of a posterior width.
+        {'start_ix': 3, 'logp': -10.000, 'point': {'x': [0., 0.]}},
+        {'start_ix': 0, 'logp': -10.004, 'point': {'x': [0.02, 0.001]}},
+        {'start_ix': 5, 'logp': -10.006, 'point': {'x': [-0.03, -0.002]}},
+        # same logp as mode 0, but elsewhere (in units of `scale`).
+        {'start_ix': 1, 'logp': -10.001, 'point': {'x': [0., 0.5]}},
+        # same location as mode 0, but a different logp.
+        {'start_ix': 4, 'logp': -12.000, 'point': {'x': [0.01, 0.]}},
+        {'start_ix': 2, 'logp': -12.005, 'point': {'x': [0.01, 0.002]}},
+    ]
+
+    modes = dedupe_optima(optima, _Bijection(), scale, logp_tol=1e-2,
+                          x_tol=0.1)
+
+    assert len(modes) == 3
+    assert [m['start_ixs'] for m in modes] == [[3, 0, 5], [1], [4, 2]]
+    assert [m['N_converged'] for m in modes] == [3, 1, 2]
+    # each mode keeps its best (first) optimum.
+    assert [m['logp'] for m in modes] == [-10.000, -10.001, -12.000]
+    assert np.allclose(modes[1]['x'], [0., 0.5])
+
+if __name__ == "__main__":
+    main()
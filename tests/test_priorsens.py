@@ -0,0 +1,37 @@
+import numpy as np
+from billy.priorsens import truncnorm_logpdf
+
+def _trapz(y, x):
+    return np.sum(0.5*(y[1:] + y[:-1])*np.diff(x))
+
+def main():
+    test_truncnorm_normalization()
+    test_truncnorm_support()
+
+def test_truncnorm_normalization():
+
+    # integrates to one over [lower, upper], for narrow, wide, and
+    # off-center priors (the last two are cut hard by the bounds).
+    x = np.linspace(0, 3, 300001)
+    for mu, sd in [(0.39, 0.25), (1.23, 0.4), (0.1, 2.), (2.9, 0.05)]:
+        p = np.exp(truncnorm_logpdf(x, mu, sd))
+        assert np.isclose(_trapz(p, x), 1, rtol=1e-6), (mu, sd)
+
+    x = np.linspace(-1, 1, 200001)
+    p = np.exp(truncnorm_logpdf(x, 0.5, 1., lower=-1, upper=1))
+    assert np.isclose(_trapz(p, x), 1, rtol=1e-6)
+
+def test_truncnorm_support():
+
+    logp = truncnorm_logpdf([-0.1, 0, 1.5, 3, 3.1], 1.23, 0.4)
+    assert np.all(np.isneginf(logp[[0, 4]]))
+    assert np.all(np.isfinite(logp[1:4]))
+
+    # inside the bounds, only the normalization differs from a normal.
+    x = np.array([0.8, 1.2, 1.7])
+    lognormal = -0.5*((x - 1.23)/0.4)**2 - np.log(0.4*np.sqrt(2*np.pi))
+    d = truncnorm_logpdf(x, 1.23, 0.4) - lognormal
+    assert np.allclose(d, d[0]) and d[0] > 0
+
+if __name__ == "__main__":
+    main()
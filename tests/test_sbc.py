@@ -0,0 +1,52 @@
+import numpy as np, pandas as pd
+from billy.sbc import get_ranks, get_rank_uniformity
+
+def main():
+    test_get_ranks()
+    test_calibrated_ranks()
+    test_miscalibrated_ranks()
+
+def test_get_ranks():
+
+    # 1000 draws; the L = 11 thinned draws are 0, 99.9, ..., 999 -> 0, 99,
+    # ..., 999, so a truth of 250 is above three of them.
+    samples = np.arange(1000, dtype=float)[:, None] * np.ones(3)[None, :]
+    true = np.array([[-1., 250., 2000.]])
+    assert list(get_ranks(samples, true, 11)) == [0, 3, 11]
+    assert list(get_ranks(samples, true[0], 11)) == [0, 3, 11]
+
+def _simulate_ranks(rng, N_replicas, N_thin, post_sd):
+    # conjugate normal model: θ ~ N(0, 1), y ~ N(θ, 1), so the posterior
+    # is N(y/2, 1/2). post_sd rescales the posterior width (1/√2 is
+    # calibrated).
+    rows = []
+    for ix in range(N_replicas):
+        theta = rng.normal()
+        y = rng.normal(loc=theta)
+        samples = rng.normal(loc=y/2, scale=post_sd, size=(500, 1))
+        ranks = get_ranks(samples, np.array([[theta]]), N_thin)
+        rows.append({'replica': ix, 'theta': ranks[0]})
+    return pd.DataFrame(rows)
+
+def test_calibrated_ranks():
+
+    rng = np.random.default_rng(42)
+    N_thin = 99
+    ranks = _simulate_ranks(rng, 2000, N_thin, 1/np.sqrt(2))
+    assert ranks['theta'].between(0, N_thin).all()
+
+    d = get_rank_uniformity(ranks, N_thin=N_thin, N_bins=20)
+    assert d.loc['theta', 'p_value'] > 1e-3
+    assert abs(d.loc['theta', 'mean_rank_offset']) < 0.03
+
+def test_miscalibrated_ranks():
+
+    # too-narrow posteriors give ∪-shaped histograms, caught by the χ² test.
+    rng = np.random.default_rng(43)
+    N_thin = 99
+    ranks = _simulate_ranks(rng, 2000, N_thin, 0.3)
+    d = get_rank_uniformity(ranks, N_thin=N_thin, N_bins=20)
+    assert d.loc['theta', 'p_value'] < 1e-6
+
+if __name__ == "__main__":
+    main()